@@ -0,0 +1,71 @@
+""" Compare random-access reads of BDT entries with seek+read and with a
+memory-mapped BDT, on a synthetic file. Each entry is hashed with CRC32 so that
+both modes actually touch the data. Run from the SiegLib directory:
+
+    python -m benchmarks.bdt_read --size 512 --entries 20000
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+import zlib
+
+from sieglib.bdt import Bdt
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("--size", type = int, default = 256,
+                           help = "BDT size in MiB")
+    argparser.add_argument("--entries", type = int, default = 20000)
+    argparser.add_argument("--max-entry-size", type = int, default = 0x10000)
+    args = argparser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        bdt_path = os.path.join(temp_dir, "bench.bdt")
+        bdt_size = args.size * 1024 * 1024
+        write_synthetic_bdt(bdt_path, bdt_size)
+        entries = make_random_entries(
+            bdt_size, args.entries, args.max_entry_size
+        )
+        print("{} MiB, {} random entries".format(args.size, len(entries)))
+        for use_mmap in (False, True):
+            duration, checksum = measure_reads(bdt_path, entries, use_mmap)
+            print("{:10}: {:8.3f} ms (checksum {:08X})".format(
+                "mmap" if use_mmap else "seek+read", duration * 1000, checksum
+            ))
+
+def write_synthetic_bdt(bdt_path, bdt_size):
+    with open(bdt_path, "wb") as bdt_file:
+        bdt_file.write(Bdt.FULL_MAGIC)
+        block = os.urandom(1024 * 1024)
+        written = len(Bdt.FULL_MAGIC)
+        while written < bdt_size:
+            written += bdt_file.write(block[: bdt_size - written])
+
+def make_random_entries(bdt_size, num_entries, max_entry_size):
+    rng = random.Random(0)
+    entries = []
+    for _ in range(num_entries):
+        size = rng.randrange(1, max_entry_size)
+        offset = rng.randrange(len(Bdt.FULL_MAGIC), bdt_size - size)
+        entries.append((offset, size))
+    return entries
+
+def measure_reads(bdt_path, entries, use_mmap):
+    """ Return the duration of reading all entries and a checksum of them. """
+    bdt = Bdt()
+    bdt.open(bdt_path, use_mmap = use_mmap)
+    checksum = 0
+    start = time.perf_counter()
+    for offset, size in entries:
+        checksum = zlib.crc32(bdt.read_entry(offset, size), checksum)
+    duration = time.perf_counter() - start
+    bdt.close()
+    return duration, checksum
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+""" Compare loading time and memory of Bhd.load in object and compact modes,
+on a synthetic BHD5 file. Run from the SiegLib directory:
+
+    python -m benchmarks.bhd_load --records 1000 --entries 100000
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+from sieglib.bhd import Bhd, BhdHeader, BhdRecord, BhdDataEntry
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("--records", type = int, default = 1000)
+    argparser.add_argument("--entries", type = int, default = 100000)
+    argparser.add_argument("--repeat", type = int, default = 3)
+    args = argparser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        bhd_path = os.path.join(temp_dir, "bench.bhd5")
+        write_synthetic_bhd(bhd_path, args.records, args.entries)
+        print("{} records, {} entries, {} bytes".format(
+            args.records, args.entries, os.stat(bhd_path).st_size
+        ))
+        for compact in (False, True):
+            duration, peak = measure_load(bhd_path, compact, args.repeat)
+            print("{:8}: {:8.3f} ms, peak {:8.1f} KiB".format(
+                "compact" if compact else "objects", duration * 1000,
+                peak / 1024
+            ))
+
+def write_synthetic_bhd(bhd_path, num_records, num_entries):
+    """ Write a BHD5 with num_entries random entries spread in num_records. """
+    rng = random.Random(0)
+    bhd = Bhd()
+    bhd.records = [BhdRecord() for _ in range(num_records)]
+    offset = 16
+    for _ in range(num_entries):
+        entry = BhdDataEntry()
+        entry.hash = rng.getrandbits(32)
+        entry.size = rng.randrange(1, 0x2000)
+        entry.offset = offset
+        offset += entry.size + (-entry.size % 16)
+        bhd.records[entry.hash % num_records].entries.append(entry)
+    bhd.header = BhdHeader()
+    bhd.header.num_records = num_records
+    bhd.save(bhd_path)
+
+def measure_load(bhd_path, compact, repeat):
+    """ Return the best load duration and the peak traced memory. """
+    best_duration = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        Bhd().load(bhd_path, compact = compact)
+        duration = time.perf_counter() - start
+        if best_duration is None or duration < best_duration:
+            best_duration = duration
+
+    tracemalloc.start()
+    bhd = Bhd()
+    bhd.load(bhd_path, compact = compact)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best_duration, peak
+
+
+if __name__ == "__main__":
+    main()
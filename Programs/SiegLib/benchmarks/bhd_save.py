@@ -0,0 +1,77 @@
+""" Compare saving a synthetic BHD5 file with one write per header, record and
+data entry (how Bhd.save used to work) and with Bhd.save, which packs the file
+in one buffer, from records and from a compact table. Outputs are checked to
+be byte-identical. Run from the SiegLib directory:
+
+    python -m benchmarks.bhd_save --records 1000 --entries 100000
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from benchmarks.bhd_load import write_synthetic_bhd
+from sieglib.bhd import Bhd, BhdRecord, BhdDataEntry
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("--records", type = int, default = 1000)
+    argparser.add_argument("--entries", type = int, default = 100000)
+    argparser.add_argument("--repeat", type = int, default = 3)
+    args = argparser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        bhd_path = os.path.join(temp_dir, "bench.bhd5")
+        write_synthetic_bhd(bhd_path, args.records, args.entries)
+        print("{} records, {} entries, {} bytes".format(
+            args.records, args.entries, os.stat(bhd_path).st_size
+        ))
+        bhd = Bhd()
+        bhd.load(bhd_path)
+        compact_bhd = Bhd()
+        compact_bhd.load(bhd_path, compact = True)
+
+        cases = (
+            ("streamed", lambda path: save_streamed(bhd, path)),
+            ("buffered", bhd.save),
+            ("compact", compact_bhd.save)
+        )
+        contents = []
+        for name, save in cases:
+            output_path = os.path.join(temp_dir, name + ".bhd5")
+            duration = measure_save(save, output_path, args.repeat)
+            print("{:8}: {:8.3f} ms".format(name, duration * 1000))
+            with open(output_path, "rb") as output_file:
+                contents.append(output_file.read())
+        if any(content != contents[0] for content in contents):
+            print("Outputs differ!")
+
+def save_streamed(bhd, file_path):
+    """ Save bhd with one write per header, record and data entry. """
+    with open(file_path, "wb") as header_file:
+        bhd.header.save(header_file)
+        offset = ( bhd.header.records_offset
+                   + len(bhd.records) * BhdRecord.RECORD_BIN.size )
+        for record in bhd.records:
+            record.save(offset, header_file)
+            offset += len(record.entries) * BhdDataEntry.DATA_ENTRY_BIN.size
+        for record in bhd.records:
+            for entry in record.entries:
+                entry.save(header_file)
+
+def measure_save(save, output_path, repeat):
+    """ Return the best duration of save(output_path). """
+    best_duration = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        save(output_path)
+        duration = time.perf_counter() - start
+        if best_duration is None or duration < best_duration:
+            best_duration = duration
+    return best_duration
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+""" Compare exporting a synthetic archive in record order and in BDT offset
+order (see ReadPlanner). Entries of the synthetic BHD are spread in records by
+hash, like in the game archives, so record order jumps around the BDT. Before
+each run the BDT pages are dropped from the page cache with posix_fadvise, to
+approach a cold cache without root privileges. Run from the SiegLib directory:
+
+    python -m benchmarks.export_order --entries 50000
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from benchmarks.bdt_read import write_synthetic_bdt
+from benchmarks.bhd_load import write_synthetic_bhd
+from sieglib.bhd import Bhd
+from sieglib.external_archive import ExternalArchive
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("--records", type = int, default = 1000)
+    argparser.add_argument("--entries", type = int, default = 50000)
+    args = argparser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        bhd_path = os.path.join(temp_dir, "bench.bhd5")
+        write_synthetic_bhd(bhd_path, args.records, args.entries)
+        bhd = Bhd()
+        bhd.load(bhd_path)
+        bdt_size = max(
+            entry.offset + entry.size
+            for record in bhd.records for entry in record.entries
+        )
+        write_synthetic_bdt(os.path.join(temp_dir, "bench.bdt"), bdt_size)
+        print("{} entries, {:.1f} MiB".format(
+            args.entries, bdt_size / (1024 * 1024)
+        ))
+        for offset_order in (False, True):
+            output_dir = os.path.join(temp_dir, "export")
+            duration = measure_export(bhd_path, output_dir, offset_order)
+            shutil.rmtree(output_dir)
+            print("{:12}: {:8.3f} s, {:8.1f} MiB/s".format(
+                "offset order" if offset_order else "record order", duration,
+                bdt_size / (1024 * 1024) / duration
+            ))
+
+def measure_export(bhd_path, output_dir, offset_order):
+    """ Return the duration of exporting the archive at bhd_path. """
+    archive = ExternalArchive()
+    archive.load(bhd_path)
+    drop_cache(archive.bdt.bdt_file.fileno())
+    start = time.perf_counter()
+    archive.export_all_files(output_dir, offset_order = offset_order)
+    duration = time.perf_counter() - start
+    archive.bdt.close()
+    return duration
+
+def drop_cache(file_descriptor):
+    if hasattr(os, "posix_fadvise"):
+        os.fsync(file_descriptor)
+        os.posix_fadvise(file_descriptor, 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+if __name__ == "__main__":
+    main()
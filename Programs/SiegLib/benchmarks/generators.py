@@ -0,0 +1,106 @@
+""" Generators of synthetic files for the benchmarks: BHD5/BDT archives with
+named and DCX entries, DCX files of a given compression ratio, BND3 archives
+with 20 or 24-byte entries and TPF files. Everything is generated from a seed so
+results can be compared between runs. """
+
+import os
+import random
+from struct import Struct
+
+from sieglib.bdt import Bdt
+from sieglib.bhd import Bhd, BhdHeader, BhdRecord, BhdDataEntry
+from sieglib.bnd import Bnd, BndEntry, BndFlags
+from sieglib.dcx import Dcx
+
+
+def make_data(rng, size, ratio = 1.0):
+    """ Return size bytes that zlib compresses to about ratio of their size:
+    a random part followed by a part of repeated bytes. """
+    random_size = int(size * ratio)
+    return ( rng.getrandbits(8 * random_size).to_bytes(random_size, "little")
+             + b"\x00" * (size - random_size) )
+
+def write_archive( bhd_path, num_records, num_entries, entry_size = 0x4000,
+                   dcx_every = 4, ratio = 0.5, seed = 0 ):
+    """ Write a BHD5/BDT archive at bhd_path with num_entries named entries
+    spread in num_records by hash; one entry out of dcx_every is a DCX. Entry
+    sizes are random up to entry_size. Return the filelist (dict of hashes to
+    names). """
+    rng = random.Random(seed)
+    filelist = {}
+    bdt = Bdt()
+    bdt.open(os.path.splitext(bhd_path)[0] + ".bdt", "wb")
+    bdt.make_header()
+    bhd = Bhd()
+    bhd.records = [BhdRecord() for _ in range(num_records)]
+    for index in range(num_entries):
+        data = make_data(rng, rng.randrange(1, entry_size), ratio)
+        name = "/bench/{:03}/{:06}.bin".format(index % 100, index)
+        if dcx_every and index % dcx_every == 0:
+            data = Dcx.compress_data(data)
+            name += ".dcx"
+        entry = BhdDataEntry()
+        entry.hash = BhdDataEntry.hash_name(name)
+        entry.offset, entry.size = bdt.import_data(data)
+        bhd.records[entry.hash % num_records].entries.append(entry)
+        filelist[entry.hash] = name
+    bdt.close()
+    bhd.header = BhdHeader()
+    bhd.header.num_records = num_records
+    bhd.save(bhd_path)
+    return filelist
+
+def write_bnd( bnd_path, num_entries, entry_size = 0x1000,
+               has_24b_entries = True, seed = 0 ):
+    """ Write a BND3 at bnd_path with num_entries entries with absolute paths,
+    with 24-byte entry structs if has_24b_entries is True, else 20-byte ones.
+    """
+    rng = random.Random(seed)
+    bnd = Bnd()
+    bnd.flags = BndFlags.TYPE3 if has_24b_entries else BndFlags.TYPE2
+    bnd._set_entry_bin()
+    for index in range(num_entries):
+        entry = BndEntry()
+        entry.ident = index
+        entry.decoded_path = Bnd.VIRTUAL_ROOT + "\\bench\\{:05}.bin".format(
+            index
+        )
+        entry.set_has_absolute_path()
+        entry.data = make_data(rng, rng.randrange(1, entry_size))
+        entry.data_size = entry.unk2 = len(entry.data)
+        bnd.entries.append(entry)
+    bnd.num_entries = num_entries
+    bnd.save(bnd_path)
+
+TPF_HEADER_BIN = Struct("<4I")
+TPF_ENTRY_BIN = Struct("<5I")
+TPF_MAGIC = 0x00465054
+
+def write_tpf(tpf_path, num_textures, texture_size = 0x10000, seed = 0):
+    """ Write a TPF at tpf_path with num_textures textures of texture_size
+    bytes, in the layout read by solairelib.tpf. """
+    rng = random.Random(seed)
+    names = [ "texture_{:04}".format(index).encode("utf8") + b"\x00"
+              for index in range(num_textures) ]
+    names_position = TPF_HEADER_BIN.size + num_textures * TPF_ENTRY_BIN.size
+    data_position = names_position + sum(len(name) for name in names)
+    data_position += -data_position % 16
+
+    entries = []
+    name_position = names_position
+    position = data_position
+    for name in names:
+        entries.append(TPF_ENTRY_BIN.pack(
+            position, texture_size, 0, name_position, 0
+        ))
+        name_position += len(name)
+        position += texture_size
+    with open(tpf_path, "wb") as tpf_file:
+        tpf_file.write(TPF_HEADER_BIN.pack(
+            TPF_MAGIC, position - data_position, num_textures, 0
+        ))
+        tpf_file.write(b"".join(entries))
+        tpf_file.write(b"".join(names))
+        tpf_file.write(b"\x00" * (data_position - name_position))
+        for _ in range(num_textures):
+            tpf_file.write(make_data(rng, texture_size))
@@ -0,0 +1,266 @@
+""" Benchmark suite: generate synthetic archives (see benchmarks.generators),
+time loading, exporting, importing, saving and round-trips, and write the
+results as JSON so they can be compared between commits. Run from the SiegLib
+directory:
+
+    python -m benchmarks.suite --output before.json
+    python -m benchmarks.suite --output after.json
+    python -m benchmarks.suite --compare before.json after.json
+
+TPF cases need solairelib (add Programs/SiegLib/../SolaireLib to PYTHONPATH);
+they are skipped if it can't be imported.
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+
+from benchmarks import generators
+from sieglib.bhd import Bhd
+from sieglib.bnd import Bnd
+from sieglib.dcx import Dcx
+from sieglib.external_archive import ExternalArchive
+from sieglib.filelist import Filelist
+
+try:
+    from solairelib.tpf import Tpf
+except ImportError:
+    Tpf = None
+
+
+DCX_RATIOS = (0.1, 0.5, 0.9)
+
+
+def main():
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument("--records", type = int, default = 500)
+    argparser.add_argument("--entries", type = int, default = 5000)
+    argparser.add_argument("--bnd-entries", type = int, default = 500)
+    argparser.add_argument("--dcx-size", type = int, default = 4 * 1024 * 1024)
+    argparser.add_argument("--textures", type = int, default = 64)
+    argparser.add_argument("--repeat", type = int, default = 3)
+    argparser.add_argument("--output", type = str,
+                           help = "write results to that JSON file")
+    argparser.add_argument("--compare", nargs = 2, metavar = ("OLD", "NEW"),
+                           help = "compare two result files")
+    args = argparser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    # Per-file logging would be measured with everything else.
+    logging.getLogger("sieglib").setLevel(logging.WARNING)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        suite = BenchmarkSuite(temp_dir, args.repeat)
+        suite.run_archive(args.records, args.entries)
+        suite.run_dcx(args.dcx_size)
+        for has_24b_entries in (False, True):
+            suite.run_bnd(args.bnd_entries, has_24b_entries)
+        suite.run_tpf(args.textures)
+    report = suite.get_report(vars(args))
+    for name, result in report["results"].items():
+        print("{:28} {:10.3f} ms".format(name, result["seconds"] * 1000))
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent = 2)
+
+def compare(old_path, new_path):
+    """ Print the durations of two result files and their ratio. """
+    with open(old_path, "r") as old_file:
+        old_results = json.load(old_file)["results"]
+    with open(new_path, "r") as new_file:
+        new_results = json.load(new_file)["results"]
+    for name in sorted(set(old_results) | set(new_results)):
+        old = old_results.get(name, {}).get("seconds")
+        new = new_results.get(name, {}).get("seconds")
+        if old is None or new is None:
+            only_in = "OLD" if new is None else "NEW"
+            print("{:28} only in {}".format(name, only_in))
+            continue
+        print("{:28} {:10.3f} ms {:10.3f} ms {:7.2f}x".format(
+            name, old * 1000, new * 1000, old / new if new else 0.0
+        ))
+
+
+class BenchmarkSuite(object):
+    """ Run benchmark cases in temp_dir; each case keeps the best of repeat
+    runs.
+
+    Attributes:
+    - results: dict which maps case names to dicts with "seconds" and "bytes"
+    """
+
+    def __init__(self, temp_dir, repeat = 3):
+        self.temp_dir = temp_dir
+        self.repeat = repeat
+        self.results = {}
+
+    def measure(self, name, function, num_bytes = 0, setup = None):
+        """ Time function, calling setup before each run, and store the best
+        duration under name. Return the last result of function. """
+        best_duration = None
+        result = None
+        for _ in range(self.repeat):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            result = function()
+            duration = time.perf_counter() - start
+            if best_duration is None or duration < best_duration:
+                best_duration = duration
+        self.results[name] = { "seconds": best_duration, "bytes": num_bytes }
+        return result
+
+    def _get_path(self, *parts):
+        return os.path.join(self.temp_dir, *parts)
+
+    @staticmethod
+    def _clear(path):
+        """ Return a setup function emptying the directory at path. """
+        def setup():
+            shutil.rmtree(path, ignore_errors = True)
+            os.makedirs(path)
+        return setup
+
+    def run_archive(self, num_records, num_entries):
+        bhd_path = self._get_path("archive", "dvdbnd.bhd5")
+        os.makedirs(os.path.dirname(bhd_path))
+        filelist = generators.write_archive(bhd_path, num_records, num_entries)
+        bdt_size = os.stat(os.path.splitext(bhd_path)[0] + ".bdt").st_size
+
+        self.measure("bhd.load", lambda: Bhd().load(bhd_path))
+        self.measure( "bhd.load_compact",
+                      lambda: Bhd().load(bhd_path, compact = True) )
+        bhd = Bhd()
+        bhd.load(bhd_path)
+        saved_path = self._get_path("saved.bhd5")
+        self.measure("bhd.save", lambda: bhd.save(saved_path))
+
+        archive = ExternalArchive()
+        archive.load(bhd_path)
+        archive.filelist = Filelist(filelist)
+        export_dir = self._get_path("export")
+        self.measure( "archive.export",
+                      lambda: archive.export_all_files(export_dir),
+                      bdt_size, self._clear(export_dir) )
+        archive.bdt.close()
+
+        # Importing compresses decompressed files in place, replacing them with
+        # their DCX: each run imports a fresh copy of the exported tree.
+        import_dir = self._get_path("import")
+        import_tree_dir = os.path.join(import_dir, "tree")
+        import_path = os.path.join(import_dir, "dvdbnd.bhd5")
+        def copy_tree():
+            self._clear(import_dir)()
+            shutil.copytree(export_dir, import_tree_dir)
+        def import_files():
+            imported = ExternalArchive()
+            imported.filelist = Filelist(filelist)
+            imported.import_files(import_tree_dir, import_path)
+        self.measure("archive.import", import_files, bdt_size, copy_tree)
+
+        round_trip_dir = self._get_path("round_trip")
+        tree_dir = os.path.join(round_trip_dir, "tree")
+        def round_trip():
+            source = ExternalArchive()
+            source.load(bhd_path)
+            source.filelist = Filelist(filelist)
+            source.export_all_files(tree_dir)
+            source.bdt.close()
+            imported = ExternalArchive()
+            imported.filelist = Filelist(filelist)
+            imported.import_files(
+                tree_dir, os.path.join(round_trip_dir, "dvdbnd.bhd5")
+            )
+        self.measure( "archive.round_trip", round_trip, bdt_size,
+                      self._clear(round_trip_dir) )
+
+    def run_dcx(self, size):
+        for ratio in DCX_RATIOS:
+            rng = random.Random(0)
+            data = generators.make_data(rng, size, ratio)
+            data_path = self._get_path("dcx_{}.bin".format(ratio))
+            with open(data_path, "wb") as data_file:
+                data_file.write(data)
+            name = "dcx.{:.1f}".format(ratio)
+
+            def deflate():
+                dcx = Dcx()
+                dcx.load_decompressed(data_path)
+                return dcx.generate_data()
+            dcx_data = self.measure(name + ".deflate", deflate, size)
+
+            def inflate():
+                dcx = Dcx()
+                dcx.load_data(dcx_data)
+                return dcx.get_decompressed()
+            self.measure(name + ".inflate", inflate, size)
+
+    def run_bnd(self, num_entries, has_24b_entries):
+        name = "bnd{}".format(24 if has_24b_entries else 20)
+        bnd_path = self._get_path(name + ".bnd")
+        generators.write_bnd(bnd_path, num_entries,
+                             has_24b_entries = has_24b_entries)
+        bnd_size = os.stat(bnd_path).st_size
+
+        self.measure(name + ".load", lambda: Bnd().load(bnd_path), bnd_size)
+        bnd = Bnd()
+        bnd.load(bnd_path)
+        saved_path = self._get_path(name + ".saved.bnd")
+        self.measure(name + ".save", lambda: bnd.save(saved_path), bnd_size)
+        extract_dir = self._get_path(name + "_extract")
+        self.measure( name + ".extract",
+                      lambda: bnd.extract_all_files(extract_dir), bnd_size,
+                      self._clear(extract_dir) )
+
+        def round_trip():
+            imported = Bnd()
+            imported.import_files(extract_dir)
+            imported.save(saved_path)
+        self.measure(name + ".round_trip", round_trip, bnd_size)
+
+    def run_tpf(self, num_textures):
+        if Tpf is None:
+            print("solairelib not found, skipping TPF cases.")
+            return
+        tpf_path = self._get_path("bench.tpf")
+        generators.write_tpf(tpf_path, num_textures)
+        tpf_size = os.stat(tpf_path).st_size
+        self.measure("tpf.load", lambda: Tpf().load(tpf_path), tpf_size)
+        tpf = Tpf()
+        tpf.load(tpf_path)
+        extract_dir = self._get_path("tpf_extract")
+        os.makedirs(extract_dir)
+        self.measure( "tpf.extract", lambda: tpf.extract_textures(extract_dir),
+                      tpf_size )
+
+    def get_report(self, parameters):
+        """ Return the results with the parameters and environment. """
+        return {
+            "commit": _get_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "parameters": { k: v for k, v in parameters.items()
+                            if k not in ("output", "compare") },
+            "results": self.results
+        }
+
+def _get_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr = subprocess.DEVNULL
+        ).decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == "__main__":
+    main()
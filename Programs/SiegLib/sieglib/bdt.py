@@ -1,58 +1,275 @@
+import hashlib
+import io
+import mmap
+import os
+import threading
+
 from pyshgck.bin import pad_file
 from sieglib.log import LOG
+from sieglib.metrics import METRICS
 
 
 class Bdt(object):
     """ Describe a BDT file. Do not load the whole file in memory as they can
-    weight several GB, just open the file in whatever mode you need. """
+    weight several GB, just open the file in whatever mode you need.
+
+    A read-only BDT can also be memory-mapped; read_entry then returns
+    memoryview slices of the map instead of copies of the entries. Reads can be
+    done from several threads.
+
+    When writing, if dedup is True, data already written by import_data or
+    import_file is not written again: its first position is returned instead,
+    and bytes_saved counts the bytes that were not written. """
 
     MAGIC      = 0x33464442  # BDF3
     FULL_MAGIC = b"\x42\x44\x46\x33\x30\x37\x44\x37\x52\x36" + b"\x00"*6
 
+    # Size of the chunks used when an entry can't be copied by the kernel.
+    CHUNK_SIZE = 1024 * 1024
+
     def __init__(self):
         self.bdt_file = None
+        self.file_path = None
+        self.bdt_mmap = None
         self.opened = False
+        self.dedup = False
+        self.lock = threading.Lock()
+        self.content_positions = {}
+        self.bytes_saved = 0
 
     def __del__(self):
         if self.opened:
             self.close()
 
-    def open(self, file_path, mode = "rb"):
+    def open(self, file_path, mode = "rb", use_mmap = False):
+        """ Open the BDT file; if use_mmap is True and mode is "rb", the file is
+        also memory-mapped (if it is not empty). """
         try:
             self.bdt_file = open(file_path, mode)
         except OSError as exc:
             LOG.error("Error opening {}: {}".format(file_path, exc))
             return
+        try:
+            if use_mmap and mode == "rb":
+                self._map_file()
+        except OSError as exc:
+            LOG.error("Error mapping {}: {}".format(file_path, exc))
+            self.bdt_file.close()
+            self.bdt_file = None
+            return
+        self.file_path = file_path
         self.opened = True
 
+    def _map_file(self):
+        """ Memory-map the opened file; empty files can't be mapped. """
+        file_descriptor = self.bdt_file.fileno()
+        if os.fstat(file_descriptor).st_size == 0:
+            return
+        self.bdt_mmap = mmap.mmap(file_descriptor, 0, access = mmap.ACCESS_READ)
+
     def close(self):
+        if self.bdt_mmap is not None:
+            try:
+                self.bdt_mmap.close()
+            except BufferError:
+                # Views returned by read_entry are still alive; the map will be
+                # unmapped when they are all released.
+                pass
+            self.bdt_mmap = None
         self.bdt_file.close()
         self.opened = False
 
     def read_entry(self, position, size):
+        """ Return the entry content, as bytes or as a memoryview if the BDT is
+        memory-mapped. The content is shorter than size if the end of the BDT
+        is reached. """
         assert self.opened
-        self.bdt_file.seek(position)
-        content = self.bdt_file.read(size)
+        if self.bdt_mmap is not None:
+            return memoryview(self.bdt_mmap)[position : position + size]
+        with METRICS.measure(METRICS.BDT_READ) as timer:
+            with self.lock:
+                self.bdt_file.seek(position)
+                content = self.bdt_file.read(size)
+            timer.num_bytes = len(content)
         return content
 
+    def open_entry(self, position, size):
+        """ Return a seekable, read-only, buffered file object over the entry at
+        position; the BDT must stay opened while it is used. """
+        assert self.opened
+        return io.BufferedReader(BdtEntryFile(self, position, size))
+
+    def copy_entry(self, position, size, output_file):
+        """ Copy the entry at position to the output_file object without
+        loading it in memory, return the number of bytes copied (lower than size
+        if the end of the BDT is reached). When possible (Linux) the data is
+        copied by the kernel with copy_file_range or sendfile, else it is copied
+        in chunks of CHUNK_SIZE bytes. """
+        assert self.opened
+        output_file.flush()
+        with METRICS.measure(METRICS.BDT_COPY) as timer:
+            copied = Bdt._copy_in_kernel(
+                self.bdt_file.fileno(), output_file.fileno(), position, size
+            )
+            timer.num_bytes = copied
+        if copied < size:
+            copied += self._copy_in_chunks(
+                position + copied, size - copied, output_file
+            )
+        return copied
+
+    @staticmethod
+    def _copy_in_kernel(in_fd, out_fd, position, size):
+        """ Copy with the first system call supported for these descriptors;
+        return the number of bytes copied, 0 if none is supported. """
+        copied = 0
+        for copy_function in KERNEL_COPY_FUNCTIONS:
+            try:
+                while copied < size:
+                    num_copied = copy_function(
+                        in_fd, out_fd, position + copied, size - copied
+                    )
+                    if num_copied == 0:  # end of file
+                        return copied
+                    copied += num_copied
+                return copied
+            except OSError:
+                continue
+        return copied
+
+    def _copy_in_chunks(self, position, size, output_file):
+        copied = 0
+        while copied < size:
+            chunk_size = min(self.CHUNK_SIZE, size - copied)
+            chunk = self.read_entry(position + copied, chunk_size)
+            if not chunk:
+                break
+            output_file.write(chunk)
+            copied += len(chunk)
+        return copied
+
     def make_header(self):
         assert self.opened
         self.bdt_file.seek(0)
         self.bdt_file.write(Bdt.FULL_MAGIC)
 
     def import_file(self, file_path):
-        position = self.bdt_file.tell()
         try:
-            with open(file_path, "rb") as input_file:
-                file_content = input_file.read()
-            num_written = self.bdt_file.write(file_content)
-
-            # Pad the BDT file to 16-byte if needed.
-            pad_file(self.bdt_file, 16)
+            with METRICS.measure(METRICS.FS_READ) as timer:
+                with open(file_path, "rb") as input_file:
+                    file_content = input_file.read()
+                timer.num_bytes = len(file_content)
         except OSError as exc:
             LOG.error("Error importing {}: {}".format(
                 file_path, exc
             ))
+            return self.bdt_file.tell(), -1
+        return self.import_data(file_content)
+
+    def import_data(self, data):
+        """ Write data at the current position, return the position and the
+        number of bytes written, or -1 on error. With dedup, identical data
+        previously imported is not written and its position is returned. """
+        if self.dedup:
+            digest = hashlib.sha1(data).digest()
+            if digest in self.content_positions:
+                self.bytes_saved += len(data)
+                return self.content_positions[digest]
+        position = self.bdt_file.tell()
+        try:
+            with METRICS.measure(METRICS.BDT_WRITE, len(data)):
+                num_written = self.bdt_file.write(data)
+
+                # Pad the BDT file to 16-byte if needed.
+                pad_file(self.bdt_file, 16)
+        except OSError as exc:
+            LOG.error("Error writing BDT data: {}".format(exc))
             return position, -1
         else:
+            if self.dedup:
+                self.content_positions[digest] = (position, num_written)
             return position, num_written
+
+    def import_range(self, source_bdt, position, size):
+        """ Write the entry at position in source_bdt at the current position,
+        copied kernel-side when possible (see copy_entry); return the position
+        and the number of bytes written, or -1 on error. """
+        output_position = self.bdt_file.tell()
+        try:
+            copied = source_bdt.copy_entry(position, size, self.bdt_file)
+            # The copy may not have moved the position of the file object.
+            self.bdt_file.seek(output_position + copied)
+            if copied != size:
+                LOG.error("Tried to copy {} bytes but only {} were "
+                          "available.".format(size, copied))
+                return output_position, -1
+            pad_file(self.bdt_file, 16)
+        except OSError as exc:
+            LOG.error("Error writing BDT data: {}".format(exc))
+            return output_position, -1
+        return output_position, copied
+
+    def seek_end(self):
+        """ Move to the end of the BDT, to append entries. """
+        assert self.opened
+        self.bdt_file.seek(0, os.SEEK_END)
+
+
+class BdtEntryFile(io.RawIOBase):
+    """ Raw read-only file object over the range of an entry in a BDT. Reading
+    past the entry size behaves like reaching the end of a file. """
+
+    def __init__(self, bdt, position, size):
+        super().__init__()
+        self.bdt = bdt
+        self.start = position
+        self.size = size
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence = io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError("Invalid whence ({})".format(whence))
+        if position < 0:
+            raise ValueError("Negative seek position {}".format(position))
+        self.position = position
+        return self.position
+
+    def readinto(self, buffer):
+        num_to_read = min(len(buffer), self.size - self.position)
+        if num_to_read <= 0:
+            return 0
+        data = self.bdt.read_entry(self.start + self.position, num_to_read)
+        num_read = len(data)
+        buffer[:num_read] = data
+        self.position += num_read
+        return num_read
+
+
+def _copy_file_range(in_fd, out_fd, position, count):
+    return os.copy_file_range(in_fd, out_fd, count, position)
+
+def _sendfile(in_fd, out_fd, position, count):
+    return os.sendfile(out_fd, in_fd, position, count)
+
+# Kernel-side copy functions available on this platform, in preference order;
+# os.sendfile only accepts regular files as output on Linux.
+KERNEL_COPY_FUNCTIONS = []
+if hasattr(os, "copy_file_range"):
+    KERNEL_COPY_FUNCTIONS.append(_copy_file_range)
+if hasattr(os, "sendfile") and os.name == "posix":
+    KERNEL_COPY_FUNCTIONS.append(_sendfile)
@@ -1,22 +1,46 @@
+from array import array
 from struct import Struct
+import os
+import sys
 
 from pyshgck.bin import read_struct
 from sieglib.log import LOG
+from sieglib.metrics import METRICS
 
 
 class Bhd(object):
-    """ Describe a BHD5 file. """
+    """ Describe a BHD5 file.
+
+    By default, one BhdRecord and one BhdDataEntry object are created for each
+    record and data entry. The dvdbnd headers hold hundreds of thousands of
+    entries, so a compact mode is available: the file is read in one call and
+    entries are decoded in a BhdTable, and records are left empty; object-style
+    records can still be obtained with table.get_records(). ExternalArchive
+    works on records, so the compact mode is only used to save a BHD (see
+    generate_data) and by the benchmarks.
+    """
 
     def __init__(self):
         self.header = None
         self.records = []
+        self.table = None
 
-    def load(self, file_path):
-        """ Load the archive at file_path, return True on success. """
+    def load(self, file_path, compact = False):
+        """ Load the archive at file_path, return True on success. If compact
+        is True, data entries are loaded in self.table instead of records.
+        Anything previously loaded is discarded. """
+        self.header = None
+        self.records = []
+        self.table = None
         try:
             with open(file_path, "rb") as header_file:
-                self._load_header(header_file)
-                self._load_records(header_file)
+                file_size = os.fstat(header_file.fileno()).st_size
+                with METRICS.measure(METRICS.BHD_PARSE, file_size):
+                    if compact:
+                        self._load_table(header_file)
+                    else:
+                        self._load_header(header_file)
+                        self._load_records(header_file)
         except OSError as exc:
             LOG.error("Error reading {}: {}".format(file_path, exc))
             return False
@@ -34,31 +58,84 @@ class Bhd(object):
             record.load(header_file)
             self.records[index] = record
 
+    def _load_table(self, header_file):
+        data = header_file.read()
+        self.header = BhdHeader()
+        self.header.load_data(data)
+        self.table = BhdTable()
+        self.table.load_data(
+            data, self.header.num_records, self.header.records_offset
+        )
+
     def save(self, file_path):
-        """ Save the BHD to disk, return True on success. """
+        """ Save the BHD to disk in one write (see generate_data), return True
+        on success. """
         try:
             with open(file_path, "wb") as header_file:
-                self.header.save(header_file)
-                self._save_records(header_file)
-                self._save_data_entries(header_file)
+                with METRICS.measure(METRICS.BHD_WRITE) as timer:
+                    data = self.generate_data()
+                    header_file.write(data)
+                    timer.num_bytes = len(data)
         except OSError as exc:
             LOG.error("Error writing {}: {}".format(file_path, exc))
             return False
         return True
 
-    def _save_records(self, file_object):
-        """ Save each record with an appropriate data offset. """
-        offset = ( self.header.records_offset +
-                   len(self.records) * BhdRecord.RECORD_BIN.size )
-        for record in self.records:
-            record.save(offset, file_object)
-            offset += len(record.entries) * BhdDataEntry.DATA_ENTRY_BIN.size
+    def generate_data(self):
+        """ Return the content of the BHD file: the header, then the records,
+        then the data entries of each record. The layout is computed first and
+        everything is packed in one preallocated buffer. If the BHD has been
+        loaded in compact mode, records and entries are taken from the table.
+        """
+        if not self.records and self.table is not None:
+            entry_counts = [
+                self.table.record_starts[index + 1]
+                - self.table.record_starts[index]
+                for index in range(self.table.num_records)
+            ]
+        else:
+            entry_counts = [len(record.entries) for record in self.records]
+        records_position = BhdHeader.HEADER_BIN.size
+        entries_position = (
+            records_position + len(entry_counts) * BhdRecord.RECORD_BIN.size
+        )
+        data = bytearray(
+            entries_position
+            + sum(entry_counts) * BhdDataEntry.DATA_ENTRY_BIN.size
+        )
 
-    def _save_data_entries(self, file_object):
-        """ Save each data entry of each record. """
+        self.header.save_data(data)
+        self._pack_records(data, records_position, entry_counts)
+        if not self.records and self.table is not None:
+            self.table.save_data(data, entries_position)
+        else:
+            self._pack_data_entries(data, entries_position)
+        return data
+
+    def _pack_records(self, data, position, entry_counts):
+        """ Pack the records in data at position; the data offset of a record
+        is relative to the records offset of the header, like the game does.
+        """
+        pack_into = BhdRecord.RECORD_BIN.pack_into
+        record_size = BhdRecord.RECORD_BIN.size
+        entry_size = BhdDataEntry.DATA_ENTRY_BIN.size
+        offset = self.header.records_offset + len(entry_counts) * record_size
+        for num_entries in entry_counts:
+            pack_into(data, position, num_entries, offset)
+            position += record_size
+            offset += num_entries * entry_size
+
+    def _pack_data_entries(self, data, position):
+        """ Pack the data entries of each record in data at position. """
+        pack_into = BhdDataEntry.DATA_ENTRY_BIN.pack_into
+        entry_size = BhdDataEntry.DATA_ENTRY_BIN.size
         for record in self.records:
             for entry in record.entries:
-                entry.save(file_object)
+                pack_into(
+                    data, position,
+                    entry.hash, entry.size, entry.offset, entry.unk
+                )
+                position += entry_size
 
 
 class BhdHeader(object):
@@ -77,6 +154,14 @@ class BhdHeader(object):
     def load(self, header_file):
         header_file.seek(0)
         unpacked = read_struct(header_file, self.HEADER_BIN)
+        self._set_values(unpacked)
+
+    def load_data(self, data):
+        """ Load the header from the beginning of a bytes-like object. """
+        unpacked = self.HEADER_BIN.unpack_from(data)
+        self._set_values(unpacked)
+
+    def _set_values(self, unpacked):
         self.magic          = unpacked[0]
         self.unk1           = unpacked[1]
         self.unk2           = unpacked[2]
@@ -92,6 +177,13 @@ class BhdHeader(object):
         )
         file_object.write(data)
 
+    def save_data(self, data, position = 0):
+        """ Pack the header in the buffer data at position. """
+        self.HEADER_BIN.pack_into(
+            data, position, self.magic, self.unk1, self.unk2,
+            self.file_size, self.num_records, self.records_offset
+        )
+
 
 class BhdRecord(object):
 
@@ -121,6 +213,95 @@ class BhdRecord(object):
         file_object.write(data)
 
 
+class BhdTable(object):
+    """ Columnar storage of all data entries of a BHD: each column is an array
+    of uint32, and the entry at index i has hashes[i], sizes[i], offsets[i],
+    unks[i] and is part of the record record_indices[i]. Entries of a record
+    are contiguous, from record_starts[r] to record_starts[r + 1]. """
+
+    def __init__(self):
+        self.hashes = array("I")
+        self.sizes = array("I")
+        self.offsets = array("I")
+        self.unks = array("I")
+        self.record_indices = array("I")
+        self.record_starts = array("I", [0])
+
+    def __len__(self):
+        return len(self.hashes)
+
+    @property
+    def num_records(self):
+        return len(self.record_starts) - 1
+
+    def load_data(self, data, num_records, records_offset):
+        """ Decode the records and data entries found in the BHD content. """
+        data = memoryview(data)
+        records_end = records_offset + num_records * BhdRecord.RECORD_BIN.size
+        records = BhdTable._uint32_array(data[records_offset : records_end])
+
+        entry_size = BhdDataEntry.DATA_ENTRY_BIN.size
+        entries = array("I")
+        self.record_indices = array("I")
+        self.record_starts = array("I", [0])
+        for index in range(num_records):
+            num_entries = records[index * 2]
+            offset = records[index * 2 + 1]
+            entries.frombytes(data[offset : offset + num_entries * entry_size])
+            self.record_indices.extend(array("I", [index]) * num_entries)
+            self.record_starts.append(self.record_starts[-1] + num_entries)
+        if sys.byteorder == "big":
+            entries.byteswap()
+
+        self.hashes  = entries[0::4]
+        self.sizes   = entries[1::4]
+        self.offsets = entries[2::4]
+        self.unks    = entries[3::4]
+
+    @staticmethod
+    def _uint32_array(data):
+        """ Return an array of the little-endian uint32 values in data. """
+        values = array("I")
+        values.frombytes(data)
+        if sys.byteorder == "big":
+            values.byteswap()
+        return values
+
+    def save_data(self, data, position):
+        """ Write the data entries, as in a BHD, in the buffer data at
+        position: columns are interleaved in one array and copied at once. """
+        entries = array("I", [0]) * (len(self) * 4)
+        entries[0::4] = self.hashes
+        entries[1::4] = self.sizes
+        entries[2::4] = self.offsets
+        entries[3::4] = self.unks
+        if sys.byteorder == "big":
+            entries.byteswap()
+        entries_data = entries.tobytes()
+        data[position : position + len(entries_data)] = entries_data
+
+    def get_entry(self, index):
+        """ Return a new BhdDataEntry with the values of the entry at index. """
+        entry = BhdDataEntry()
+        entry.hash   = self.hashes[index]
+        entry.size   = self.sizes[index]
+        entry.offset = self.offsets[index]
+        entry.unk    = self.unks[index]
+        return entry
+
+    def get_records(self):
+        """ Return a list of BhdRecord with a BhdDataEntry object for each entry
+        of the table, as Bhd.load does in non-compact mode. """
+        records = [None] * self.num_records
+        for record_index in range(self.num_records):
+            record = BhdRecord()
+            start = self.record_starts[record_index]
+            end = self.record_starts[record_index + 1]
+            record.entries = [self.get_entry(i) for i in range(start, end)]
+            records[record_index] = record
+        return records
+
+
 class BhdDataEntry(object):
 
     DATA_ENTRY_BIN = Struct("<4I")
@@ -5,7 +5,7 @@ import os
 from struct import Struct
 
 from pyshgck.bin import read_cstring, read_struct, pad_file, pad_data
-from sieglib.log import LOG
+from sieglib.log import LOG, PROGRESS
 
 
 class BndFlags(IntEnum):
@@ -78,13 +78,19 @@ class Bnd(object):
         self.reset()
         try:
             with open(file_path, "rb") as bnd_file:
-                self._load_header(bnd_file)
-                self._load_entries(bnd_file)
+                self.load_file(bnd_file)
         except OSError as exc:
             LOG.error("Error reading {}: {}".format(file_path, exc))
             return False
         return True
 
+    def load_file(self, bnd_file):
+        """ Load the whole BND archive from a binary file object, e.g. an entry
+        opened with ExternalArchive.open. """
+        self.reset()
+        self._load_header(bnd_file)
+        self._load_entries(bnd_file)
+
     def _load_header(self, bnd_file):
         unpacked = read_struct(bnd_file, self.HEADER_BIN)
         self.magic         = unpacked[0]
@@ -120,11 +126,15 @@ class Bnd(object):
         allows you to call import_files later and use the same BND and entries
         properties, to try not to break anything when editing a file.
         """
+        PROGRESS.start("BND extraction")
         for entry in self.entries:
             relative_path = entry.get_joinable_path()
-            LOG.info("Extracting {}".format(relative_path))
             entry_path = os.path.join(output_dir, relative_path)
-            entry.extract_file(entry_path, write_infos)
+            if entry.extract_file(entry_path, write_infos):
+                PROGRESS.file("Extracting", relative_path, entry.data_size)
+            else:
+                PROGRESS.fail()
+        PROGRESS.finish()
         self._write_infos(output_dir)
 
     def _write_infos(self, output_dir):
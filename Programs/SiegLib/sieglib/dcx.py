@@ -1,16 +1,18 @@
-import os
-from struct import Struct
+import io
+from struct import Struct, error as struct_error
 import zlib
 
 from pyshgck.bin import read_struct
 from sieglib.log import LOG
+from sieglib.metrics import METRICS
 
 
 class Dcx(object):
     """ DCX parser. """
 
-    MAGIC      = 0x44435800
-    CONST_UNK1 = 0x00010000
+    MAGIC       = 0x44435800
+    MAGIC_BYTES = b"DCX\x00"
+    CONST_UNK1  = 0x00010000
 
     HEADER_BIN = Struct(">6I")
 
@@ -30,6 +32,11 @@ class Dcx(object):
         if file_path:
             self.load(file_path)
 
+    @staticmethod
+    def is_dcx(data):
+        """ Return True if that bytes-like object starts with a DCX magic. """
+        return bytes(data[:4]) == Dcx.MAGIC_BYTES
+
     def load(self, file_path):
         """ Load a DCX file, return True on success. """
         try:
@@ -39,23 +46,60 @@ class Dcx(object):
         except OSError as exc:
             LOG.error("Error reading '{}': {}".format(file_path, exc))
             return False
+        if not self.is_valid():
+            LOG.error("Invalid DCX headers in '{}'.".format(file_path))
+            return False
+        return True
+
+    def load_data(self, data):
+        """ Load a DCX from a bytes-like object (e.g. a BDT entry view), return
+        True on success, False if data is too short or its headers are invalid.
+        The zlib data is kept as a slice of data. """
+        data = memoryview(data)
+        try:
+            self._set_header_values(self.HEADER_BIN.unpack_from(data))
+            self.sizes.load_data(data, self.dcs_offset)
+            self.parameters.load_data(data, self.dcp_offset)
+            dca_offset = self.dcp_offset + self.parameters.dca_offset
+            self.zlib_container.load_data(data, dca_offset)
+        except struct_error as exc:
+            LOG.error("DCX data is too short: {}".format(exc))
+            return False
+        if not self.is_valid():
+            LOG.error("Invalid DCX headers.")
+            return False
+        zlib_offset = dca_offset + self.zlib_container.data_offset
+        zlib_end = zlib_offset + self.sizes.compressed_size
+        self.zlib_data = data[zlib_offset : zlib_end]
         return True
 
     def _load_header(self, dcx_file):
         dcx_file.seek(0)
         unpacked = read_struct(dcx_file, self.HEADER_BIN)
+        self._set_header_values(unpacked)
+
+    def _set_header_values(self, unpacked):
         self.magic        = unpacked[0]
         self.unk1         = unpacked[1]
         self.dcs_offset   = unpacked[2]
         self.dcp_offset   = unpacked[3]
         self.unk2         = unpacked[4]
         self.unk3         = unpacked[5]
-        assert self.magic == self.MAGIC
-        assert self.unk1 == self.CONST_UNK1
-        assert self.dcs_offset == self.HEADER_BIN.size
-        assert self.dcp_offset == self.dcs_offset + DcxSizes.SIZES_BIN.size
-        assert self.unk2 == self.dcp_offset
-        assert self.unk3 == self.dcp_offset + 0x8
+
+    def is_valid(self):
+        """ Return True if the DCX header and the DCS, DCP and DCA chunks have
+        the expected constant values. """
+        return (
+            self.magic == self.MAGIC
+            and self.unk1 == self.CONST_UNK1
+            and self.dcs_offset == self.HEADER_BIN.size
+            and self.dcp_offset == self.dcs_offset + DcxSizes.SIZES_BIN.size
+            and self.unk2 == self.dcp_offset
+            and self.unk3 == self.dcp_offset + 0x8
+            and self.sizes.is_valid()
+            and self.parameters.is_valid()
+            and self.zlib_container.is_valid()
+        )
 
     def _load_content(self, dcx_file):
         self.sizes.load(dcx_file, self.dcs_offset)
@@ -81,6 +125,13 @@ class Dcx(object):
             return False
         return True
 
+    def generate_data(self):
+        """ Return the content of the DCX file as bytes. """
+        data_io = io.BytesIO()
+        self._save_header(data_io)
+        self._save_content(data_io)
+        return data_io.getvalue()
+
     def _save_header(self, file_object):
         data = self.HEADER_BIN.pack(
             self.magic, self.unk1, self.dcs_offset, self.dcp_offset,
@@ -104,25 +155,48 @@ class Dcx(object):
         except OSError as exc:
             LOG.error("Error reading '{}': {}".format(file_path, exc))
             return False
+        return self.load_decompressed_data(data)
 
+    def load_decompressed_data(self, data):
+        """ Compress data, import it and update the different sizes variables.
+        Return True on success and False if an error occured with zlib. """
         try:
-            self.zlib_data = zlib.compress(data, 9)
+            with METRICS.measure(METRICS.DCX_DEFLATE, len(data)):
+                self.zlib_data = zlib.compress(data, 9)
         except zlib.error as exc:
             LOG.error("Zlib error: {}".format(exc))
             return False
 
-        file_size = os.stat(file_path).st_size
-        self.sizes.uncompressed_size = file_size
+        self.sizes.uncompressed_size = len(data)
         self.sizes.compressed_size = len(self.zlib_data)
         return True
 
-    def save_decompressed(self, output_path):
-        """ Save the decompressed content at output_path, return True on
-        success and False if an error occured with zlib or the export. """
+    @staticmethod
+    def compress_data(data):
+        """ Return the content of a DCX file containing data, or None if an
+        error occured with zlib. """
+        dcx = Dcx()
+        if not dcx.load_decompressed_data(data):
+            return None
+        return dcx.generate_data()
+
+    def get_decompressed(self):
+        """ Return the decompressed content, or None if a zlib error occured.
+        """
         try:
-            decompressed = zlib.decompress(self.zlib_data)
+            with METRICS.measure(METRICS.DCX_INFLATE) as timer:
+                decompressed = zlib.decompress(self.zlib_data)
+                timer.num_bytes = len(decompressed)
+            return decompressed
         except zlib.error as exc:
             LOG.error("Zlib error: {}".format(exc))
+            return None
+
+    def save_decompressed(self, output_path):
+        """ Save the decompressed content at output_path, return True on
+        success and False if an error occured with zlib or the export. """
+        decompressed = self.get_decompressed()
+        if decompressed is None:
             return False
 
         try:
@@ -149,11 +223,18 @@ class DcxSizes(object):
 
     def load(self, dcx_file, dcs_offset):
         dcx_file.seek(dcs_offset)
-        unpacked = read_struct(dcx_file, self.SIZES_BIN)
+        self._set_values(read_struct(dcx_file, self.SIZES_BIN))
+
+    def load_data(self, data, dcs_offset):
+        self._set_values(self.SIZES_BIN.unpack_from(data, dcs_offset))
+
+    def _set_values(self, unpacked):
         self.magic             = unpacked[0]
         self.uncompressed_size = unpacked[1]
         self.compressed_size   = unpacked[2]
-        assert self.magic == self.MAGIC
+
+    def is_valid(self):
+        return self.magic == self.MAGIC
 
     def save(self, file_object):
         data = self.SIZES_BIN.pack(
@@ -184,7 +265,12 @@ class DcxParameters(object):
 
     def load(self, dcx_file, dcp_offset):
         dcx_file.seek(dcp_offset)
-        unpacked = read_struct(dcx_file, self.PARAMETERS_BIN)
+        self._set_values(read_struct(dcx_file, self.PARAMETERS_BIN))
+
+    def load_data(self, data, dcp_offset):
+        self._set_values(self.PARAMETERS_BIN.unpack_from(data, dcp_offset))
+
+    def _set_values(self, unpacked):
         self.magic      = unpacked[0]
         self.method     = unpacked[1]
         self.dca_offset = unpacked[2]
@@ -193,14 +279,18 @@ class DcxParameters(object):
         self.unk3       = unpacked[5]
         self.unk4       = unpacked[6]
         self.unk5       = unpacked[7]
-        assert self.magic == self.MAGIC
-        assert self.method == self.METHOD
-        assert self.dca_offset == self.PARAMETERS_BIN.size
-        assert self.unk1 == self.CONST_UNK1
-        assert self.unk2 == 0
-        assert self.unk3 == 0
-        assert self.unk4 == 0
-        assert self.unk5 == self.CONST_UNK5
+
+    def is_valid(self):
+        return (
+            self.magic == self.MAGIC
+            and self.method == self.METHOD
+            and self.dca_offset == self.PARAMETERS_BIN.size
+            and self.unk1 == self.CONST_UNK1
+            and self.unk2 == 0
+            and self.unk3 == 0
+            and self.unk4 == 0
+            and self.unk5 == self.CONST_UNK5
+        )
 
     def save(self, file_object):
         data = self.PARAMETERS_BIN.pack(
@@ -224,11 +314,20 @@ class DcxZlibContainer(object):
 
     def load(self, dcx_file, dca_offset):
         dcx_file.seek(dca_offset)
-        unpacked = read_struct(dcx_file, self.ZLIB_CONTAINER_BIN)
+        self._set_values(read_struct(dcx_file, self.ZLIB_CONTAINER_BIN))
+
+    def load_data(self, data, dca_offset):
+        self._set_values(self.ZLIB_CONTAINER_BIN.unpack_from(data, dca_offset))
+
+    def _set_values(self, unpacked):
         self.magic       = unpacked[0]
         self.data_offset = unpacked[1]
-        assert self.magic == self.MAGIC
-        assert self.data_offset == self.CONST_OFFSET
+
+    def is_valid(self):
+        return (
+            self.magic == self.MAGIC
+            and self.data_offset == self.CONST_OFFSET
+        )
 
     def save(self, file_object):
         data = self.ZLIB_CONTAINER_BIN.pack(self.magic, self.data_offset)
@@ -0,0 +1,61 @@
+import fnmatch
+import re
+
+from sieglib.log import LOG
+
+
+class EntryFilter(object):
+    """ Selection of archive entries by name glob pattern (e.g.
+    "/chr/*.anibnd.dcx"), name extension (e.g. ".tpf.dcx") or hash. An entry
+    is selected if it matches any of them; an empty filter selects everything.
+
+    Names are the archive names of entries: their filelist name (with its .dcx
+    extension, even if the entry is exported decompressed), or their uppercase
+    hex hash if they have none. Matching is case-insensitive like entry
+    hashes, and "*" in patterns also matches "/". Patterns are compiled
+    in one regular expression, so matching an entry costs one search whatever
+    the number of patterns.
+
+    Attributes:
+    - patterns: list of glob patterns
+    - extensions: tuple of lowercase extensions
+    - hashes: set of entry hashes
+    """
+
+    def __init__(self, patterns = None, extensions = None, hashes = None):
+        self.patterns = list(patterns or [])
+        self.extensions = tuple(
+            ext.lower() if ext.startswith(".") else "." + ext.lower()
+            for ext in extensions or []
+        )
+        self.hashes = set(hashes or [])
+        self.pattern_re = None
+        if self.patterns:
+            self.pattern_re = re.compile(
+                "|".join(fnmatch.translate(p) for p in self.patterns),
+                re.IGNORECASE
+            )
+
+    def is_empty(self):
+        return not (self.patterns or self.extensions or self.hashes)
+
+    def matches(self, entry_hash, name):
+        """ Return True if the entry with that hash and name is selected. """
+        if self.is_empty() or entry_hash in self.hashes:
+            return True
+        if self.extensions and name.lower().endswith(self.extensions):
+            return True
+        return self.pattern_re is not None and bool(self.pattern_re.match(name))
+
+    @staticmethod
+    def parse_hashes(hash_args):
+        """ Return the set of hashes in hash_args, a list of hex strings, or
+        None if one of them is not a valid hash. """
+        hashes = set()
+        for hash_arg in hash_args:
+            try:
+                hashes.add(int(hash_arg, 16))
+            except ValueError:
+                LOG.error("Invalid hash: {}".format(hash_arg))
+                return None
+        return hashes
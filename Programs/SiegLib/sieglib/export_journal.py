@@ -0,0 +1,115 @@
+import os
+
+from sieglib.log import LOG
+
+
+class ExportJournal(object):
+    """ Append-only journal of the entries exported in a directory, so an
+    interrupted export can be resumed without exporting finished entries again,
+    and the records map and decompressed list rebuilt from it.
+
+    Each line is "record_index entry_index hash outcome rel_path", the hash in
+    hex and the outcome EXPORTED or DECOMPRESSED (the entry content was then
+    written without its .dcx extension). Failed entries are not journaled.
+    Lines are buffered and flushed every FLUSH_INTERVAL entries: lines lost in
+    a crash only mean these entries are exported again. A truncated or invalid
+    line is ignored.
+
+    Attributes:
+    - results: dict which maps (record_index, entry_index) to a tuple (hash,
+        rel_path, decompressed) for every journaled entry
+    """
+
+    FILE_NAME = "export.journal"
+    FLUSH_INTERVAL = 1024
+
+    EXPORTED = "e"
+    DECOMPRESSED = "d"
+
+    def __init__(self):
+        self.results = {}
+        self.journal_file = None
+        self.num_unflushed = 0
+
+    def load(self, output_dir):
+        """ Load the journal of output_dir, return True on success. A missing
+        journal means there is nothing to resume: results are left empty. """
+        journal_path = os.path.join(output_dir, self.FILE_NAME)
+        self.results = {}
+        if not os.path.isfile(journal_path):
+            LOG.info("No export journal in {}.".format(output_dir))
+            return True
+        try:
+            with open(journal_path, "r", encoding = "utf8") as journal_file:
+                for line in journal_file:
+                    self._load_line(line)
+        except OSError as exc:
+            LOG.error("Error reading {}: {}".format(journal_path, exc))
+            return False
+        return True
+
+    def _load_line(self, line):
+        if not line.endswith("\n"):
+            return
+        parts = line[:-1].split(" ", 4)
+        if len(parts) != 5:
+            return
+        if parts[3] not in (self.EXPORTED, self.DECOMPRESSED):
+            return
+        try:
+            key = (int(parts[0]), int(parts[1]))
+            entry_hash = int(parts[2], 16)
+        except ValueError:
+            return
+        decompressed = parts[3] == self.DECOMPRESSED
+        self.results[key] = (entry_hash, parts[4], decompressed)
+
+    def open(self, output_dir):
+        """ Start the journal of output_dir with the current results, replacing
+        any previous journal. Return True on success. """
+        journal_path = os.path.join(output_dir, self.FILE_NAME)
+        try:
+            os.makedirs(output_dir, exist_ok = True)
+            self.journal_file = open(
+                journal_path, "w", encoding = "utf8", newline = "\n"
+            )
+        except OSError as exc:
+            LOG.error("Error writing {}: {}".format(journal_path, exc))
+            return False
+        for key, result in sorted(self.results.items()):
+            self._write_line(key, *result)
+        self.journal_file.flush()
+        return True
+
+    def add( self, record_index, entry_index, entry_hash, rel_path,
+             decompressed ):
+        """ Journal an exported entry; rel_path is its name in the archive,
+        with the .dcx extension if it has been decompressed. """
+        key = (record_index, entry_index)
+        self.results[key] = (entry_hash, rel_path, decompressed)
+        if self.journal_file is None:
+            return
+        self._write_line(key, entry_hash, rel_path, decompressed)
+        self.num_unflushed += 1
+        if self.num_unflushed >= self.FLUSH_INTERVAL:
+            self.journal_file.flush()
+            self.num_unflushed = 0
+
+    def _write_line(self, key, entry_hash, rel_path, decompressed):
+        outcome = self.DECOMPRESSED if decompressed else self.EXPORTED
+        self.journal_file.write("{} {} {:08X} {} {}\n".format(
+            key[0], key[1], entry_hash, outcome, rel_path
+        ))
+
+    def close(self):
+        if self.journal_file is not None:
+            self.journal_file.close()
+            self.journal_file = None
+            self.num_unflushed = 0
+
+    @staticmethod
+    def remove(output_dir):
+        """ Remove the journal of output_dir, once the export is complete. """
+        journal_path = os.path.join(output_dir, ExportJournal.FILE_NAME)
+        if os.path.isfile(journal_path):
+            os.remove(journal_path)
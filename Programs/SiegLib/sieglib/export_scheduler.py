@@ -0,0 +1,155 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+from sieglib.log import LOG, PROGRESS
+
+
+class ByteBudget(object):
+    """ Limit the number of bytes in flight between threads: acquire blocks
+    while taking the bytes asked would exceed the limit. An entry bigger than
+    the limit can still be taken when nothing else is in flight. """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, num_bytes):
+        with self.condition:
+            while ( self.in_flight > 0
+                    and self.in_flight + num_bytes > self.limit ):
+                self.condition.wait()
+            self.in_flight += num_bytes
+
+    def release(self, num_bytes):
+        with self.condition:
+            self.in_flight -= num_bytes
+            self.condition.notify_all()
+
+
+class ExportScheduler(object):
+    """ Export several loaded ExternalArchives together, with one pool of
+    threads and one budget of bytes in flight for all of them.
+
+    Entries of the archives are interleaved so every BDT is read at the same
+    time; DCX inflation (zlib releases the GIL) then overlaps with the reads
+    and writes of the other threads, and the budget keeps the memory used by
+    entries being read or inflated under a limit. Entry names, records maps
+    and decompressed lists are the same as with ExternalArchive.export_all_files
+    on each archive.
+
+    Attributes:
+    - workers: number of threads
+    - budget: ByteBudget shared by all exports
+    - exports: list of (archive, output_dir, decompress, write_manifest,
+        entry_filter)
+    - num_files: number of files exported by the last run
+    - bytes_read: number of BDT bytes exported by the last run
+    - duration: wall time of the last run, in seconds
+    """
+
+    DEFAULT_MAX_IN_FLIGHT = 64 * 1024 * 1024
+
+    def __init__(self, workers = 4, max_in_flight = DEFAULT_MAX_IN_FLIGHT):
+        self.workers = max(workers, 1)
+        self.budget = ByteBudget(max_in_flight)
+        self.exports = []
+        self.num_files = 0
+        self.bytes_read = 0
+        self.duration = 0.0
+
+    def add_archive( self, archive, output_dir, decompress = True,
+                     write_manifest = False, entry_filter = None ):
+        """ Add a loaded archive to export in output_dir when run is called;
+        if entry_filter is given, only the entries it selects are exported. """
+        self.exports.append(
+            (archive, output_dir, decompress, write_manifest, entry_filter)
+        )
+
+    @property
+    def throughput(self):
+        """ Bytes exported per second by the last run. """
+        if self.duration <= 0.0:
+            return 0.0
+        return self.bytes_read / self.duration
+
+    def run(self):
+        """ Export all added archives, then save their records maps,
+        decompressed lists and (if asked) manifests. """
+        self.num_files = 0
+        self.bytes_read = 0
+        start = time.perf_counter()
+        results = [{} for _ in self.exports]
+        PROGRESS.start("Concurrent export")
+        with ThreadPoolExecutor(self.workers) as executor:
+            for export_index, task in self._interleave_tasks():
+                self.budget.acquire(task[1])
+                future = executor.submit(self._export_task, export_index, task)
+                results[export_index][task] = future
+        self.duration = time.perf_counter() - start
+        PROGRESS.finish()
+
+        for export, export_results in zip(self.exports, results):
+            self._finish_export(export, export_results)
+        LOG.info("Exported {} files, {:.1f} MB in {:.1f}s ({:.1f} MB/s)".format(
+            self.num_files, self.bytes_read / 1000000, self.duration,
+            self.throughput / 1000000
+        ))
+
+    def _interleave_tasks(self):
+        """ Generate (export_index, entry_task) taking one entry of each
+        archive in turn. An entry task is (offset, size, rel_path,
+        base_rel_path, record_index, entry_index). """
+        generators = [
+            self._generate_entry_tasks(export)
+            for export in self.exports
+        ]
+        while generators:
+            for index, generator in list(enumerate(generators)):
+                task = next(generator, None)
+                if task is None:
+                    generators[index] = None
+                    continue
+                yield index, task
+            generators = [g for g in generators if g is not None]
+
+    @staticmethod
+    def _generate_entry_tasks(export):
+        archive, _, decompress, _, entry_filter = export
+        filtered_out = archive.get_filtered_out(entry_filter)
+        return archive._generate_entry_tasks(decompress, filtered_out)
+
+    def _export_task(self, export_index, task):
+        """ Export an entry, return a tuple (exported, decompressed). """
+        archive, output_dir = self.exports[export_index][:2]
+        offset, size, rel_path, base_rel_path = task[:4]
+        try:
+            return archive._export_entry(
+                offset, size, rel_path, base_rel_path, output_dir
+            )
+        finally:
+            self.budget.release(size)
+
+    def _finish_export(self, export, results):
+        """ Fill the records map and decompressed list of an archive from its
+        export results, in record order, and save them. """
+        archive, output_dir, _, write_manifest, _ = export
+        archive.records_map = {}
+        archive.decompressed_list = []
+        for index in range(len(archive.bhd.records)):
+            archive.records_map[index] = []
+        for task in sorted(results, key = lambda task: task[4:]):
+            exported, decompressed = results[task].result()
+            if not exported:
+                continue
+            _, size, rel_path, base_rel_path, record_index, _ = task
+            archive.records_map[record_index].append(rel_path)
+            if decompressed:
+                archive.decompressed_list.append(base_rel_path)
+            self.num_files += 1
+            self.bytes_read += size
+        archive.save_records_map(output_dir)
+        archive.save_decompressed_list(output_dir)
+        if write_manifest:
+            archive.save_manifest(output_dir)
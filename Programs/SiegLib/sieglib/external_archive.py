@@ -1,14 +1,32 @@
+from collections import namedtuple
+import copy
+import io
 import json
+import multiprocessing
 import os
+import queue
 import re
+import threading
 
 from sieglib.bdt import Bdt
 from sieglib.bhd import Bhd, BhdHeader, BhdRecord, BhdDataEntry
 from sieglib.dcx import Dcx
-from sieglib.log import LOG
+from sieglib.export_journal import ExportJournal
+from sieglib.filelist import Filelist
+from sieglib.log import LOG, PROGRESS, init_worker_logging
+from sieglib.manifest import Manifest
+from sieglib.metrics import METRICS
+from sieglib.read_planner import ReadPlanner
 from pyshgck.time import time_it
 
 
+# Entry of an archive as generated by ExternalArchive.iter_entries.
+ArchiveItem = namedtuple("ArchiveItem", [
+    "hash", "name", "record_index", "payload", "entry", "decompressed",
+    "entry_index"
+])
+
+
 class ExternalArchive(object):
     """ Combination of BHD and BDT. Contains methods to export files to the
     filesystem and to generate archives from a directory tree.
@@ -20,15 +38,29 @@ class ExternalArchive(object):
     Attributes:
     - bhd: Bhd object
     - bdt: Bdt object
-    - filelist: dict which maps hashes to the original string
+    - filelist: Filelist which maps hashes to the original string, and the
+        strings back to their hash
     - records_map: dict which maps record indices to the entry relative path
         they contain; the hashes are those found in the BHD file
     - decompressed_list: list of files that have been decompressed during the
         archive export; it's the decompressed name, i.e. w/o the .dcx extension
+    - decompressed_set: set of the paths of the loaded decompressed list, for
+        constant time lookups during an import
+    - compression_results: dict which maps the relative paths of files
+        compressed beforehand by an import compression pool to their success
+    - path_records: dict which maps entry relative paths to the index of the
+        record containing them, built from records_map
+    - unknown_files: list of relative paths found during an import that are
+        not in any record; they are reported once the import is done
+    - entries_by_hash: dict which maps hashes to their BhdDataEntry, built
+        once when the BHD is loaded
+    - entry_records: dict which maps BhdDataEntry identities (id) to the index
+        of the record containing them
+    - journal: ExportJournal of the running export_all_files, or None
     """
 
     # Do not handle these files when crafting an archive.
-    SPECIAL_FILE_TYPES     = (".json",)
+    SPECIAL_FILE_TYPES     = (".json", ".journal")
     RECORDS_MAP_NAME       = "records.json"
     DECOMPRESSED_LIST_NAME = "decompressed.json"
 
@@ -38,33 +70,83 @@ class ExternalArchive(object):
     def __init__(self):
         self.bhd = Bhd()
         self.bdt = Bdt()
-        self.filelist = {}
+        self.filelist = Filelist()
         self.records_map = {}
         self.decompressed_list = []
+        self.decompressed_set = set()
+        self.compression_results = {}
+        self.path_records = {}
+        self.unknown_files = []
+        self.entries_by_hash = {}
+        self.entry_records = {}
+        self.journal = None
 
     def reset(self):
         self.__init__()
 
-    def load(self, bhd_name):
+    def load(self, bhd_name, use_mmap = False):
         """ Load the BHD file and prepare the BDT file for reading, return True
-        on success. """
+        on success. If use_mmap is True, the BDT file is memory-mapped. """
         self.reset()
 
         bhd_load_success = self.bhd.load(bhd_name)
         if not bhd_load_success:
             return False
+        self._index_entries()
 
         bdt_name = os.path.splitext(bhd_name)[0] + ".bdt"
-        self.bdt.open(bdt_name)
+        self.bdt.open(bdt_name, use_mmap = use_mmap)
         if not self.bdt.opened:
             return False
 
         return True
 
+    def _index_entries(self):
+        """ Build the hash and identity indices of the BHD data entries, so
+        that lookups and membership checks do not have to walk the records. """
+        self.entries_by_hash = {}
+        self.entry_records = {}
+        for index, record in enumerate(self.bhd.records):
+            for entry in record.entries:
+                self.entries_by_hash[entry.hash] = entry
+                self.entry_records[id(entry)] = index
+
+    def get_entry(self, hash_or_path):
+        """ Return the BhdDataEntry for that hash or path, or None if this
+        archive has no such entry. Unnamed paths (uppercase hex hashes, as they
+        are exported) are parsed instead of hashed. """
+        return self.entries_by_hash.get(self._get_hash(hash_or_path))
+
+    def _get_hash(self, hash_or_path):
+        """ Return the hash of that path, or hash_or_path if it is a hash. """
+        if isinstance(hash_or_path, str):
+            if self.UNNAMED_FILE_RE.fullmatch(hash_or_path):
+                return int(hash_or_path, 16)
+            return BhdDataEntry.hash_name(hash_or_path)
+        return hash_or_path
+
+    def open(self, hash_or_path, decompress = False):
+        """ Return a seekable read-only file object over the content of the
+        entry with that hash or path (see get_entry), without exporting it, or
+        None if there is no such entry. If decompress is True and the entry is
+        a DCX, the file object contains the decompressed data instead. """
+        entry = self.get_entry(hash_or_path)
+        if entry is None:
+            LOG.error("No entry {} in this archive.".format(hash_or_path))
+            return None
+        entry_file = self.bdt.open_entry(entry.offset, entry.size)
+        if not decompress or not Dcx.is_dcx(entry_file.peek(4)):
+            return entry_file
+
+        decompressed = ExternalArchive._inflate(entry_file.read())
+        if decompressed is None:
+            return None
+        return io.BytesIO(decompressed)
+
     def load_filelist(self, hashmap_path):
-        with open(hashmap_path, "r") as hashmap_file:
-            hashmap = json.load(hashmap_file)
-        self.filelist = { int(k, 16): hashmap[k] for k in hashmap.keys() }
+        """ Load the JSON hashmap at hashmap_path, return True on success. Its
+        binary cache is used (and generated if needed) to avoid parsing it. """
+        return self.filelist.load(hashmap_path, use_cache = True)
 
     def load_records_map(self, input_dir):
         """ Load the archive's records map that will be used to generate an
@@ -74,10 +156,20 @@ class ExternalArchive(object):
             LOG.error("Records map file can't be found.")
             return False
         else:
-            with open(map_path, "r") as records_map_file:
-                self.records_map = json.load(records_map_file)
+            with METRICS.measure(METRICS.JSON):
+                with open(map_path, "r") as records_map_file:
+                    self.records_map = json.load(records_map_file)
+            self._index_records_map()
             return True
 
+    def _index_records_map(self):
+        """ Build the path to record index map from the records map. """
+        self.path_records = {
+            rel_path: int(index)
+            for index, files in self.records_map.items()
+            for rel_path in files
+        }
+
     def load_decompressed_list(self, input_dir):
         """ Load the list of files in that input dir that should be compressed
         before being imported in the archive. """
@@ -86,140 +178,484 @@ class ExternalArchive(object):
             LOG.info("No decompressed file list found in the input dir.")
             return False
         else:
-            with open(list_path, "r") as list_file:
-                self.decompressed_list = json.load(list_file)
+            with METRICS.measure(METRICS.JSON):
+                with open(list_path, "r") as list_file:
+                    self.decompressed_list = json.load(list_file)
+            self.decompressed_set = set(self.decompressed_list)
             LOG.info("Loaded decompressed file list.")
             return True
 
     def save_records_map(self, output_dir):
         """ Write the JSON map of records to their entries. """
         records_map_path = os.path.join(output_dir, self.RECORDS_MAP_NAME)
-        with open(records_map_path, "w") as records_map_file:
-            json.dump(self.records_map, records_map_file)
+        with METRICS.measure(METRICS.JSON):
+            with open(records_map_path, "w") as records_map_file:
+                json.dump(self.records_map, records_map_file)
 
     def save_decompressed_list(self, output_dir):
         """ Write the JSON list of files (relative path) decompressed. """
         list_path = os.path.join(output_dir, self.DECOMPRESSED_LIST_NAME)
-        with open(list_path, "w") as list_file:
-            json.dump(self.decompressed_list, list_file)
+        with METRICS.measure(METRICS.JSON):
+            with open(list_path, "w") as list_file:
+                json.dump(self.decompressed_list, list_file)
 
     #------------------------------
     # Extraction
     #------------------------------
 
+    def iter_entries( self, decompress = False, readahead = 16,
+                      load_payloads = True, skip = None ):
+        """ Generate an ArchiveItem for each entry of the archive, in record
+        order, without writing anything to disk.
+
+        The payload of an item is the entry content, a memoryview of the BDT if
+        it is memory-mapped (see load). If decompress is True, DCX entries that
+        can be decompressed (see export_file) are inflated and their item has
+        the decompressed flag set. If load_payloads is False, payloads are None
+        except for decompressed entries, for consumers that read entries their
+        own way. Items are prepared by a background thread at most readahead
+        items in advance (zlib releases the GIL, so inflation can run while the
+        consumer works); with a readahead of 0 everything is done on demand.
+        Entries whose (record index, entry index) is in skip are left out. """
+        items = self._generate_items(decompress, load_payloads, skip or ())
+        if readahead > 0:
+            items = _prefetch(items, readahead)
+        yield from items
+
+    def _generate_items(self, decompress, load_payloads, skip):
+        for index, record in enumerate(self.bhd.records):
+            for entry_index, entry in enumerate(record.entries):
+                if (index, entry_index) in skip:
+                    continue
+                yield self._get_item(
+                    index, entry_index, entry, decompress, load_payloads
+                )
+
+    def _get_item( self, record_index, entry_index, entry, decompress,
+                   load_payloads ):
+        """ Return the ArchiveItem for that entry, see iter_entries. """
+        name = self._get_entry_rel_path(entry)
+        base_rel_path = None
+        if decompress:
+            base_rel_path = self._get_decompressed_path(name)
+        payload = None
+        decompressed = False
+        if base_rel_path is not None or load_payloads:
+            payload = self.bdt.read_entry(entry.offset, entry.size)
+        if base_rel_path is not None and len(payload) == entry.size:
+            inflated = ExternalArchive._inflate(payload)
+            if inflated is not None:
+                payload = inflated
+                decompressed = True
+        return ArchiveItem(
+            entry.hash, name, record_index, payload, entry, decompressed,
+            entry_index
+        )
+
+    @staticmethod
+    def _inflate(content):
+        """ Return the decompressed content of a DCX, or None if content is not
+        a valid DCX or can't be decompressed. """
+        if not Dcx.is_dcx(content):
+            return None
+        dcx = Dcx()
+        if not dcx.load_data(content):
+            return None
+        return dcx.get_decompressed()
+
     @time_it(LOG)
-    def export_all_files(self, output_dir, decompress = True):
+    def export_all_files( self, output_dir, decompress = True, workers = 1,
+                          write_manifest = False, offset_order = False,
+                          resume = False, entry_filter = None ):
         """ Export all files from the archive to a directory tree in output_dir
-        and decompress (if decompress is True, which is default) DCX files. """
-        self.records_map = {}
-        self.decompressed_list = []
-        for index_and_record in enumerate(self.bhd.records):
-            self._export_record(index_and_record, output_dir, decompress)
+        and decompress (if decompress is True, which is default) DCX files.
+
+        If workers is greater than 1, entries are exported by a pool of that
+        many processes, each with its own BDT handle; the records map and the
+        decompressed list are the same as the ones of a serial export.
+
+        If offset_order is True (and workers is 1), entries are read in BDT
+        order with a ReadPlanner instead of record order, which follows hashes
+        and makes reads jump around the BDT; the output is the same.
+
+        If write_manifest is True, a manifest of the exported tree is written
+        so the archive can later be updated with update_files.
+
+        Exported entries are written to an ExportJournal in output_dir, removed
+        once the export is complete. If resume is True, the entries journaled
+        by an interrupted export of this archive are not exported again, and
+        the records map and decompressed list include them.
+
+        If entry_filter (an EntryFilter) is given, only the entries it selects
+        are exported and listed in the records map; others are filtered out
+        with the BHD index and the filelist, before anything is read. """
+        self.journal = ExportJournal()
+        if resume and self.journal.load(output_dir):
+            self._check_journal(output_dir)
+            LOG.info("Resuming export, {} entries already exported.".format(
+                len(self.journal.results)
+            ))
+        # Entries exported by a previous run with another filter are forgotten.
+        filtered_out = self.get_filtered_out(entry_filter)
+        for key in filtered_out & set(self.journal.results):
+            del self.journal.results[key]
+        self.journal.open(output_dir)
+        done = set(self.journal.results) | filtered_out
+        PROGRESS.start("Export")
+        try:
+            if workers > 1:
+                self._export_records_in_pool(
+                    output_dir, decompress, workers, done
+                )
+            elif offset_order:
+                self._export_in_offset_order(output_dir, decompress, done)
+            else:
+                self._export_items(output_dir, decompress, done)
+        finally:
+            self.journal.close()
+        PROGRESS.finish()
+        self._load_export_results(self.journal.results)
+        self.journal = None
         self.save_records_map(output_dir)
         self.save_decompressed_list(output_dir)
+        if write_manifest:
+            self.save_manifest(output_dir)
+        ExportJournal.remove(output_dir)
 
-    def _export_record(self, index_and_record, output_dir, decompress):
-        """ Export data entries of that record. """
-        record_files = []
+    def get_filtered_out(self, entry_filter):
+        """ Return the set of (record index, entry index) of the entries not
+        selected by entry_filter (empty if it is None). """
+        filtered_out = set()
+        if entry_filter is None or entry_filter.is_empty():
+            return filtered_out
+        for index, record in enumerate(self.bhd.records):
+            for entry_index, entry in enumerate(record.entries):
+                name = self._get_entry_rel_path(entry)
+                if not entry_filter.matches(entry.hash, name):
+                    filtered_out.add((index, entry_index))
+        return filtered_out
 
-        index, record = index_and_record
-        for entry in record.entries:
-            rel_path = self.export_file(entry, output_dir)
-            if not rel_path:
-                continue
-            record_files.append(rel_path)
+    def _check_journal(self, output_dir):
+        """ Forget the journaled entries that do not match an entry of this
+        archive or whose exported file is missing, so they are exported again.
+        """
+        for key, result in list(self.journal.results.items()):
+            record_index, entry_index = key
+            entry_hash, rel_path, decompressed = result
+            entry = None
+            if record_index < len(self.bhd.records):
+                entries = self.bhd.records[record_index].entries
+                if entry_index < len(entries):
+                    entry = entries[entry_index]
+            if decompressed:
+                rel_path = os.path.splitext(rel_path)[0]
+            output_path = ExternalArchive._get_output_path(output_dir, rel_path)
+            if ( entry is None or entry.hash != entry_hash
+                 or not os.path.isfile(output_path) ):
+                del self.journal.results[key]
 
-            if decompress:
-                base_rel_path, extension = os.path.splitext(rel_path)
-                if extension == ".dcx":
-                    self._try_decompress(rel_path, base_rel_path, output_dir)
+    def _journal_entry(self, record_index, entry_index, rel_path, decompressed):
+        """ Journal an exported entry, see ExportJournal. """
+        entry = self.bhd.records[record_index].entries[entry_index]
+        self.journal.add(
+            record_index, entry_index, entry.hash, rel_path, decompressed
+        )
 
-        self.records_map[index] = record_files
+    def _load_export_results(self, results):
+        """ Fill the records map and decompressed list, in record order, from
+        export results as stored by ExportJournal. """
+        self.records_map = {}
+        self.decompressed_list = []
+        for index in range(len(self.bhd.records)):
+            self.records_map[index] = []
+        for key in sorted(results):
+            _, rel_path, decompressed = results[key]
+            self.records_map[key[0]].append(rel_path)
+            if decompressed:
+                self.decompressed_list.append(os.path.splitext(rel_path)[0])
+
+    def _export_items(self, output_dir, decompress, done):
+        """ Export the entries not in done as a consumer of iter_entries;
+        entries that are not decompressed are streamed to disk (see
+        _export_content). """
+        items = self.iter_entries(
+            decompress, load_payloads = False, skip = done
+        )
+        for item in items:
+            if self._export_item(item, output_dir):
+                self._journal_entry(
+                    item.record_index, item.entry_index, item.name,
+                    item.decompressed
+                )
+
+    def _export_item(self, item, output_dir):
+        """ Write that ArchiveItem in output_dir, return True on success. """
+        entry = item.entry
+        if item.payload is None:
+            return self._export_content(
+                entry.offset, entry.size, item.name, output_dir
+            )
+
+        if item.decompressed:
+            base_rel_path = os.path.splitext(item.name)[0]
+            ExternalArchive._write_file(output_dir, base_rel_path, item.payload)
+            PROGRESS.file("Extracting", item.name, entry.size)
+            return True
+        if not ExternalArchive._check_size(item.name, entry.size, item.payload):
+            PROGRESS.fail()
+            return False
+        ExternalArchive._write_file(output_dir, item.name, item.payload)
+        PROGRESS.file("Extracting", item.name, entry.size)
+        return True
+
+    def _export_in_offset_order(self, output_dir, decompress, done):
+        """ Export the entries not in done in BDT order, see ReadPlanner. """
+        tasks = list(self._generate_entry_tasks(decompress, done))
+        planned_entries = ((task[0], task[1], task) for task in tasks)
+        for task, payload in ReadPlanner().read(self.bdt, planned_entries):
+            offset, size, rel_path, base_rel_path = task[:4]
+            if payload is None:
+                exported, decompressed = self._export_entry(
+                    offset, size, rel_path, base_rel_path, output_dir
+                )
+            else:
+                exported, decompressed = ExternalArchive._write_content(
+                    payload, size, rel_path, base_rel_path, output_dir
+                )
+            if exported:
+                self._journal_entry(task[4], task[5], rel_path, decompressed)
+
+    def _export_records_in_pool(self, output_dir, decompress, workers, done):
+        """ Export records with a process pool. Entry names and decompression
+        conflicts are resolved here; workers only read, write and decompress,
+        and results are journaled by this process. Entries in done are not
+        given to workers. """
+        tasks = ( self._get_record_task( index, record, output_dir, decompress,
+                                         done )
+                  for index, record in enumerate(self.bhd.records) )
+        init_args = (self.bdt.file_path, PROGRESS.verbose)
+        with multiprocessing.Pool( workers, _init_export_worker,
+                                   init_args ) as pool:
+            for index, results in pool.imap(_export_record_task, tasks):
+                entries = self.bhd.records[index].entries
+                entry_indices = [ entry_index
+                                  for entry_index in range(len(entries))
+                                  if (index, entry_index) not in done ]
+                exported = [
+                    (entry_index, rel_path, base_rel_path)
+                    for entry_index, (rel_path, base_rel_path)
+                    in zip(entry_indices, results) if rel_path
+                ]
+                PROGRESS.count(len(exported), sum(
+                    entries[entry_index].size for entry_index, _, _ in exported
+                ))
+                PROGRESS.fail(len(results) - len(exported))
+                for entry_index, rel_path, base_rel_path in exported:
+                    self._journal_entry(
+                        index, entry_index, rel_path, bool(base_rel_path)
+                    )
+
+    def _generate_entry_tasks(self, decompress, skip = ()):
+        """ Generate a task (offset, size, rel_path, base_rel_path,
+        record_index, entry_index) for each entry not in skip, in record order;
+        base_rel_path is the path to decompress the entry to, or None. """
+        for index, record in enumerate(self.bhd.records):
+            for entry_index, entry in enumerate(record.entries):
+                if (index, entry_index) in skip:
+                    continue
+                rel_path = self._get_entry_rel_path(entry)
+                base_rel_path = None
+                if decompress:
+                    base_rel_path = self._get_decompressed_path(rel_path)
+                yield ( entry.offset, entry.size, rel_path, base_rel_path,
+                        index, entry_index )
 
-    def export_file(self, entry, output_dir):
+    def _get_record_task( self, index, record, output_dir, decompress,
+                          done = () ):
+        """ Return the export task of a record for _export_record_task, without
+        the entries whose (record index, entry index) is in done. """
+        entries = []
+        for entry_index, entry in enumerate(record.entries):
+            if (index, entry_index) in done:
+                continue
+            rel_path = self._get_entry_rel_path(entry)
+            base_rel_path = None
+            if decompress:
+                base_rel_path = self._get_decompressed_path(rel_path)
+            entries.append((entry.offset, entry.size, rel_path, base_rel_path))
+        return index, output_dir, entries
+
+    def export_file(self, entry, output_dir, decompress = False):
         """ Export the file corresponding to that BHD data entry, return the
-        relative file path on success, None on failure """
+        relative file path on success, None on failure. If decompress is True
+        and the entry is a DCX, it is written decompressed (if there is no
+        conflict) and its decompressed name is added to the decompressed list.
+        """
         if not self.is_entry_valid(entry):
             LOG.error("Tried to extract a file not from this archive.")
             return None
 
-        rel_path = self.filelist.get(entry.hash) or "{:08X}".format(entry.hash)
-        LOG.info("Extracting {}".format(rel_path))
+        rel_path = self._get_entry_rel_path(entry)
+        base_rel_path = None
+        if decompress:
+            base_rel_path = self._get_decompressed_path(rel_path)
+        success, decompressed = self._export_entry(
+            entry.offset, entry.size, rel_path, base_rel_path, output_dir
+        )
+        if decompressed:
+            self.decompressed_list.append(base_rel_path)
+        return rel_path if success else None
 
-        file_content = self.bdt.read_entry(entry.offset, entry.size)
-        content_len = len(file_content)
-        if content_len != entry.size:
-            LOG.error( "Tried to read {} bytes but only {} were available "
-                       "(file '{}').".format(
-                entry.size, content_len, rel_path
-            ))
-            return None
+    def _get_entry_rel_path(self, entry):
+        """ Return the entry name, or its hex hash if it has no known name. """
+        return self.filelist.get(entry.hash) or "{:08X}".format(entry.hash)
+
+    def _export_entry(self, offset, size, rel_path, base_rel_path, output_dir):
+        """ Export the BDT content at offset to rel_path in output_dir, or to
+        base_rel_path if it is not None and the content is a valid DCX, that is
+        then decompressed in memory. Return a tuple (exported, decompressed).
+        """
+        if base_rel_path is None:
+            exported = self._export_content(offset, size, rel_path, output_dir)
+            return exported, False
+        return self._export_dcx_content(
+            offset, size, rel_path, base_rel_path, output_dir
+        )
 
-        output_path = os.path.join(output_dir, rel_path.lstrip("/"))
-        if not os.path.isdir(os.path.dirname(output_path)):
-            os.makedirs(os.path.dirname(output_path))
+    def _export_content(self, offset, size, rel_path, output_dir):
+        """ Copy the BDT content at offset to rel_path in output_dir, return
+        True on success. The content is streamed, never fully loaded. """
+        output_path = ExternalArchive._get_output_path(output_dir, rel_path)
+        ExternalArchive._make_parent_dir(output_path)
         with open(output_path, "wb") as output_file:
-            output_file.write(file_content)
-        return rel_path
+            content_len = self.bdt.copy_entry(offset, size, output_file)
+        if content_len != size:
+            ExternalArchive._log_short_read(rel_path, size, content_len)
+            os.remove(output_path)
+            PROGRESS.fail()
+            return False
+        PROGRESS.file("Extracting", rel_path, size)
+        return True
+
+    @staticmethod
+    def _check_size(rel_path, size, content):
+        """ Return True if content has the expected size, else log an error. """
+        if len(content) != size:
+            ExternalArchive._log_short_read(rel_path, size, len(content))
+            return False
+        return True
+
+    @staticmethod
+    def _log_short_read(rel_path, size, content_len):
+        LOG.error( "Tried to read {} bytes but only {} were available "
+                   "(file '{}').".format(
+            size, content_len, rel_path
+        ))
+
+    @staticmethod
+    def _get_output_path(output_dir, rel_path):
+        """ Return the path where the file rel_path is exported. """
+        joinable_rel_path = os.path.normpath(rel_path.lstrip("/"))
+        return os.path.join(output_dir, joinable_rel_path)
 
     def is_entry_valid(self, entry):
         """ Return True if that BhdDataEntry is part of this archive. """
-        for record in self.bhd.records:
-            if entry in record.entries:
-                return True
-        return False
-
-    def _try_decompress(self, rel_path, base_rel_path, output_dir):
-        """ Try to decompress the DCX at rel_path to base_rel_path, in the
-        output_dir; fails if a file is already expected at base_rel_path. """
-        if base_rel_path in self.filelist.values():
+        return id(entry) in self.entry_records
+
+    def _get_decompressed_path(self, rel_path):
+        """ Return the path rel_path should be decompressed to, or None if it is
+        not a DCX or if a file is already expected at that path. """
+        base_rel_path, extension = os.path.splitext(rel_path)
+        if extension != ".dcx":
+            return None
+        if self.filelist.has_name(base_rel_path):
             LOG.info("Won't decompress {} because it conflicts with {}".format(
                 rel_path, base_rel_path
             ))
-            return
-        joinable_rel_path = os.path.normpath(rel_path.lstrip("/"))
-        file_path = os.path.join(output_dir, joinable_rel_path)
-        success = ExternalArchive._decompress(file_path)
-        if success:
-            self.decompressed_list.append(base_rel_path)
+            return None
+        return base_rel_path
+
+    def _export_dcx_content(self, offset, size, rel_path, base_rel_path,
+                            output_dir):
+        """ Read the DCX at offset and write its decompressed content to
+        base_rel_path; the DCX itself is never written to disk unless it can't
+        be decompressed, in which case it is exported as is at rel_path. Return
+        a tuple (exported, decompressed). """
+        content = self.bdt.read_entry(offset, size)
+        return ExternalArchive._write_content(
+            content, size, rel_path, base_rel_path, output_dir
+        )
 
     @staticmethod
-    def _decompress(file_path, remove_dcx = True):
-        """ Decompress that file and remove the compressed original (DCX) if
-        remove_dcx is True. Return True on success. """
-        dcx = Dcx()
-        import_success = dcx.load(file_path)
-        if not import_success:
-            return False
+    def _write_content(content, size, rel_path, base_rel_path, output_dir):
+        """ Write the content read for an entry: decompressed to base_rel_path
+        if it is not None and content is a valid DCX, else as is to rel_path.
+        Return a tuple (exported, decompressed). """
+        if not ExternalArchive._check_size(rel_path, size, content):
+            PROGRESS.fail()
+            return False, False
+        decompressed = None
+        if base_rel_path is not None:
+            decompressed = ExternalArchive._inflate(content)
+        if decompressed is not None:
+            ExternalArchive._write_file(output_dir, base_rel_path, decompressed)
+        else:
+            ExternalArchive._write_file(output_dir, rel_path, content)
+        PROGRESS.file("Extracting", rel_path, size)
+        return True, decompressed is not None
 
-        decompressed_path = os.path.splitext(file_path)[0]  # remove the .dcx
-        export_success = dcx.save_decompressed(decompressed_path)
-        if not export_success:
-            return False
+    @staticmethod
+    def _write_file(output_dir, rel_path, data):
+        """ Write data to the file rel_path in output_dir. """
+        output_path = ExternalArchive._get_output_path(output_dir, rel_path)
+        with METRICS.measure(METRICS.FS_WRITE, len(data)):
+            ExternalArchive._make_parent_dir(output_path)
+            with open(output_path, "wb") as output_file:
+                output_file.write(data)
 
-        if remove_dcx:
-            os.remove(file_path)
-        return True
+    @staticmethod
+    def _make_parent_dir(file_path):
+        """ Create the directories containing file_path if necessary. """
+        parent_dir = os.path.dirname(file_path)
+        if not os.path.isdir(parent_dir):
+            os.makedirs(parent_dir, exist_ok = True)
 
     #------------------------------
     # Import
     #------------------------------
 
     @time_it(LOG)
-    def import_files(self, data_dir, bhd_path):
+    def import_files(self, data_dir, bhd_path, workers = 1, dedup = False):
         """ Create an external archive from the data in data_dir, return True on
-        success. """
+        success.
+
+        If workers is greater than 1, the files of the decompressed list are
+        first compressed by a pool of that many processes, then all files are
+        appended to the BDT in the same order as a serial import, so the
+        resulting BHD and BDT are identical.
+
+        If dedup is True, files with the same content as a file already
+        imported are not written again in the BDT: their data entry points to
+        the data of the first one. """
         self.reset()
         self._prepare_import(data_dir, bhd_path)
+        self.bdt.dedup = dedup
 
-        for root, _, files in os.walk(data_dir):
-            for file_name in files:
-                ext = os.path.splitext(file_name)[1]
-                if ext in self.SPECIAL_FILE_TYPES:
-                    continue
-                self.import_file(data_dir, root, file_name)
+        files_to_import = ExternalArchive._get_files_to_import(data_dir)
+        if workers > 1:
+            self._compress_files_in_pool(data_dir, files_to_import, workers)
+        PROGRESS.start("Import")
+        for file_dir, file_name in files_to_import:
+            self.import_file(data_dir, file_dir, file_name)
+        PROGRESS.finish()
+        self._report_unknown_files()
+        if dedup:
+            LOG.info("Deduplication saved {} bytes.".format(
+                self.bdt.bytes_saved
+            ))
 
         self._update_header()
+        self._index_entries()
         self._save_files(bhd_path)
         return True
 
@@ -241,30 +677,56 @@ class ExternalArchive(object):
         # Load the list of files to compress
         self.load_decompressed_list(data_dir)
 
+    @staticmethod
+    def _get_files_to_import(data_dir):
+        """ Return the list of (directory, file name) to import from data_dir,
+        in the order they are imported. """
+        files_to_import = []
+        for root, _, files in os.walk(data_dir):
+            for file_name in files:
+                ext = os.path.splitext(file_name)[1]
+                if ext in ExternalArchive.SPECIAL_FILE_TYPES:
+                    continue
+                files_to_import.append((root, file_name))
+        return files_to_import
+
+    def _compress_files_in_pool(self, data_dir, files_to_import, workers):
+        """ Compress the files of the decompressed list with a process pool and
+        store the results in compression_results. """
+        rel_paths = []
+        for file_dir, file_name in files_to_import:
+            file_path = os.path.join(file_dir, file_name)
+            rel_path = self._get_import_rel_path(data_dir, file_path)[0]
+            if rel_path in self.decompressed_set:
+                rel_paths.append(rel_path)
+        file_paths = [ ExternalArchive._get_output_path(data_dir, rel_path)
+                       for rel_path in rel_paths ]
+
+        LOG.info("Compressing {} files...".format(len(file_paths)))
+        with multiprocessing.Pool(workers, init_worker_logging) as pool:
+            results = pool.map(ExternalArchive._compress, file_paths)
+        self.compression_results = dict(zip(rel_paths, results))
+
     def import_file(self, data_dir, file_dir, file_name):
         """ Try to import the file file_name in file_dir, with data_dir as the
         archive root; create a data entry in the appropriate record, and write
         the file data in the BDT file. Return True on success. """
         file_path = os.path.join(file_dir, file_name)
-
-        # Find rel_path: either a hashable name like "/chr/c5352.anibnd.dcx"
-        # or directly a hash name like "192E66A4".
-        is_unnamed = self.UNNAMED_FILE_RE.match(file_name) is not None
-        if is_unnamed:
-            rel_path = file_name
-        else:
-            rel_path = ExternalArchive._get_rel_path(data_dir, file_path)
-            rel_path = "/" + rel_path
-        LOG.info("Importing {}".format(rel_path))
+        rel_path, is_unnamed = self._get_import_rel_path(data_dir, file_path)
 
         # If the file is in the decompressed list, it has to be compressed first
-        # and that means we have to create its DCX file, then we update the
-        # paths we use afterwards.
-        if rel_path in self.decompressed_list:
-            joinable_rel_path = os.path.normpath(rel_path.lstrip("/"))
-            decompressed_path = os.path.join(data_dir, joinable_rel_path)
-            success = ExternalArchive._compress(decompressed_path)
+        # (unless it has already been by a compression pool) and that means we
+        # have to create its DCX file, then we update the paths we use
+        # afterwards.
+        if rel_path in self.decompressed_set:
+            success = self.compression_results.get(rel_path)
+            if success is None:
+                decompressed_path = ExternalArchive._get_output_path(
+                    data_dir, rel_path
+                )
+                success = ExternalArchive._compress(decompressed_path)
             if not success:
+                PROGRESS.fail()
                 return False
             rel_path = rel_path + ".dcx"
             file_path = file_path + ".dcx"
@@ -272,7 +734,9 @@ class ExternalArchive(object):
         # Import the file
         import_results = self.bdt.import_file(file_path)
         if import_results[1] == -1:  # written bytes
+            PROGRESS.fail()
             return False
+        PROGRESS.file("Importing", rel_path, import_results[1])
 
         # Unnamed files aren't decompressed, so their hash is already available.
         # Named files can be decompressed, therefore we don't know their
@@ -289,6 +753,19 @@ class ExternalArchive(object):
         record_is_updated = self._update_record(rel_path, data_entry)
         return record_is_updated
 
+    def _get_import_rel_path(self, data_dir, file_path):
+        """ Return the relative path used in the archive for that file, either
+        a hashable name like "/chr/c5352.anibnd.dcx" or directly a hash name
+        like "192E66A4", and a boolean telling if the file is unnamed. """
+        file_name = os.path.basename(file_path)
+        is_unnamed = self.UNNAMED_FILE_RE.match(file_name) is not None
+        if is_unnamed:
+            rel_path = file_name
+        else:
+            rel_path = ExternalArchive._get_rel_path(data_dir, file_path)
+            rel_path = "/" + rel_path
+        return rel_path, is_unnamed
+
     @staticmethod
     def _get_rel_path(data_dir, file_path):
         """ Return the sanitized relative path of file_path. """
@@ -315,36 +792,319 @@ class ExternalArchive(object):
     def _update_record(self, rel_path, data_entry):
         """ Add the data entry to the record associated with that relative path,
         return True on success. """
-        try:
-            index = next(( int(index)
-                           for index, files in self.records_map.items()
-                           if rel_path in files ))
-        except StopIteration:
-            LOG.error("File {} not in any record.".format(rel_path))
+        index = self.path_records.get(rel_path)
+        if index is None:
+            self.unknown_files.append(rel_path)
             return False
         record = self.bhd.records[index]
         record.entries.append(data_entry)
         return True
 
+    def _report_unknown_files(self):
+        """ Log all the files that were not imported because they are not in
+        any record, if any. """
+        if not self.unknown_files:
+            return
+        LOG.error("{} files not in any record: {}".format(
+            len(self.unknown_files), ", ".join(self.unknown_files)
+        ))
+
     def _update_header(self):
         """ Update the BHD header with values corresponding to the amount of
         records and entries stored; the header is then ready to write. """
-        self.bhd.header = BhdHeader()
+        ExternalArchive._update_bhd_header(self.bhd)
+
+    @staticmethod
+    def _update_bhd_header(bhd):
+        """ Update the header of that Bhd, created if needed, as described in
+        _update_header. """
+        if bhd.header is None:
+            bhd.header = BhdHeader()
 
-        num_records = len(self.bhd.records)
+        num_records = len(bhd.records)
         num_data_entries = sum( ( len(record.entries)
-                                  for record in self.bhd.records ) )
+                                  for record in bhd.records ) )
         file_size = (
             BhdHeader.HEADER_BIN.size +
             BhdRecord.RECORD_BIN.size * num_records +
             BhdDataEntry.DATA_ENTRY_BIN.size * num_data_entries
         )
 
-        self.bhd.header.file_size = file_size
-        self.bhd.header.num_records = num_records
+        bhd.header.file_size = file_size
+        bhd.header.num_records = num_records
 
     def _save_files(self, bhd_path):
         """ Write both BHD and BDT files to disk. """
         LOG.info("Saving files to disk...")
         self.bhd.save(bhd_path)
         self.bdt.close()
+
+    #------------------------------
+    # Incremental update
+    #------------------------------
+
+    def save_manifest(self, data_dir):
+        """ Write the manifest of the files in data_dir, used by update_files
+        to find changed files. Return True on success. """
+        manifest = Manifest()
+        for rel_path, file_path in self._get_tree_files(data_dir):
+            manifest.update_file(rel_path, file_path)
+        return manifest.save(data_dir)
+
+    def _get_tree_files(self, data_dir):
+        """ Return a list of (relative path, path) of the files in data_dir. """
+        tree_files = []
+        for file_dir, file_name in self._get_files_to_import(data_dir):
+            file_path = os.path.join(file_dir, file_name)
+            rel_path = self._get_import_rel_path(data_dir, file_path)[0]
+            tree_files.append((rel_path, file_path))
+        return tree_files
+
+    @time_it(LOG)
+    def update_files(self, data_dir, bhd_path):
+        """ Update the archive at bhd_path with the files of data_dir that
+        changed since its manifest was written (see save_manifest). Changed
+        files are appended to the BDT, compressed if they are in the
+        decompressed list, and the BHD is rewritten with their new offsets and
+        sizes; the data of unchanged files is not read nor rewritten. The tree
+        itself is not modified, except its manifest. Return True on success. """
+        if not self.load(bhd_path):
+            return False
+        bdt_path = self.bdt.file_path
+        self.bdt.close()
+        self.bdt.open(bdt_path, "r+b")
+        if not self.bdt.opened:
+            return False
+
+        manifest = Manifest()
+        if not manifest.load(data_dir) or not self.load_records_map(data_dir):
+            self.bdt.close()
+            return False
+        self.load_decompressed_list(data_dir)
+
+        changed_files = [
+            (rel_path, file_path)
+            for rel_path, file_path in self._get_tree_files(data_dir)
+            if manifest.is_changed(rel_path, file_path)
+        ]
+
+        self.bdt.seek_end()
+        num_updated = 0
+        for rel_path, file_path in changed_files:
+            if self._update_file(rel_path, file_path):
+                manifest.update_file(rel_path, file_path)
+                num_updated += 1
+        self._report_unknown_files()
+
+        self._update_header()
+        self._save_files(bhd_path)
+        manifest.save(data_dir)
+        LOG.info("Updated {} of {} changed files.".format(
+            num_updated, len(changed_files)
+        ))
+        return True
+
+    def _update_file(self, rel_path, file_path):
+        """ Append the file to the BDT and point its entry to the new data; the
+        entry is created if the file is new in a known record. Return True on
+        success. """
+        LOG.info("Updating {}".format(rel_path))
+        if rel_path in self.decompressed_set:
+            dcx = Dcx()
+            if not dcx.load_decompressed(file_path):
+                return False
+            data = dcx.generate_data()
+            rel_path = rel_path + ".dcx"
+        else:
+            try:
+                with open(file_path, "rb") as input_file:
+                    data = input_file.read()
+            except OSError as exc:
+                LOG.error("Error reading {}: {}".format(file_path, exc))
+                return False
+
+        entry = self.get_entry(rel_path)
+        if entry is None and rel_path not in self.path_records:
+            self.unknown_files.append(rel_path)
+            return False
+
+        offset, size = self.bdt.import_data(data)
+        if size == -1:
+            return False
+
+        if entry is None:
+            entry = BhdDataEntry()
+            entry.hash = self._get_hash(rel_path)
+            self._update_record(rel_path, entry)
+            self.entries_by_hash[entry.hash] = entry
+            self.entry_records[id(entry)] = self.path_records[rel_path]
+        entry.offset, entry.size = offset, size
+        return True
+
+    #------------------------------
+    # Overlay build
+    #------------------------------
+
+    @time_it(LOG)
+    def build_overlay(self, override_dir, bhd_path):
+        """ Write at bhd_path a copy of this (loaded) archive where the files
+        found in override_dir replace the original entries. Unchanged entries
+        are copied directly from the original BDT, kernel-side when possible;
+        only overrides are read from disk and compressed if the original entry
+        is a DCX and the override is not. Return True on success. """
+        overrides = self._get_overrides(override_dir)
+        if overrides is None:
+            return False
+
+        output_bdt_path = os.path.splitext(bhd_path)[0] + ".bdt"
+        original_bdt_path = os.path.abspath(self.bdt.file_path)
+        if os.path.abspath(output_bdt_path) == original_bdt_path:
+            LOG.error("Can't build an overlay over its original archive.")
+            return False
+        output_bdt = Bdt()
+        output_bdt.open(output_bdt_path, "wb")
+        if not output_bdt.opened:
+            return False
+        output_bdt.make_header()
+
+        # Copy entries in BDT order to keep reads of the original sequential.
+        new_entries = {}
+        all_entries = ( entry for record in self.bhd.records
+                        for entry in record.entries )
+        for entry in sorted(all_entries, key = lambda e: e.offset):
+            override = overrides.get(entry.hash)
+            if override is None:
+                results = output_bdt.import_range(
+                    self.bdt, entry.offset, entry.size
+                )
+            else:
+                results = ExternalArchive._import_override(output_bdt, override)
+            if results[1] == -1:
+                output_bdt.close()
+                return False
+            new_entries[id(entry)] = results
+        output_bdt.close()
+
+        output_bhd = self._get_overlay_bhd(new_entries)
+        LOG.info("Built overlay with {} overrides.".format(len(overrides)))
+        return output_bhd.save(bhd_path)
+
+    def _get_overrides(self, override_dir):
+        """ Return a dict which maps entry hashes to a tuple (file path, needs
+        compression) for each file of override_dir, or None if a file does not
+        match any entry. A file matches an entry with the same relative path,
+        or with the same relative path plus ".dcx" (it is then compressed). """
+        overrides = {}
+        unknown_files = []
+        for rel_path, file_path in self._get_tree_files(override_dir):
+            if self.get_entry(rel_path) is not None:
+                overrides[self._get_hash(rel_path)] = (file_path, False)
+            elif self.get_entry(rel_path + ".dcx") is not None:
+                overrides[self._get_hash(rel_path + ".dcx")] = (file_path, True)
+            else:
+                unknown_files.append(rel_path)
+        if unknown_files:
+            LOG.error("{} overrides not in the archive: {}".format(
+                len(unknown_files), ", ".join(unknown_files)
+            ))
+            return None
+        return overrides
+
+    @staticmethod
+    def _import_override(output_bdt, override):
+        """ Append the override file to output_bdt, return the BDT import
+        results (position, size or -1). """
+        file_path, compress = override
+        LOG.info("Importing override {}".format(file_path))
+        if not compress:
+            return output_bdt.import_file(file_path)
+        dcx = Dcx()
+        if not dcx.load_decompressed(file_path):
+            return output_bdt.bdt_file.tell(), -1
+        return output_bdt.import_data(dcx.generate_data())
+
+    def _get_overlay_bhd(self, new_entries):
+        """ Return a Bhd with the same records and entries as this archive,
+        with entries positions in new_entries (see build_overlay). """
+        output_bhd = Bhd()
+        output_bhd.header = copy.copy(self.bhd.header)
+        output_bhd.records = [BhdRecord() for _ in self.bhd.records]
+        for record, output_record in zip(self.bhd.records, output_bhd.records):
+            for entry in record.entries:
+                output_entry = copy.copy(entry)
+                output_entry.offset, output_entry.size = new_entries[id(entry)]
+                output_record.entries.append(output_entry)
+        ExternalArchive._update_bhd_header(output_bhd)
+        return output_bhd
+
+
+# Archive used by each export worker process, with its own BDT handle.
+_WORKER_ARCHIVE = None
+
+def _init_export_worker(bdt_path, verbose):
+    global _WORKER_ARCHIVE
+    init_worker_logging()
+    _WORKER_ARCHIVE = ExternalArchive()
+    _WORKER_ARCHIVE.bdt.open(bdt_path)
+    # Summaries are logged by the parent process.
+    PROGRESS.verbose = verbose
+    PROGRESS.interval = float("inf")
+
+def _export_record_task(task):
+    """ Export the entries of a record task made by _get_record_task; return
+    the record index and, for each entry, its relative path (None on failure)
+    and its decompressed relative path (None if it was not decompressed). """
+    index, output_dir, entries = task
+    results = []
+    for offset, size, rel_path, base_rel_path in entries:
+        exported, decompressed = _WORKER_ARCHIVE._export_entry(
+            offset, size, rel_path, base_rel_path, output_dir
+        )
+        results.append((
+            rel_path if exported else None,
+            base_rel_path if decompressed else None
+        ))
+    return index, results
+
+
+def _prefetch(items, size):
+    """ Generate the elements of the iterator items, computed by a background
+    thread at most size elements in advance. Exceptions raised by items are
+    raised by this generator. """
+    item_queue = queue.Queue(size)
+    stop_event = threading.Event()
+
+    def produce():
+        try:
+            for item in items:
+                if not _put_until_stopped(item_queue, (True, item), stop_event):
+                    return
+            end = (False, None)
+        except Exception as exc:
+            end = (False, exc)
+        _put_until_stopped(item_queue, end, stop_event)
+
+    producer = threading.Thread(target = produce, daemon = True)
+    producer.start()
+    try:
+        while True:
+            is_item, value = item_queue.get()
+            if not is_item:
+                if value is not None:
+                    raise value
+                return
+            yield value
+    finally:
+        stop_event.set()
+        producer.join()
+
+def _put_until_stopped(item_queue, value, stop_event):
+    """ Put value in the queue, waiting for a free slot unless stop_event is
+    set; return True if the value has been put. """
+    while not stop_event.is_set():
+        try:
+            item_queue.put(value, timeout = 0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
@@ -0,0 +1,159 @@
+import json
+
+from sieglib.bhd import BhdDataEntry
+from sieglib.hashmap_cache import HashmapCache
+from sieglib.log import LOG
+from sieglib.metrics import METRICS
+
+
+class Filelist(object):
+    """ Map of BHD hashes to the original file names, with a reverse index of
+    names to hashes, so both lookups are done in constant time.
+
+    It can be used like the dict of hashes to names it replaces, but it should
+    only be modified through its methods so the reverse index stays in sync.
+
+    A filelist loaded with use_cache is backed by a HashmapCache: lookups are
+    done in the mapped cache, and the dicts are only filled from it when the
+    whole filelist is needed (iteration, modification, save).
+
+    Attributes:
+    - names: dict which maps hashes to names
+    - hashes: dict which maps names to hashes
+    - cache: HashmapCache used for lookups, or None
+    """
+
+    def __init__(self, names = None):
+        self.names = {}
+        self.hashes = {}
+        self.cache = None
+        if names:
+            self.update(names)
+
+    def __len__(self):
+        if self.cache is not None:
+            return len(self.cache)
+        return len(self.names)
+
+    def __iter__(self):
+        self._load_cache_names()
+        return iter(self.names)
+
+    def __contains__(self, entry_hash):
+        if self.cache is not None:
+            return entry_hash in self.cache
+        return entry_hash in self.names
+
+    def __getitem__(self, entry_hash):
+        if self.cache is not None:
+            name = self.cache.get(entry_hash)
+            if name is None:
+                raise KeyError(entry_hash)
+            return name
+        return self.names[entry_hash]
+
+    def __setitem__(self, entry_hash, name):
+        self._load_cache_names()
+        if entry_hash in self.names:
+            del self[entry_hash]
+        self.names[entry_hash] = name
+        self.hashes[name] = entry_hash
+
+    def __delitem__(self, entry_hash):
+        self._load_cache_names()
+        name = self.names.pop(entry_hash)
+        if self.hashes.get(name) == entry_hash:
+            del self.hashes[name]
+
+    def get(self, entry_hash, default = None):
+        """ Return the name of that hash, or default if it is unknown. """
+        if self.cache is not None:
+            return self.cache.get(entry_hash, default)
+        return self.names.get(entry_hash, default)
+
+    def get_hash(self, name, default = None):
+        """ Return the hash of that name if it is in the filelist, else
+        default. Use BhdDataEntry.hash_name to hash any string. """
+        if self.cache is not None:
+            entry_hash = BhdDataEntry.hash_name(name)
+            if self.cache.get(entry_hash) == name:
+                return entry_hash
+            return default
+        return self.hashes.get(name, default)
+
+    def has_name(self, name):
+        return self.get_hash(name) is not None
+
+    def items(self):
+        self._load_cache_names()
+        return self.names.items()
+
+    def keys(self):
+        self._load_cache_names()
+        return self.names.keys()
+
+    def values(self):
+        self._load_cache_names()
+        return self.names.values()
+
+    def update(self, names):
+        """ Add the names of that dict (or Filelist) of hashes to names. """
+        for entry_hash, name in names.items():
+            self[entry_hash] = name
+
+    def add_name(self, name):
+        """ Add that name with its hash, and return the hash. """
+        entry_hash = BhdDataEntry.hash_name(name)
+        self[entry_hash] = name
+        return entry_hash
+
+    def load(self, hashmap_path, use_cache = False):
+        """ Load a JSON hashmap, which maps hex hashes to names, replacing the
+        current content; return True on success. If use_cache is True, names
+        are looked up in its binary cache (see HashmapCache) instead, and the
+        JSON is only parsed if the cache has to be generated. """
+        self._close_cache()
+        if use_cache:
+            cache = HashmapCache()
+            if cache.open(hashmap_path):
+                self.names = {}
+                self.hashes = {}
+                self.cache = cache
+                return True
+            LOG.info("Can't use a cache for {}.".format(hashmap_path))
+        try:
+            with METRICS.measure(METRICS.JSON):
+                with open(hashmap_path, "r") as hashmap_file:
+                    hashmap = json.load(hashmap_file)
+                self.names = { int(k, 16): hashmap[k] for k in hashmap.keys() }
+                self.hashes = { name: h for h, name in self.names.items() }
+        except OSError as exc:
+            LOG.error("Error reading {}: {}".format(hashmap_path, exc))
+            return False
+        return True
+
+    def save(self, hashmap_path):
+        """ Save the filelist as a JSON hashmap, return True on success. """
+        self._load_cache_names()
+        hashmap = { "{:08X}".format(h): name for h, name in self.names.items() }
+        try:
+            with METRICS.measure(METRICS.JSON):
+                with open(hashmap_path, "w") as hashmap_file:
+                    json.dump(hashmap, hashmap_file, indent = 2)
+        except OSError as exc:
+            LOG.error("Error writing {}: {}".format(hashmap_path, exc))
+            return False
+        return True
+
+    def _load_cache_names(self):
+        """ Fill the dicts with the names of the cache and stop using it. """
+        if self.cache is None:
+            return
+        self.names = dict(self.cache.items())
+        self.hashes = { name: h for h, name in self.names.items() }
+        self._close_cache()
+
+    def _close_cache(self):
+        if self.cache is not None:
+            self.cache.close()
+            self.cache = None
@@ -0,0 +1,184 @@
+from array import array
+from bisect import bisect_left
+from struct import Struct, error as struct_error
+import json
+import mmap
+import os
+
+from sieglib.log import LOG
+
+
+class HashmapCache(object):
+    """ Binary form of a JSON hashmap, generated next to it, so names can be
+    looked up without parsing the JSON and converting every hex hash.
+
+    The file contains a header, the sorted hashes as uint32, an offset table of
+    uint32 into the name blob (one more offset than there are names, so name i
+    is blob[offsets[i] : offsets[i + 1]]) and the blob of UTF-8 names. Values
+    use the host byte order, which the header records. The cache is memory-
+    mapped and names are decoded only when looked up.
+
+    The header also stores the size and modification time of the JSON file the
+    cache was generated from; a cache that does not match its JSON anymore is
+    generated again.
+
+    Attributes:
+    - num_entries: number of names in the cache
+    - hashes: memoryview of the sorted hashes
+    - offsets: memoryview of the name offsets in the blob
+    - blob: memoryview of the names
+    """
+
+    MAGIC = b"HMAP"
+    BYTE_ORDER_MARK = 0x01020304
+    HEADER = Struct("=4sIIQq4x")
+    EXTENSION = ".bin"
+
+    def __init__(self):
+        self.cache_file = None
+        self.cache_mmap = None
+        self.num_entries = 0
+        self.hashes = None
+        self.offsets = None
+        self.blob = None
+
+    def __len__(self):
+        return self.num_entries
+
+    def __contains__(self, entry_hash):
+        return self._find(entry_hash) is not None
+
+    @staticmethod
+    def get_cache_path(hashmap_path):
+        """ Return the path of the cache of that JSON hashmap. """
+        return os.path.splitext(hashmap_path)[0] + HashmapCache.EXTENSION
+
+    def open(self, hashmap_path):
+        """ Open the cache of the JSON hashmap at hashmap_path, generating it
+        if it is missing or outdated; return True on success. """
+        try:
+            json_stat = os.stat(hashmap_path)
+        except OSError as exc:
+            LOG.error("Error reading {}: {}".format(hashmap_path, exc))
+            return False
+        cache_path = HashmapCache.get_cache_path(hashmap_path)
+        if self._open_cache(cache_path, json_stat):
+            return True
+        if not HashmapCache.generate(hashmap_path, cache_path):
+            return False
+        return self._open_cache(cache_path, os.stat(hashmap_path))
+
+    def _open_cache(self, cache_path, json_stat):
+        """ Map the cache at cache_path if it is valid for that JSON stat. """
+        self.close()
+        try:
+            self.cache_file = open(cache_path, "rb")
+            cache_size = os.fstat(self.cache_file.fileno()).st_size
+            if cache_size < self.HEADER.size:
+                self.close()
+                return False
+            self.cache_mmap = mmap.mmap(
+                self.cache_file.fileno(), 0, access = mmap.ACCESS_READ
+            )
+            header = self.HEADER.unpack_from(self.cache_mmap)
+        except (OSError, ValueError, struct_error):
+            self.close()
+            return False
+
+        magic, byte_order_mark, num_entries, json_size, json_mtime = header
+        tables_end = self.HEADER.size + 8 * num_entries + 4
+        if ( magic != self.MAGIC
+                or byte_order_mark != self.BYTE_ORDER_MARK
+                or json_size != json_stat.st_size
+                or json_mtime != json_stat.st_mtime_ns
+                or cache_size < tables_end ):
+            self.close()
+            return False
+
+        view = memoryview(self.cache_mmap)
+        hashes_end = self.HEADER.size + 4 * num_entries
+        self.num_entries = num_entries
+        self.hashes = view[self.HEADER.size : hashes_end].cast("I")
+        self.offsets = view[hashes_end : tables_end].cast("I")
+        self.blob = view[tables_end:]
+        view.release()
+        return True
+
+    def close(self):
+        """ Release the views and unmap the cache. """
+        for view in (self.hashes, self.offsets, self.blob):
+            if view is not None:
+                view.release()
+        self.hashes = self.offsets = self.blob = None
+        self.num_entries = 0
+        if self.cache_mmap is not None:
+            self.cache_mmap.close()
+            self.cache_mmap = None
+        if self.cache_file is not None:
+            self.cache_file.close()
+            self.cache_file = None
+
+    def _find(self, entry_hash):
+        """ Return the index of that hash, or None if it is not cached. """
+        if not 0 <= entry_hash <= 0xFFFFFFFF:
+            return None
+        index = bisect_left(self.hashes, entry_hash)
+        if index < self.num_entries and self.hashes[index] == entry_hash:
+            return index
+        return None
+
+    def _get_name(self, index):
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return str(self.blob[start:end], "utf8")
+
+    def get(self, entry_hash, default = None):
+        """ Return the name of that hash, or default if it is unknown. """
+        index = self._find(entry_hash)
+        if index is None:
+            return default
+        return self._get_name(index)
+
+    def items(self):
+        """ Generate all (hash, name) pairs, sorted by hash. """
+        for index in range(self.num_entries):
+            yield self.hashes[index], self._get_name(index)
+
+    @staticmethod
+    def generate(hashmap_path, cache_path = None):
+        """ Generate the cache of the JSON hashmap at hashmap_path, at
+        cache_path if given, return True on success. The file is written
+        under a temporary name then renamed, so a cache is always complete. """
+        if cache_path is None:
+            cache_path = HashmapCache.get_cache_path(hashmap_path)
+        try:
+            json_stat = os.stat(hashmap_path)
+            with open(hashmap_path, "r") as hashmap_file:
+                hashmap = json.load(hashmap_file)
+        except OSError as exc:
+            LOG.error("Error reading {}: {}".format(hashmap_path, exc))
+            return False
+        names = { int(k, 16): hashmap[k] for k in hashmap.keys() }
+
+        hashes = array("I", sorted(names))
+        offsets = array("I", [0])
+        blob = bytearray()
+        for entry_hash in hashes:
+            blob += names[entry_hash].encode("utf8")
+            offsets.append(len(blob))
+        header = HashmapCache.HEADER.pack(
+            HashmapCache.MAGIC, HashmapCache.BYTE_ORDER_MARK, len(hashes),
+            json_stat.st_size, json_stat.st_mtime_ns
+        )
+
+        temp_path = cache_path + ".tmp"
+        try:
+            with open(temp_path, "wb") as cache_file:
+                cache_file.write(header)
+                cache_file.write(hashes.tobytes())
+                cache_file.write(offsets.tobytes())
+                cache_file.write(blob)
+            os.replace(temp_path, cache_path)
+        except OSError as exc:
+            LOG.error("Error writing {}: {}".format(cache_path, exc))
+            return False
+        return True
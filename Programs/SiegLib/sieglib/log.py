@@ -1,4 +1,130 @@
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
 from pyshgck.logger import get_logger
 
 
 LOG = get_logger(name = "sieglib")
+
+
+class FileProgress(object):
+    """ Log the files processed by a long operation (export, import, BND
+    extraction). In verbose mode, a line is logged for each file; else files
+    are only counted and a summary with the number of files, bytes and rate is
+    logged every INTERVAL seconds and when the operation finishes. Files are
+    counted once processed successfully; failures are counted apart.
+
+    Attributes:
+    - verbose: True to log a line for each file
+    - interval: seconds between summaries, INTERVAL by default
+    - action: name of the current operation, used in summaries
+    - num_files: number of files processed by the current operation
+    - num_bytes: number of bytes processed by the current operation
+    - num_failed: number of files the current operation failed to process
+    """
+
+    INTERVAL = 2.0
+
+    def __init__(self):
+        self.verbose = False
+        self.interval = self.INTERVAL
+        self.lock = threading.Lock()
+        self.start("")
+
+    def start(self, action):
+        """ Start counting the files of a new operation. """
+        with self.lock:
+            self.action = action
+            self.num_files = 0
+            self.num_bytes = 0
+            self.num_failed = 0
+            self.start_time = time.perf_counter()
+            self.last_summary = self.start_time
+
+    def file(self, message, rel_path, num_bytes = 0):
+        """ Count a file; message is the per-file line, e.g. "Extracting". """
+        if self.verbose:
+            LOG.info("%s %s", message, rel_path)
+        self.count(1, num_bytes)
+
+    def fail(self, num_files = 1):
+        """ Count files that could not be processed; errors are logged by the
+        caller. """
+        with self.lock:
+            self.num_failed += num_files
+
+    def count(self, num_files, num_bytes):
+        """ Count files processed without logging them individually, e.g.
+        files processed by other processes. """
+        with self.lock:
+            self.num_files += num_files
+            self.num_bytes += num_bytes
+            now = time.perf_counter()
+            if self.verbose or now - self.last_summary < self.interval:
+                return
+            self.last_summary = now
+        self._log_summary(now)
+
+    def finish(self):
+        """ Log the summary of the current operation. """
+        self._log_summary(time.perf_counter(), done = True)
+
+    def _log_summary(self, now, done = False):
+        duration = now - self.start_time
+        rate = self.num_bytes / duration if duration > 0 else 0.0
+        failed = ""
+        if self.num_failed:
+            failed = ", {} failed".format(self.num_failed)
+        LOG.info("{}{}: {} files{}, {:.1f} MB, {:.1f} MB/s".format(
+            self.action, " done" if done else "", self.num_files, failed,
+            self.num_bytes / 1000000, rate / 1000000
+        ))
+
+
+PROGRESS = FileProgress()
+
+_LISTENER = None
+
+def start_async_logging():
+    """ Move the handlers of LOG behind a queue, so records are written by a
+    background thread instead of the thread logging them. """
+    global _LISTENER
+    if _LISTENER is not None or not LOG.handlers:
+        return
+    handlers = LOG.handlers[:]
+    for handler in handlers:
+        LOG.removeHandler(handler)
+    log_queue = queue.SimpleQueue()
+    LOG.addHandler(logging.handlers.QueueHandler(log_queue))
+    _LISTENER = logging.handlers.QueueListener(
+        log_queue, *handlers, respect_handler_level = True
+    )
+    _LISTENER.start()
+
+def stop_async_logging():
+    """ Write the queued records and give the handlers back to LOG. """
+    if _LISTENER is None:
+        return
+    _LISTENER.stop()
+    _restore_handlers()
+
+def init_worker_logging():
+    """ Give the handlers back to LOG in a worker process forked while logging
+    is asynchronous: the listener thread only runs in the parent process, so
+    records put in the worker copy of the queue would never be written. To be
+    called by pool initializers. """
+    if _LISTENER is None:
+        return
+    _restore_handlers()
+
+def _restore_handlers():
+    global _LISTENER
+    for handler in LOG.handlers[:]:
+        if isinstance(handler, logging.handlers.QueueHandler):
+            LOG.removeHandler(handler)
+    for handler in _LISTENER.handlers:
+        LOG.addHandler(handler)
+    _LISTENER = None
@@ -1,9 +1,23 @@
 import argparse
+import cProfile
+import multiprocessing
 import os
+import sys
+import tracemalloc
 
+from sieglib.bhd import Bhd
 from sieglib.bnd import Bnd
 from sieglib.config import RESOURCES_DIR
+from sieglib.entry_filter import EntryFilter
+from sieglib.export_scheduler import ExportScheduler
 from sieglib.external_archive import ExternalArchive
+from sieglib.filelist import Filelist
+from sieglib.log import (
+    LOG, PROGRESS, start_async_logging, stop_async_logging
+)
+from sieglib.metrics import METRICS
+from sieglib.name_recovery import NameRecovery, NameTemplate, load_word_list
+from sieglib.verifier import ArchiveVerifier
 
 DESCRIPTION = """
 Dark Souls archive formats library. You can use this library to export files
@@ -32,6 +46,72 @@ ARGS = [
                      "type": str,
                      "help": "specify BHD filelists (-E has default files)" }
     },
+    {
+        "command": ("--workers",),
+        "params":  { "dest": "workers",
+                     "type": int,
+                     "default": 1,
+                     "help": "number of worker processes (-e/-E/-i/-I/"
+                             "--verify/--recover-names)" }
+    },
+    {
+        "command": ("--manifest",),
+        "params":  { "dest": "manifest",
+                     "action": "store_true",
+                     "help": "write a manifest of exported files (-e/-E)" }
+    },
+    {
+        "command": ("--offset-order",),
+        "params":  { "dest": "offset_order",
+                     "action": "store_true",
+                     "help": "read entries in BDT order (-e/-E)" }
+    },
+    {
+        "command": ("--include",),
+        "params":  { "dest": "include_patterns",
+                     "action": "append",
+                     "metavar": "PATTERN",
+                     "help": "export only entries matching that name glob, "
+                             "e.g. /chr/*.anibnd.dcx (-e/-E)" }
+    },
+    {
+        "command": ("--ext",),
+        "params":  { "dest": "extensions",
+                     "action": "append",
+                     "metavar": "EXT",
+                     "help": "export only entries with that extension, e.g. "
+                             ".tpf.dcx (-e/-E)" }
+    },
+    {
+        "command": ("--hash",),
+        "params":  { "dest": "hashes",
+                     "action": "append",
+                     "metavar": "HASH",
+                     "help": "export only entries with that hex hash (-e/-E)" }
+    },
+    {
+        "command": ("--resume",),
+        "params":  { "dest": "resume",
+                     "action": "store_true",
+                     "help": "skip the files exported by an interrupted "
+                             "export (-e/-E)" }
+    },
+    {
+        "command": ("--concurrent",),
+        "params":  { "dest": "concurrent",
+                     "action": "store_true",
+                     "help": "export all archives together, with --workers "
+                             "threads (-E, not with --resume or "
+                             "--offset-order)" }
+    },
+    {
+        "command": ("--max-in-flight",),
+        "params":  { "dest": "max_in_flight",
+                     "type": int,
+                     "default": 64,
+                     "help": "MB of entries read or inflated at the same time "
+                             "(--concurrent)" }
+    },
     {
         "command": ("-i", "--import-files"),
         "params":  { "dest": "archive_tree",
@@ -44,6 +124,59 @@ ARGS = [
                      "type": str,
                      "help": "generate archives from that exported file tree" }
     },
+    {
+        "command": ("--dedup",),
+        "params":  { "dest": "dedup",
+                     "action": "store_true",
+                     "help": "store identical files only once (-i/-I)" }
+    },
+    {
+        "command": ("-u", "--update-archive"),
+        "params":  { "dest": "update_tree",
+                     "type": str,
+                     "help": "append files changed in that exported tree to "
+                             "the archive given as output" }
+    },
+    {
+        "command": ("--overlay",),
+        "params":  { "dest": "overlay",
+                     "nargs": 2,
+                     "metavar": ("BHD", "OVERRIDE_DIR"),
+                     "help": "build a copy of that archive at the output "
+                             "path, with the files of OVERRIDE_DIR replacing "
+                             "the original ones" }
+    },
+    {
+        "command": ("--verify",),
+        "params":  { "dest": "verify_bhd",
+                     "type": str,
+                     "metavar": "BHD",
+                     "help": "check the integrity of this archive, a JSON "
+                             "report is written at the output path" }
+    },
+    {
+        "command": ("--recover-names",),
+        "params":  { "dest": "recovery_dir",
+                     "type": str,
+                     "help": "find names of unknown hashes in the archives of "
+                             "that directory, patches are written in the "
+                             "output directory" }
+    },
+    {
+        "command": ("--template",),
+        "params":  { "dest": "templates",
+                     "action": "append",
+                     "help": "name template, e.g. /chr/c{0000-9999}.{ext}.dcx "
+                             "(--recover-names)" }
+    },
+    {
+        "command": ("--words",),
+        "params":  { "dest": "word_lists",
+                     "action": "append",
+                     "metavar": "NAME=FILE",
+                     "help": "word list usable as {NAME} in templates "
+                             "(--recover-names)" }
+    },
     {
         "command": ("--extract-bnd",),
         "params": { "dest": "bnd",
@@ -56,6 +189,33 @@ ARGS = [
                     "type": str,
                     "help": "generate a BND from the file in that dir" }
     },
+    {
+        "command": ("-v", "--verbose"),
+        "params":  { "dest": "verbose",
+                     "action": "store_true",
+                     "help": "log every file instead of progress summaries" }
+    },
+    {
+        "command": ("--metrics",),
+        "params":  { "dest": "metrics",
+                     "type": str,
+                     "metavar": "REPORT",
+                     "help": "write a JSON report of per-stage metrics" }
+    },
+    {
+        "command": ("--trace-memory",),
+        "params":  { "dest": "trace_memory",
+                     "action": "store_true",
+                     "help": "trace allocations with tracemalloc to report "
+                             "peak memory (--metrics)" }
+    },
+    {
+        "command": ("--profile",),
+        "params":  { "dest": "profile",
+                     "type": str,
+                     "metavar": "STATS",
+                     "help": "run with cProfile and dump stats to that file" }
+    },
     {
         "command": ("-o",),
         "params":  { "dest": "output",
@@ -72,31 +232,100 @@ def main():
         argparser.add_argument(*arg["command"], **arg["params"])
     args = argparser.parse_args()
 
+    PROGRESS.verbose = args.verbose
+    if args.metrics:
+        METRICS.enable()
+    if args.trace_memory:
+        tracemalloc.start()
+    start_async_logging()
+    try:
+        if args.profile:
+            profiler = cProfile.Profile()
+            success = profiler.runcall(run_command, args)
+            profiler.dump_stats(args.profile)
+        else:
+            success = run_command(args)
+    finally:
+        stop_async_logging()
+    if args.metrics:
+        METRICS.save_report(args.metrics)
+    if not success:
+        sys.exit(1)
+
+def run_command(args):
+    """ Run the command asked with these parsed arguments. Return False if
+    the arguments are invalid or if a verified archive is not valid. """
+    if args.bhd or args.data_dir:
+        hashes = EntryFilter.parse_hashes(args.hashes or [])
+        if hashes is None:
+            return False
+        entry_filter = EntryFilter(
+            args.include_patterns, args.extensions, hashes
+        )
     if args.bhd:
-        export_archive(args.bhd, args.output, args.filelist)
+        export_archive( args.bhd, args.output, args.filelist, args.workers,
+                        args.manifest, args.offset_order, args.resume,
+                        entry_filter )
     elif args.data_dir:
-        export_archives(args.data_dir, args.output, args.filelist)
+        if args.concurrent and (args.resume or args.offset_order):
+            LOG.error("--concurrent can't be used with --resume or "
+                      "--offset-order.")
+            return False
+        if args.concurrent:
+            export_archives_concurrently(
+                args.data_dir, args.output, args.filelist, args.workers,
+                args.manifest, args.max_in_flight * 1024 * 1024, entry_filter
+            )
+        else:
+            export_archives( args.data_dir, args.output, args.filelist,
+                             args.workers, args.manifest, args.offset_order,
+                             args.resume, entry_filter )
     elif args.archive_tree:
-        import_files(args.archive_tree, args.output)
+        import_files( args.archive_tree, args.output, workers = args.workers,
+                      dedup = args.dedup )
     elif args.archives_tree:
-        reimport_archives(args.archives_tree, args.output)
+        reimport_archives( args.archives_tree, args.output, args.workers,
+                           args.dedup )
+    elif args.update_tree:
+        update_archive(args.update_tree, args.output)
+    elif args.overlay:
+        build_overlay(args.overlay[0], args.overlay[1], args.output)
+    elif args.verify_bhd:
+        return verify_archive( args.verify_bhd, args.output, args.filelist,
+                               args.workers )
+    elif args.recovery_dir:
+        recover_names( args.recovery_dir, args.output, args.templates or [],
+                       args.word_lists or [], args.filelist, args.workers )
     elif args.bnd:
         extract_bnd(args.bnd, args.output)
     elif args.bnd_dir:
         generate_bnd(args.bnd_dir, args.output)
+    return True
 
-def export_archive(bhd_path, output_dir, filelist_path):
+def export_archive( bhd_path, output_dir, filelist_path, workers = 1,
+                    write_manifest = False, offset_order = False,
+                    resume = False, entry_filter = None ):
     """ Export the archive located at bhd_path in the directory output_dir.
-    A filelist can be provided as filelist_path. """
+    A filelist can be provided as filelist_path. Files are exported by workers
+    processes. If write_manifest is True, the archive can later be updated with
+    update_archive. If offset_order is True, entries are read in BDT order. If
+    resume is True, files exported by an interrupted export are skipped. If
+    entry_filter is given, only the entries it selects are exported. """
     archive = ExternalArchive()
     load_success = archive.load(bhd_path)
     if not load_success:
         return
     if filelist_path:
         archive.load_filelist(filelist_path)
-    archive.export_all_files(output_dir)
+    archive.export_all_files(
+        output_dir, workers = workers, write_manifest = write_manifest,
+        offset_order = offset_order, resume = resume,
+        entry_filter = entry_filter
+    )
 
-def export_archives(data_dir, output_dir, filelist_path = None):
+def export_archives( data_dir, output_dir, filelist_path = None, workers = 1,
+                     write_manifest = False, offset_order = False,
+                     resume = False, entry_filter = None ):
     """ Export the Dark Souls archives located in the data_dir directory, to
     the output_dir. A subdirectory for each archive will be created. A filelist
     can be provided as filelist_path, but default filelists are available. """
@@ -107,25 +336,143 @@ def export_archives(data_dir, output_dir, filelist_path = None):
         if use_default_filelist:
             filelist_path = DVDBND_HASHMAP_PATH.format(index)
         archive_workspace = os.path.join(output_dir, index)
-        export_archive(bhd_path, archive_workspace, filelist_path)
+        export_archive( bhd_path, archive_workspace, filelist_path, workers,
+                        write_manifest, offset_order, resume, entry_filter )
 
-def import_files(archive_tree, output_dir, index = None):
+def export_archives_concurrently( data_dir, output_dir, filelist_path = None,
+                                 workers = 4, write_manifest = False,
+                                 max_in_flight = None, entry_filter = None ):
+    """ Export the Dark Souls archives like export_archives, but all at the
+    same time with an ExportScheduler of workers threads, reading or inflating
+    at most max_in_flight bytes at once. The throughput is logged. """
+    if max_in_flight is None:
+        max_in_flight = ExportScheduler.DEFAULT_MAX_IN_FLIGHT
+    scheduler = ExportScheduler(workers, max_in_flight)
+    archives = []
+    use_default_filelist = filelist_path is None
+    for index in [str(i) for i in range(4)]:
+        bhd_name = "dvdbnd{}.bhd5".format(index)
+        bhd_path = os.path.join(data_dir, bhd_name)
+        if use_default_filelist:
+            filelist_path = DVDBND_HASHMAP_PATH.format(index)
+        archive = ExternalArchive()
+        if not archive.load(bhd_path, use_mmap = True):
+            continue
+        if filelist_path:
+            archive.load_filelist(filelist_path)
+        archives.append(archive)
+        archive_workspace = os.path.join(output_dir, index)
+        scheduler.add_archive(
+            archive, archive_workspace, write_manifest = write_manifest,
+            entry_filter = entry_filter
+        )
+    scheduler.run()
+    for archive in archives:
+        archive.bdt.close()
+
+def import_files( archive_tree, output_dir, index = None, workers = 1,
+                  dedup = False ):
     """ Import the data located in archive_tree in an external archive that will
-    be written in output_dir. An archive index can be provided. """
+    be written in output_dir. An archive index can be provided. Files are
+    compressed by workers processes, and identical files are stored once if
+    dedup is True. """
     if index is None:
         bhd_name = "dvdbnd.bhd5"
     else:
         bhd_name = "dvdbnd{}.bhd5".format(index)
     archive_bhd_path = os.path.join(output_dir, bhd_name)
     archive = ExternalArchive()
-    archive.import_files(archive_tree, archive_bhd_path)
+    archive.import_files(archive_tree, archive_bhd_path, workers, dedup)
 
-def reimport_archives(archives_tree, output_dir):
+def reimport_archives(archives_tree, output_dir, workers = 1, dedup = False):
     """ Generate Dark Souls archives from the archives tree formerly created by
     using the export_archives function; files are written in output_dir. """
     for index in [str(i) for i in range(4)]:
         archive_tree = os.path.join(archives_tree, index)
-        import_files(archive_tree, output_dir, index)
+        import_files(archive_tree, output_dir, index, workers, dedup)
+
+def update_archive(archive_tree, bhd_path):
+    """ Update the archive at bhd_path with the files changed in archive_tree
+    since it was exported with a manifest. """
+    archive = ExternalArchive()
+    archive.update_files(archive_tree, bhd_path)
+
+def build_overlay(bhd_path, override_dir, output_bhd_path):
+    """ Build a copy of the archive at bhd_path where files of override_dir
+    replace the original ones; the new archive is written at output_bhd_path.
+    """
+    archive = ExternalArchive()
+    load_success = archive.load(bhd_path)
+    if not load_success:
+        return
+    archive.build_overlay(override_dir, output_bhd_path)
+
+def verify_archive(bhd_path, report_path, filelist_path = None, workers = 1):
+    """ Check the integrity of the archive at bhd_path (see ArchiveVerifier)
+    with workers processes and write the JSON report at report_path. A
+    filelist can be provided as filelist_path to find DCX entries by name;
+    unnamed entries are probed. Return True if the archive is valid. """
+    archive = ExternalArchive()
+    load_success = archive.load(bhd_path)
+    if not load_success:
+        return False
+    if filelist_path:
+        archive.load_filelist(filelist_path)
+    verifier = ArchiveVerifier(archive)
+    valid = verifier.verify(workers)
+    archive.bdt.close()
+    for issue in verifier.issues:
+        LOG.error("{} ({}): {}".format(
+            issue.get("name") or issue.get("hash", "BDT"), issue["check"],
+            issue["message"]
+        ))
+    verifier.save_report(report_path)
+    return valid
+
+def recover_names( data_dir, output_dir, templates, word_list_args,
+                   filelist_path = None, workers = None ):
+    """ Try the name templates against the unknown hashes of the Dark Souls
+    archives located in data_dir with workers processes (all CPUs if None),
+    and write for each archive a hashmap patch of the names found in
+    output_dir. Word lists are given as "NAME=FILE". """
+    word_lists = {}
+    for word_list_arg in word_list_args:
+        name, _, word_list_path = word_list_arg.partition("=")
+        words = load_word_list(word_list_path)
+        if words is None:
+            return
+        word_lists[name] = words
+    name_templates = []
+    for template in templates:
+        name_template = NameTemplate.parse(template, word_lists)
+        if name_template is None:
+            return
+        LOG.info(str(name_template))
+        name_templates.append(name_template)
+
+    unknown_hashes = {}
+    use_default_filelist = filelist_path is None
+    for index in [str(i) for i in range(4)]:
+        bhd = Bhd()
+        if not bhd.load(os.path.join(data_dir, "dvdbnd{}.bhd5".format(index))):
+            return
+        if use_default_filelist:
+            filelist_path = DVDBND_HASHMAP_PATH.format(index)
+        filelist = Filelist()
+        if not filelist.load(filelist_path, use_cache = True):
+            return
+        unknown_hashes[index] = set(
+            entry.hash for record in bhd.records for entry in record.entries
+            if entry.hash not in filelist
+        )
+
+    recovery = NameRecovery(set().union(*unknown_hashes.values()))
+    recovery.search(name_templates, workers)
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    for index, hashes in unknown_hashes.items():
+        patch_name = "dvdbnd{}.hashmap.patch.json".format(index)
+        recovery.save_patch(os.path.join(output_dir, patch_name), hashes)
 
 def extract_bnd(bnd_path, output_dir):
     """ Extract files from a BND to output_dir. """
@@ -143,4 +490,5 @@ def generate_bnd(bnd_dir, output_path):
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     main()
@@ -0,0 +1,83 @@
+import hashlib
+import json
+import os
+
+from sieglib.log import LOG
+from sieglib.metrics import METRICS
+
+
+class Manifest(object):
+    """ State of the files of an archive tree: for each file, by relative path
+    as used in the archive, its size, modification time and SHA-1 digest. It is
+    used to find the files changed since the manifest was made without reading
+    the whole tree: the digest is only computed again for files whose size or
+    modification time changed.
+
+    Attributes:
+    - files: dict which maps relative paths to a list [size, mtime_ns, digest]
+    """
+
+    FILE_NAME = "manifest.json"
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self):
+        self.files = {}
+
+    def load(self, data_dir):
+        """ Load the manifest of data_dir, return True on success. """
+        manifest_path = os.path.join(data_dir, self.FILE_NAME)
+        try:
+            with METRICS.measure(METRICS.JSON):
+                with open(manifest_path, "r") as manifest_file:
+                    self.files = json.load(manifest_file)
+        except OSError as exc:
+            LOG.error("Error reading {}: {}".format(manifest_path, exc))
+            return False
+        return True
+
+    def save(self, data_dir):
+        """ Save the manifest in data_dir, return True on success. """
+        manifest_path = os.path.join(data_dir, self.FILE_NAME)
+        try:
+            with METRICS.measure(METRICS.JSON):
+                with open(manifest_path, "w") as manifest_file:
+                    json.dump(self.files, manifest_file)
+        except OSError as exc:
+            LOG.error("Error writing {}: {}".format(manifest_path, exc))
+            return False
+        return True
+
+    def update_file(self, rel_path, file_path):
+        """ Store the current state of the file at file_path. """
+        stat = os.stat(file_path)
+        digest = Manifest.get_digest(file_path)
+        self.files[rel_path] = [stat.st_size, stat.st_mtime_ns, digest]
+
+    def is_changed(self, rel_path, file_path):
+        """ Return True if the file at file_path has changed since its state
+        was stored, or if it is not in the manifest. """
+        state = self.files.get(rel_path)
+        if state is None:
+            return True
+        size, mtime_ns, digest = state
+        stat = os.stat(file_path)
+        if stat.st_size != size:
+            return True
+        if stat.st_mtime_ns == mtime_ns:
+            return False
+        if Manifest.get_digest(file_path) != digest:
+            return True
+        # Same content, only touched: store the new time to skip it next time.
+        state[1] = stat.st_mtime_ns
+        return False
+
+    @staticmethod
+    def get_digest(file_path):
+        """ Return the hex SHA-1 digest of the file content. """
+        sha1 = hashlib.sha1()
+        with open(file_path, "rb") as input_file:
+            chunk = input_file.read(Manifest.CHUNK_SIZE)
+            while chunk:
+                sha1.update(chunk)
+                chunk = input_file.read(Manifest.CHUNK_SIZE)
+        return sha1.hexdigest()
@@ -0,0 +1,153 @@
+from contextlib import contextmanager
+import json
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from sieglib.log import LOG
+
+
+class StageMetrics(object):
+    """ Counters of a stage: number of times it ran, bytes processed, wall and
+    CPU time in seconds, and peak memory allocated during one run (only when
+    tracemalloc is tracing, else 0). """
+
+    def __init__(self):
+        self.count = 0
+        self.num_bytes = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.peak_memory = 0
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "bytes": self.num_bytes,
+            "wall": self.wall,
+            "cpu": self.cpu,
+            "peak_memory": self.peak_memory
+        }
+
+
+class StageTimer(object):
+    """ Object given by Metrics.measure, to set the bytes processed when they
+    are only known at the end of the stage. """
+
+    def __init__(self, num_bytes = 0):
+        self.num_bytes = num_bytes
+
+
+class Metrics(object):
+    """ Per-stage performance metrics. Stages are measured with measure, a
+    context manager doing nothing while the metrics are disabled, so the
+    instrumented code costs nothing by default.
+
+    CPU time is the time of the thread running the stage. Peak memory is
+    measured with tracemalloc, if it is tracing; it is approximate when stages
+    run in several threads. Stages run in worker processes are not counted.
+
+    Attributes:
+    - enabled: True if stages are measured
+    - stages: dict which maps stage names to StageMetrics
+    """
+
+    # Stage names used in SiegLib.
+    BHD_PARSE = "bhd_parse"
+    BHD_WRITE = "bhd_write"
+    BDT_READ = "bdt_read"
+    BDT_WRITE = "bdt_write"
+    BDT_COPY = "bdt_copy"
+    DCX_INFLATE = "dcx_inflate"
+    DCX_DEFLATE = "dcx_deflate"
+    FS_READ = "fs_read"
+    FS_WRITE = "fs_write"
+    JSON = "json"
+
+    def __init__(self):
+        self.enabled = False
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.start_wall = 0.0
+        self.start_cpu = 0.0
+
+    def enable(self):
+        """ Reset the counters and start measuring stages. """
+        self.stages = {}
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    @contextmanager
+    def measure(self, name, num_bytes = 0):
+        """ Measure the stage name while in the context; the StageTimer given
+        can be used to set the number of bytes processed. """
+        timer = StageTimer(num_bytes)
+        if not self.enabled:
+            yield timer
+            return
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            start_memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        start_wall = time.perf_counter()
+        start_cpu = time.thread_time()
+        try:
+            yield timer
+        finally:
+            wall = time.perf_counter() - start_wall
+            cpu = time.thread_time() - start_cpu
+            peak_memory = 0
+            if tracing:
+                peak_memory = tracemalloc.get_traced_memory()[1] - start_memory
+            self.add(name, timer.num_bytes, wall, cpu, peak_memory)
+
+    def add(self, name, num_bytes = 0, wall = 0.0, cpu = 0.0, peak_memory = 0):
+        """ Count a run of the stage name. """
+        with self.lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = StageMetrics()
+            stage.count += 1
+            stage.num_bytes += num_bytes
+            stage.wall += wall
+            stage.cpu += cpu
+            stage.peak_memory = max(stage.peak_memory, peak_memory)
+
+    def get_report(self):
+        """ Return a dict with the metrics of every stage and of the whole
+        process since the metrics were enabled. """
+        report = {
+            "wall": time.perf_counter() - self.start_wall,
+            "cpu": time.process_time() - self.start_cpu,
+            "stages": {
+                name: stage.to_dict()
+                for name, stage in sorted(self.stages.items())
+            }
+        }
+        if tracemalloc.is_tracing():
+            report["traced_peak_memory"] = tracemalloc.get_traced_memory()[1]
+        if resource is not None:
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            report["max_rss_kb"] = usage.ru_maxrss
+        return report
+
+    def save_report(self, report_path):
+        """ Save the report as JSON at report_path, return True on success. """
+        try:
+            with open(report_path, "w") as report_file:
+                json.dump(self.get_report(), report_file, indent = 2)
+        except OSError as exc:
+            LOG.error("Error writing {}: {}".format(report_path, exc))
+            return False
+        return True
+
+
+METRICS = Metrics()
@@ -0,0 +1,258 @@
+import json
+import multiprocessing
+import os
+import re
+
+from sieglib.bhd import BhdDataEntry
+from sieglib.log import LOG, init_worker_logging
+
+
+HASH_MASK = 0xFFFFFFFF
+
+
+class NameTemplate(object):
+    """ Template of file names to try against unknown hashes, for example
+    "/chr/c{0000-9999}.{ext}.dcx". Fields between braces can be:
+
+    - a decimal range "{first-last}", zero-padded to the width of first;
+    - alternatives separated by commas, "{anibnd,chrbnd}";
+    - the name of a word list given to parse, "{ext}".
+
+    The template is stored as a list of parts, each a list of strings, so the
+    candidate names are the concatenations of one string of each part. Literal
+    text is merged with the part preceding it, to keep as few parts as possible.
+
+    Attributes:
+    - template: the template string
+    - parts: list of lists of strings
+    """
+
+    FIELD_RE = re.compile(r"\{([^{}]*)\}")
+    RANGE_RE = re.compile(r"(\d+)-(\d+)")
+
+    def __init__(self):
+        self.template = ""
+        self.parts = []
+
+    def __str__(self):
+        return "Template '{}', {} candidates".format(
+            self.template, self.num_candidates
+        )
+
+    @property
+    def num_candidates(self):
+        num_candidates = 1
+        for part in self.parts:
+            num_candidates *= len(part)
+        return num_candidates
+
+    @staticmethod
+    def parse(template, word_lists = None):
+        """ Return a NameTemplate for that template string, or None if it is
+        invalid. word_lists is a dict of word list names to lists of strings.
+        """
+        word_lists = word_lists or {}
+        name_template = NameTemplate()
+        name_template.template = template
+        position = 0
+        for match in NameTemplate.FIELD_RE.finditer(template):
+            name_template._add_literal(template[position : match.start()])
+            words = NameTemplate._get_field_words(match.group(1), word_lists)
+            if not words:
+                LOG.error("Invalid field '{}' in template '{}'.".format(
+                    match.group(0), template
+                ))
+                return None
+            name_template.parts.append(words)
+            position = match.end()
+        name_template._add_literal(template[position:])
+        if not name_template.parts:
+            name_template.parts.append([""])
+        return name_template
+
+    def _add_literal(self, literal):
+        if not literal:
+            return
+        if not self.parts:
+            self.parts.append([literal])
+        else:
+            self.parts[-1] = [word + literal for word in self.parts[-1]]
+
+    @staticmethod
+    def _get_field_words(field, word_lists):
+        """ Return the strings of that field, or None if it is invalid. """
+        range_match = NameTemplate.RANGE_RE.fullmatch(field)
+        if range_match:
+            first, last = range_match.group(1), range_match.group(2)
+            width = len(first)
+            return [
+                str(number).zfill(width)
+                for number in range(int(first), int(last) + 1)
+            ]
+        if field in word_lists:
+            return list(word_lists[field])
+        if "," in field:
+            return field.split(",")
+        return None
+
+    def get_name(self, indices):
+        """ Return the candidate made of these indices in each part. """
+        return "".join(part[i] for part, i in zip(self.parts, indices))
+
+
+def load_word_list(word_list_path):
+    """ Return the list of non-empty lines of that file, or None on error. """
+    try:
+        with open(word_list_path, "r") as word_list_file:
+            return [line.strip() for line in word_list_file if line.strip()]
+    except OSError as exc:
+        LOG.error("Error reading {}: {}".format(word_list_path, exc))
+        return None
+
+
+class NameRecovery(object):
+    """ Find the names of unknown hashes by hashing the candidates of name
+    templates, on several processes.
+
+    The BHD hash is h = h * 37 + c for each character, truncated to 32 bits,
+    so the hash of a name can be computed from the hash of its prefix:
+    hash(prefix + s) = hash(prefix) * 37^len(s) + hash(s). Each part of a
+    template is reduced to a table of (37^len(s), hash(s)) and candidates are
+    walked depth-first, so a shared prefix is hashed once and each candidate
+    costs one multiply-add. Work is split across processes on the values of
+    the first part with several strings.
+
+    Attributes:
+    - target_hashes: set of the hashes to find names for
+    - found_names: dict which maps found hashes to names
+    - collisions: dict which maps hashes to the other names found for them
+    """
+
+    # Number of tasks per worker, to balance the work.
+    TASKS_PER_WORKER = 4
+
+    def __init__(self, target_hashes):
+        self.target_hashes = set(target_hashes)
+        self.found_names = {}
+        self.collisions = {}
+
+    def search(self, templates, workers = None):
+        """ Try all candidates of these NameTemplates on workers processes
+        (all cores if None), and store the names found. Return the number of
+        new names found. """
+        workers = workers or os.cpu_count() or 1
+        tables = [_get_template_tables(t.parts) for t in templates]
+        tasks = []
+        for index, template in enumerate(templates):
+            tasks.extend(self._get_tasks(index, template, workers))
+
+        num_names = len(self.found_names)
+        if workers > 1 and len(tasks) > 1:
+            with multiprocessing.Pool(
+                workers, _init_search_worker, (tables, self.target_hashes)
+            ) as pool:
+                for results in pool.imap(_search_task, tasks):
+                    self._add_results(templates, results)
+        else:
+            _init_search_worker(tables, self.target_hashes)
+            for task in tasks:
+                self._add_results(templates, _search_task(task))
+        return len(self.found_names) - num_names
+
+    def _get_tasks(self, template_index, template, workers):
+        """ Return the tasks (template_index, split_index, start, stop) of that
+        template: the strings of the split part are divided between tasks. """
+        split_index = 0
+        for index, part in enumerate(template.parts):
+            if len(part) > 1:
+                split_index = index
+                break
+        num_words = len(template.parts[split_index])
+        num_tasks = min(num_words, workers * self.TASKS_PER_WORKER)
+        chunk_size = -(-num_words // num_tasks)
+        tasks = []
+        for start in range(0, num_words, chunk_size):
+            stop = min(start + chunk_size, num_words)
+            tasks.append((template_index, split_index, start, stop))
+        return tasks
+
+    def _add_results(self, templates, results):
+        for template_index, indices in results:
+            name = templates[template_index].get_name(indices)
+            entry_hash = BhdDataEntry.hash_name(name)
+            known_name = self.found_names.get(entry_hash)
+            if known_name is None:
+                LOG.info("Found {:08X}: {}".format(entry_hash, name))
+                self.found_names[entry_hash] = name
+            elif known_name.lower() != name.lower():
+                LOG.warning("Collision for {:08X}: {} and {}".format(
+                    entry_hash, known_name, name
+                ))
+                self.collisions.setdefault(entry_hash, []).append(name)
+
+    def save_patch(self, patch_path, hashes = None):
+        """ Save the names found as a JSON hashmap that can be merged in a
+        hashmap file; if hashes is given, only these hashes are saved. Return
+        True on success. """
+        patch = {
+            "{:08X}".format(h): name for h, name in self.found_names.items()
+            if hashes is None or h in hashes
+        }
+        try:
+            with open(patch_path, "w") as patch_file:
+                json.dump(patch, patch_file, indent = 2, sort_keys = True)
+        except OSError as exc:
+            LOG.error("Error writing {}: {}".format(patch_path, exc))
+            return False
+        return True
+
+
+def _get_template_tables(parts):
+    """ Return for each part the list of (37^len(s), hash(s)) of its strings,
+    truncated to 32 bits. """
+    return [
+        [ (pow(37, len(word), HASH_MASK + 1),
+           BhdDataEntry.hash_name(word)) for word in part ]
+        for part in parts
+    ]
+
+_WORKER_TABLES = None
+_WORKER_TARGETS = None
+
+def _init_search_worker(tables, target_hashes):
+    global _WORKER_TABLES, _WORKER_TARGETS
+    init_worker_logging()
+    _WORKER_TABLES = tables
+    _WORKER_TARGETS = frozenset(target_hashes)
+
+def _search_task(task):
+    """ Search the candidates of a task from NameRecovery._get_tasks, return a
+    list of (template_index, indices) of the matching candidates. """
+    template_index, split_index, start, stop = task
+    tables = list(_WORKER_TABLES[template_index])
+    offsets = [0] * len(tables)
+    tables[split_index] = tables[split_index][start:stop]
+    offsets[split_index] = start
+
+    results = []
+    for indices in _search_tables(tables, _WORKER_TARGETS):
+        indices = tuple(i + offset for i, offset in zip(indices, offsets))
+        results.append((template_index, indices))
+    return results
+
+def _search_tables(tables, targets):
+    """ Generate the indices of the candidates whose hash is in targets. The
+    last part is evaluated in one batch for each prefix. """
+    last_table = tables[-1]
+    last_depth = len(tables) - 1
+    stack = [(0, 0, ())]
+    while stack:
+        depth, prefix_hash, indices = stack.pop()
+        if depth == last_depth:
+            for index, (factor, word_hash) in enumerate(last_table):
+                if (prefix_hash * factor + word_hash) & HASH_MASK in targets:
+                    yield indices + (index,)
+            continue
+        for index, (factor, word_hash) in enumerate(tables[depth]):
+            part_hash = (prefix_hash * factor + word_hash) & HASH_MASK
+            stack.append((depth + 1, part_hash, indices + (index,)))
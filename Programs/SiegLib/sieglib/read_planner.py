@@ -0,0 +1,149 @@
+import os
+
+from sieglib.log import LOG
+
+
+class ReadRange(object):
+    """ Contiguous range of a BDT read at once, holding the entries it covers.
+
+    Attributes:
+    - offset: position of the range in the BDT
+    - size: size of the range, including the gaps between entries
+    - entries: list of (offset, size, task) sorted by offset
+    """
+
+    def __init__(self, offset, size, task):
+        self.offset = offset
+        self.size = size
+        self.entries = [(offset, size, task)]
+
+    @property
+    def end(self):
+        return self.offset + self.size
+
+    def add(self, offset, size, task):
+        self.entries.append((offset, size, task))
+        self.size = offset + size - self.offset
+
+
+class ReadPlanner(object):
+    """ Read entries of a BDT in offset order instead of the order they are
+    asked in, so the disk is read forward and the kernel readahead is useful.
+
+    Entries are sorted by offset and entries separated by at most max_gap bytes
+    are coalesced into ReadRanges of at most max_read_size bytes. Each range is
+    read with one vectored read (preadv), directly in one buffer per entry (and
+    one discarded buffer per gap), and the next range is announced to the
+    kernel with posix_fadvise. Entries bigger than max_read_size are not read:
+    they are given back without payload, to be streamed (see Bdt.copy_entry).
+
+    Where preadv or posix_fadvise are not available, ranges are read with
+    Bdt.read_entry and sliced, without hints.
+    """
+
+    DEFAULT_MAX_GAP = 64 * 1024
+    DEFAULT_MAX_READ_SIZE = 16 * 1024 * 1024
+    # Most systems do not accept more buffers in one vectored read.
+    MAX_BUFFERS = 1024
+
+    def __init__( self, max_gap = DEFAULT_MAX_GAP,
+                  max_read_size = DEFAULT_MAX_READ_SIZE ):
+        self.max_gap = max_gap
+        self.max_read_size = max_read_size
+
+    def plan(self, entries):
+        """ Return the list of ReadRanges covering entries, an iterable of
+        (offset, size, task), and the list of entries too big to be read. """
+        ranges = []
+        big_entries = []
+        current = None
+        for offset, size, task in sorted(entries, key = lambda e: e[:2]):
+            if size > self.max_read_size:
+                big_entries.append((offset, size, task))
+                continue
+            if current is not None and self._can_extend(current, offset, size):
+                current.add(offset, size, task)
+                continue
+            current = ReadRange(offset, size, task)
+            ranges.append(current)
+        return ranges, big_entries
+
+    def _can_extend(self, read_range, offset, size):
+        # Overlapping entries (e.g. deduplicated ones) start a new range, so
+        # every entry has its own buffer.
+        gap = offset - read_range.end
+        return ( 0 <= gap <= self.max_gap
+                 and len(read_range.entries) * 2 < self.MAX_BUFFERS
+                 and offset + size - read_range.offset <= self.max_read_size )
+
+    def read(self, bdt, entries):
+        """ Generate (task, payload) for entries, an iterable of (offset, size,
+        task), in offset order. The payload is None for entries too big to be
+        read at once, and shorter than the entry size if the end of the BDT is
+        reached. """
+        ranges, big_entries = self.plan(entries)
+        file_descriptor = bdt.bdt_file.fileno()
+        _advise(file_descriptor, 0, 0, "POSIX_FADV_SEQUENTIAL")
+        if ranges:
+            _advise(file_descriptor, ranges[0].offset, ranges[0].size)
+        for index, read_range in enumerate(ranges):
+            if index + 1 < len(ranges):
+                next_range = ranges[index + 1]
+                _advise(file_descriptor, next_range.offset, next_range.size)
+            yield from self._read_range(bdt, file_descriptor, read_range)
+        for _, _, task in big_entries:
+            yield task, None
+
+    @staticmethod
+    def _read_range(bdt, file_descriptor, read_range):
+        if bdt.bdt_mmap is None and hasattr(os, "preadv"):
+            return ReadPlanner._read_range_vectored(file_descriptor, read_range)
+        return ReadPlanner._read_range_sliced(bdt, read_range)
+
+    @staticmethod
+    def _read_range_vectored(file_descriptor, read_range):
+        buffers = []
+        payloads = []
+        position = read_range.offset
+        for offset, size, task in read_range.entries:
+            if offset > position:
+                buffers.append(bytearray(offset - position))
+            buffer = bytearray(size)
+            buffers.append(buffer)
+            payloads.append((task, buffer))
+            position = offset + size
+        try:
+            num_read = os.preadv(file_descriptor, buffers, read_range.offset)
+        except OSError as exc:
+            LOG.error("Error reading BDT range at 0x{:X}: {}".format(
+                read_range.offset, exc
+            ))
+            num_read = 0
+        if num_read < read_range.size:
+            # Truncate payloads past the end of what could be read.
+            read_end = read_range.offset + num_read
+            payloads = [
+                (task, memoryview(buffer)[: max(read_end - offset, 0)])
+                for (offset, _, _), (task, buffer)
+                in zip(read_range.entries, payloads)
+            ]
+        return payloads
+
+    @staticmethod
+    def _read_range_sliced(bdt, read_range):
+        data = memoryview(bdt.read_entry(read_range.offset, read_range.size))
+        return [
+            (task, data[offset - read_range.offset :
+                        offset - read_range.offset + size])
+            for offset, size, task in read_range.entries
+        ]
+
+
+def _advise(file_descriptor, offset, size, advice = "POSIX_FADV_WILLNEED"):
+    """ Give an access hint to the kernel if the platform supports it. """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        os.posix_fadvise(file_descriptor, offset, size, getattr(os, advice))
+    except OSError:
+        pass
@@ -0,0 +1,303 @@
+import json
+import multiprocessing
+import os
+import time
+import zlib
+
+from sieglib.bdt import Bdt
+from sieglib.dcx import Dcx
+from sieglib.log import LOG, PROGRESS, init_worker_logging
+from sieglib.read_planner import ReadPlanner
+
+
+class ArchiveVerifier(object):
+    """ Check the integrity of a loaded ExternalArchive without exporting it:
+    - the BDT starts with its magic;
+    - every entry lies inside the BDT, after its header;
+    - no entries overlap, except entries sharing the exact same range (as
+      written by a deduplicating import), whose content is checked once;
+    - DCX entries have valid DCX, DCS, DCP and DCA headers, and their zlib
+      stream inflates to the uncompressed size of their DCS chunk.
+
+    Only the index is needed for the first checks. For the DCX check, entries
+    named *.dcx are read, and entries without a known name are probed with a
+    read of their magic; other entries are never read. Ranges to read are sent
+    in offset order, in batches of about BATCH_SIZE bytes, to a pool of worker
+    processes reading them with a ReadPlanner. Inflated data is counted in
+    chunks and never kept.
+
+    Attributes:
+    - archive: the ExternalArchive verified
+    - issues: list of issue dicts with the check that failed ("bdt_header",
+        "bounds", "overlap" or "dcx"), a message and, for entry issues, the
+        record index, entry index, hash, name, offset and size of the entry
+    - num_dcx: number of DCX ranges checked by the last verification
+    - bytes_read: number of BDT bytes read by the last verification
+    - duration: wall time of the last verification, in seconds
+    """
+
+    BATCH_SIZE = 32 * 1024 * 1024
+    INFLATE_CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, archive):
+        self.archive = archive
+        self.issues = []
+        self.num_dcx = 0
+        self.bytes_read = 0
+        self.duration = 0.0
+
+    def verify(self, workers = 1):
+        """ Run all checks, with workers processes for the DCX ones; return
+        True if no issue has been found. """
+        self.issues = []
+        self.num_dcx = 0
+        self.bytes_read = 0
+        start = time.perf_counter()
+        bdt_size = os.fstat(self.archive.bdt.bdt_file.fileno()).st_size
+        self._check_bdt_header()
+        ranges = self._check_bounds(bdt_size)
+        self._check_overlaps(ranges)
+        PROGRESS.start("Verification")
+        self._check_contents(ranges, workers)
+        PROGRESS.finish()
+        self.duration = time.perf_counter() - start
+        # Batches are checked in any order.
+        self.issues.sort(key = lambda issue: (
+            issue.get("record", -1), issue.get("entry", -1)
+        ))
+
+        LOG.info("Verified {} entries in {:.1f}s: {} issues.".format(
+            self._get_num_entries(), self.duration, len(self.issues)
+        ))
+        return not self.issues
+
+    def _get_num_entries(self):
+        return sum(len(record.entries) for record in self.archive.bhd.records)
+
+    def _add_issue(self, check, message, key = None):
+        """ Add an issue of that check; key is an entry (record index, entry
+        index) if the issue is about an entry. """
+        issue = { "check": check, "message": message }
+        if key is not None:
+            record_index, entry_index = key
+            entry = self.archive.bhd.records[record_index].entries[entry_index]
+            issue.update({
+                "record": record_index,
+                "entry": entry_index,
+                "hash": "{:08X}".format(entry.hash),
+                "name": self.archive.filelist.get(entry.hash),
+                "offset": entry.offset,
+                "size": entry.size
+            })
+        self.issues.append(issue)
+
+    def _check_bdt_header(self):
+        header = bytes(self.archive.bdt.read_entry(0, len(Bdt.FULL_MAGIC)))
+        if header[:4] != Bdt.MAGIC.to_bytes(4, "little"):
+            self._add_issue("bdt_header", "BDT magic not found.")
+
+    def _check_bounds(self, bdt_size):
+        """ Report entries out of the BDT; return a dict which maps the range
+        (offset, size) of every other entry to the keys of its entries. """
+        ranges = {}
+        header_size = len(Bdt.FULL_MAGIC)
+        for record_index, record in enumerate(self.archive.bhd.records):
+            for entry_index, entry in enumerate(record.entries):
+                key = (record_index, entry_index)
+                if entry.offset < header_size:
+                    self._add_issue("bounds", "Entry overlaps BDT header.", key)
+                elif entry.offset + entry.size > bdt_size:
+                    self._add_issue("bounds", "Entry ends after BDT end "
+                                    "(0x{:X}).".format(bdt_size), key)
+                else:
+                    entry_range = (entry.offset, entry.size)
+                    ranges.setdefault(entry_range, []).append(key)
+        return ranges
+
+    def _check_overlaps(self, ranges):
+        """ Report entries whose range overlaps the range of another entry. """
+        last_range = None
+        last_end = 0
+        for entry_range in sorted(ranges):
+            offset, size = entry_range
+            if size == 0:
+                continue
+            if last_range is not None and offset < last_end:
+                other_key = ranges[last_range][0]
+                for key in ranges[entry_range]:
+                    self._add_issue(
+                        "overlap",
+                        "Entry overlaps entry {} of record {}.".format(
+                            other_key[1], other_key[0]
+                        ),
+                        key
+                    )
+            if offset + size > last_end:
+                last_range = entry_range
+                last_end = offset + size
+
+    def _check_contents(self, ranges, workers):
+        """ Check the content of the DCX entries in a pool of workers
+        processes, or in this process if workers is 1. """
+        batches = self._get_batches(ranges)
+        if workers > 1:
+            init_args = (self.archive.bdt.file_path,)
+            with multiprocessing.Pool( workers, _init_verify_worker,
+                                       init_args ) as pool:
+                for result in pool.imap_unordered(_verify_batch_task, batches):
+                    self._add_batch_result(ranges, result)
+        else:
+            for batch in batches:
+                result = _verify_batch(self.archive.bdt, batch)
+                self._add_batch_result(ranges, result)
+
+    def _get_batches(self, ranges):
+        """ Generate batches of (offset, size, probe) in offset order for
+        _verify_batch; probe is True for ranges that may not be DCX. """
+        batch = []
+        batch_size = 0
+        for entry_range in sorted(ranges):
+            probe = self._should_probe(ranges[entry_range])
+            if probe is None:
+                continue
+            batch.append(entry_range + (probe,))
+            batch_size += entry_range[1]
+            if batch_size >= self.BATCH_SIZE:
+                yield batch
+                batch = []
+                batch_size = 0
+        if batch:
+            yield batch
+
+    def _should_probe(self, keys):
+        """ Return False if entries of keys are named *.dcx, True if none of
+        them has a known name, and None if they don't need to be read. """
+        names = []
+        for record_index, entry_index in keys:
+            record = self.archive.bhd.records[record_index]
+            names.append(self.archive.filelist.get(
+                record.entries[entry_index].hash
+            ))
+        if any(name is not None and name.endswith(".dcx") for name in names):
+            return False
+        if all(name is None for name in names):
+            return True
+        return None
+
+    def _add_batch_result(self, ranges, result):
+        num_ranges, num_dcx, bytes_read, errors = result
+        self.num_dcx += num_dcx
+        self.bytes_read += bytes_read
+        PROGRESS.count(num_ranges, bytes_read)
+        for offset, size, message in errors:
+            for key in ranges[(offset, size)]:
+                self._add_issue("dcx", message, key)
+
+    @property
+    def throughput(self):
+        """ Bytes read per second by the last verification. """
+        if self.duration <= 0.0:
+            return 0.0
+        return self.bytes_read / self.duration
+
+    def get_report(self):
+        """ Return a dict with the results of the last verification. """
+        return {
+            "bdt": self.archive.bdt.file_path,
+            "valid": not self.issues,
+            "num_entries": self._get_num_entries(),
+            "num_dcx": self.num_dcx,
+            "bytes_read": self.bytes_read,
+            "duration": self.duration,
+            "throughput": self.throughput,
+            "issues": self.issues
+        }
+
+    def save_report(self, report_path):
+        """ Save the report as JSON at report_path, return True on success. """
+        try:
+            with open(report_path, "w") as report_file:
+                json.dump(self.get_report(), report_file, indent = 2)
+        except OSError as exc:
+            LOG.error("Error writing {}: {}".format(report_path, exc))
+            return False
+        return True
+
+
+# BDT used by each verification worker process, with its own handle.
+_WORKER_BDT = None
+
+def _init_verify_worker(bdt_path):
+    global _WORKER_BDT
+    init_worker_logging()
+    _WORKER_BDT = Bdt()
+    _WORKER_BDT.open(bdt_path)
+
+def _verify_batch_task(batch):
+    return _verify_batch(_WORKER_BDT, batch)
+
+def _verify_batch(bdt, batch):
+    """ Check the DCX ranges of a batch made by ArchiveVerifier._get_batches.
+    Return a tuple (number of ranges, number of DCX checked, bytes read,
+    errors), errors being a list of (offset, size, message). """
+    bytes_read = 0
+    to_read = []
+    for offset, size, probe in batch:
+        if probe:
+            magic = bdt.read_entry(offset, 4)
+            bytes_read += len(magic)
+            if not Dcx.is_dcx(magic):
+                continue
+        to_read.append((offset, size, (offset, size)))
+
+    errors = []
+    for entry_range, payload in ReadPlanner().read(bdt, to_read):
+        if payload is None:
+            payload = bdt.read_entry(*entry_range)
+        bytes_read += len(payload)
+        message = _check_dcx(payload)
+        if message is not None:
+            errors.append(entry_range + (message,))
+    return len(batch), len(to_read), bytes_read, errors
+
+def _check_dcx(data):
+    """ Return an error message if data is not a valid DCX, else None. """
+    dcx = Dcx()
+    if not dcx.load_data(data):
+        if dcx.is_valid():
+            return "DCX headers are truncated."
+        return "Invalid DCX headers."
+    if len(dcx.zlib_data) != dcx.sizes.compressed_size:
+        return "Zlib data is truncated ({} bytes instead of {}).".format(
+            len(dcx.zlib_data), dcx.sizes.compressed_size
+        )
+    try:
+        inflated_size = _get_inflated_size(dcx.zlib_data)
+    except zlib.error as exc:
+        return "Zlib error: {}".format(exc)
+    if inflated_size is None:
+        return "Zlib stream is incomplete."
+    if inflated_size != dcx.sizes.uncompressed_size:
+        return "Inflated to {} bytes instead of {}.".format(
+            inflated_size, dcx.sizes.uncompressed_size
+        )
+    return None
+
+def _get_inflated_size(zlib_data):
+    """ Return the size of the inflated zlib data, or None if the stream does
+    not end; data is inflated in chunks that are not kept. """
+    decompressor = zlib.decompressobj()
+    inflated_size = 0
+    data = zlib_data
+    while data:
+        chunk = decompressor.decompress(
+            data, ArchiveVerifier.INFLATE_CHUNK_SIZE
+        )
+        inflated_size += len(chunk)
+        data = decompressor.unconsumed_tail
+        if decompressor.eof or not chunk:
+            break
+    inflated_size += len(decompressor.flush())
+    if not decompressor.eof:
+        return None
+    return inflated_size
@@ -0,0 +1,76 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import sieglib.bdt
+from sieglib.bdt import Bdt
+
+
+CONTENT = bytes(range(256)) * 64
+
+
+class BdtTests(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.bdt_path = os.path.join(self.temp_dir.name, "test.bdt")
+        with open(self.bdt_path, "wb") as bdt_file:
+            bdt_file.write(Bdt.FULL_MAGIC + CONTENT)
+        self.bdt = Bdt()
+        self.bdt.open(self.bdt_path)
+        self.output_path = os.path.join(self.temp_dir.name, "output")
+
+    def tearDown(self):
+        self.bdt.close()
+        self.temp_dir.cleanup()
+
+    def _copy_entry(self, position, size):
+        with open(self.output_path, "wb") as output_file:
+            copied = self.bdt.copy_entry(position, size, output_file)
+        with open(self.output_path, "rb") as output_file:
+            return copied, output_file.read()
+
+    def test_copy_entry(self):
+        position = len(Bdt.FULL_MAGIC) + 100
+        copied, content = self._copy_entry(position, 5000)
+        self.assertEqual(copied, 5000)
+        self.assertEqual(content, CONTENT[100:5100])
+
+    def test_copy_entry_in_chunks(self):
+        position = len(Bdt.FULL_MAGIC) + 7
+        with mock.patch.object(sieglib.bdt, "KERNEL_COPY_FUNCTIONS", []):
+            with mock.patch.object(Bdt, "CHUNK_SIZE", 1000):
+                copied, content = self._copy_entry(position, 5000)
+        self.assertEqual(copied, 5000)
+        self.assertEqual(content, CONTENT[7:5007])
+
+    def test_copy_entry_past_end(self):
+        position = len(Bdt.FULL_MAGIC) + len(CONTENT) - 10
+        copied, content = self._copy_entry(position, 100)
+        self.assertEqual(copied, 10)
+        self.assertEqual(content, CONTENT[-10:])
+
+    def test_read_entry_mmap(self):
+        mapped_bdt = Bdt()
+        mapped_bdt.open(self.bdt_path, use_mmap = True)
+        position = len(Bdt.FULL_MAGIC) + 300
+        view = mapped_bdt.read_entry(position, 1000)
+        self.assertIsInstance(view, memoryview)
+        self.assertEqual(view, self.bdt.read_entry(position, 1000))
+        self.assertEqual(len(mapped_bdt.read_entry(position, len(CONTENT))),
+                         len(CONTENT) - 300)
+        mapped_bdt.close()
+        self.assertEqual(bytes(view), CONTENT[300:1300])
+        view.release()
+
+    def test_open_mmap_error(self):
+        mapped_bdt = Bdt()
+        with mock.patch("mmap.mmap", side_effect = OSError("no map")):
+            mapped_bdt.open(self.bdt_path, use_mmap = True)
+        self.assertFalse(mapped_bdt.opened)
+        self.assertIsNone(mapped_bdt.bdt_file)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,9 @@
+import os
+import struct
+import tempfile
 import unittest
 
-from sieglib.bhd import BhdDataEntry
+from sieglib.bhd import Bhd, BhdHeader, BhdRecord, BhdDataEntry
 
 
 EXAMPLE_NAME = "/chr/c0000.anibnd.dcx"
@@ -12,6 +15,71 @@ class BhdTests(unittest.TestCase):
     def test_hash_name(self):
         self.assertEquals(BhdDataEntry.hash_name(EXAMPLE_NAME), EXAMPLE_HASH)
 
+    def test_compact_load(self):
+        bhd = Bhd()
+        bhd.header = BhdHeader()
+        bhd.header.num_records = 3
+        bhd.records = [BhdRecord() for _ in range(3)]
+        for index in range(10):
+            entry = BhdDataEntry()
+            entry.hash, entry.size, entry.offset = index * 7, index, index * 16
+            bhd.records[index % 2 * 2].entries.append(entry)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            bhd_path = os.path.join(temp_dir, "test.bhd5")
+            bhd.save(bhd_path)
+            compact_bhd = Bhd()
+            self.assertTrue(compact_bhd.load(bhd_path, compact = True))
+
+        table = compact_bhd.table
+        self.assertEqual(len(table), 10)
+        self.assertEqual(list(table.record_indices), [0] * 5 + [2] * 5)
+        self.assertEqual(list(table.hashes[5:]), [7, 21, 35, 49, 63])
+        records = table.get_records()
+        self.assertEqual(len(records), 3)
+        for record, compact_record in zip(bhd.records, records):
+            self.assertEqual(
+                [(e.hash, e.size, e.offset) for e in record.entries],
+                [(e.hash, e.size, e.offset) for e in compact_record.entries]
+            )
+
+    def test_save(self):
+        bhd = Bhd()
+        bhd.header = BhdHeader()
+        bhd.header.num_records = 3
+        bhd.records = [BhdRecord() for _ in range(3)]
+        for index in range(5):
+            entry = BhdDataEntry()
+            entry.hash, entry.size, entry.offset = index * 7, index, index * 16
+            bhd.records[index % 2 * 2].entries.append(entry)
+        data = bhd.generate_data()
+        self.assertEqual(len(data), 24 + 3 * 8 + 5 * 16)
+        self.assertEqual(
+            list(struct.iter_unpack("<2I", data[24:48])),
+            [(3, 48), (0, 96), (2, 96)]
+        )
+        self.assertEqual(
+            struct.unpack_from("<4I", data, 48 + 16), (14, 2, 32, 0)
+        )
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            bhd_path = os.path.join(temp_dir, "test.bhd5")
+            self.assertTrue(bhd.save(bhd_path))
+            # Records of a previous load must not be saved again.
+            other_path = os.path.join(temp_dir, "other.bhd5")
+            other_bhd = Bhd()
+            other_bhd.header = BhdHeader()
+            other_bhd.header.num_records = 1
+            other_bhd.records = [BhdRecord()]
+            self.assertTrue(other_bhd.save(other_path))
+            compact_bhd = Bhd()
+            self.assertTrue(compact_bhd.load(other_path))
+            self.assertTrue(compact_bhd.load(bhd_path, compact = True))
+            self.assertEqual(compact_bhd.records, [])
+            with open(bhd_path, "rb") as bhd_file:
+                self.assertEqual(bhd_file.read(), data)
+        self.assertEqual(compact_bhd.generate_data(), data)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,39 @@
+import io
+import unittest
+import zlib
+
+from sieglib.dcx import Dcx
+
+
+CONTENT = b"DCX test content " * 50
+
+
+class DcxTests(unittest.TestCase):
+
+    def test_load_data(self):
+        dcx = Dcx()
+        dcx.zlib_data = zlib.compress(CONTENT, 9)
+        dcx.sizes.uncompressed_size = len(CONTENT)
+        dcx.sizes.compressed_size = len(dcx.zlib_data)
+        dcx_io = io.BytesIO()
+        dcx._save_header(dcx_io)
+        dcx._save_content(dcx_io)
+
+        loaded_dcx = Dcx()
+        self.assertTrue(loaded_dcx.load_data(dcx_io.getvalue()))
+        self.assertEqual(loaded_dcx.sizes.uncompressed_size, len(CONTENT))
+        self.assertEqual(zlib.decompress(loaded_dcx.zlib_data), CONTENT)
+
+    def test_load_data_truncated(self):
+        self.assertFalse(Dcx().load_data(b"\x00DCX"))
+
+    def test_load_data_invalid(self):
+        dcx = Dcx()
+        dcx.zlib_data = zlib.compress(CONTENT, 9)
+        dcx.parameters.method = b"EDGE"
+        self.assertFalse(Dcx().load_data(dcx.generate_data()))
+        self.assertFalse(Dcx().load_data(b"DCX\x00" + bytes(60)))
+
+
+if __name__ == "__main__":
+    unittest.main()
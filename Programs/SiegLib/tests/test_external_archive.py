@@ -0,0 +1,501 @@
+import io
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+
+from sieglib.bdt import Bdt
+from sieglib.bhd import Bhd, BhdHeader, BhdRecord, BhdDataEntry
+from sieglib.dcx import Dcx
+from sieglib.entry_filter import EntryFilter
+from sieglib.export_journal import ExportJournal
+from sieglib.export_scheduler import ExportScheduler
+from sieglib.external_archive import ExternalArchive
+from sieglib.filelist import Filelist
+from sieglib.log import LOG, start_async_logging, stop_async_logging
+from sieglib.manifest import Manifest
+
+
+PARAM_CONTENT = b"param data" * 100
+
+# Record index -> list of (name, content) to store in the test archive.
+ARCHIVE_CONTENT = {
+    0: [ ("/chr/c0000.anibnd", b"anibnd data" * 10),
+         ("/chr/c0001.chrbnd", b"chrbnd data" * 3) ],
+    1: [ ("/map/m10_00_00_00.msb", b"msb data" * 7) ],
+    2: [ ("/param/drawparam.parambnd.dcx", Dcx.compress_data(PARAM_CONTENT)) ],
+    3: []
+}
+UNNAMED_HASH = 0x192E66A4
+UNNAMED_CONTENT = b"unknown"
+
+
+def write_test_archive(bhd_path):
+    """ Write a small BHD/BDT pair at bhd_path, return the filelist. """
+    filelist = {}
+    bdt = Bdt()
+    bdt.open(os.path.splitext(bhd_path)[0] + ".bdt", "wb")
+    bdt.make_header()
+
+    bhd = Bhd()
+    bhd.records = [BhdRecord() for _ in ARCHIVE_CONTENT]
+    for index, files in ARCHIVE_CONTENT.items():
+        for name, content in files:
+            entry_hash = BhdDataEntry.hash_name(name)
+            filelist[entry_hash] = name
+            _add_entry(bdt, bhd.records[index], entry_hash, content)
+    _add_entry(bdt, bhd.records[1], UNNAMED_HASH, UNNAMED_CONTENT)
+    bdt.close()
+
+    bhd.header = BhdHeader()
+    bhd.header.num_records = len(bhd.records)
+    bhd.save(bhd_path)
+    return filelist
+
+def _add_entry(bdt, record, entry_hash, content):
+    entry = BhdDataEntry()
+    entry.hash = entry_hash
+    entry.offset = bdt.bdt_file.tell()
+    entry.size = bdt.bdt_file.write(content)
+    bdt.bdt_file.write(b"\x00" * (-entry.size % 16))
+    record.entries.append(entry)
+
+
+class ExternalArchiveTests(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.bhd_path = os.path.join(self.temp_dir, "dvdbnd.bhd5")
+        self.filelist = write_test_archive(self.bhd_path)
+        self.archive = ExternalArchive()
+        self.assertTrue(self.archive.load(self.bhd_path))
+        self.archive.filelist = Filelist(self.filelist)
+
+    def tearDown(self):
+        self.archive.bdt.close()
+        shutil.rmtree(self.temp_dir)
+
+    def test_get_entry(self):
+        entry = self.archive.get_entry("/chr/c0001.chrbnd")
+        self.assertIsNotNone(entry)
+        self.assertEqual(entry.size, len(ARCHIVE_CONTENT[0][1][1]))
+        self.assertIs(self.archive.get_entry(entry.hash), entry)
+        self.assertIs( self.archive.get_entry("{:08X}".format(UNNAMED_HASH)),
+                       self.archive.get_entry(UNNAMED_HASH) )
+        self.assertIsNone(self.archive.get_entry("/not/in/archive"))
+
+    def test_is_entry_valid(self):
+        for record in self.archive.bhd.records:
+            for entry in record.entries:
+                self.assertTrue(self.archive.is_entry_valid(entry))
+        foreign_entry = BhdDataEntry()
+        foreign_entry.hash = UNNAMED_HASH
+        self.assertFalse(self.archive.is_entry_valid(foreign_entry))
+
+    def test_open(self):
+        name, content = ARCHIVE_CONTENT[0][0]
+        with self.archive.open(name) as entry_file:
+            self.assertEqual(entry_file.read(6), content[:6])
+            entry_file.seek(-4, io.SEEK_END)
+            self.assertEqual(entry_file.read(), content[-4:])
+            entry_file.seek(0)
+            self.assertEqual(entry_file.read(), content)
+        param_name, param_dcx = ARCHIVE_CONTENT[2][0]
+        with self.archive.open(param_name) as param_file:
+            self.assertEqual(param_file.read(), param_dcx)
+        with self.archive.open(param_name, decompress = True) as param_file:
+            self.assertEqual(param_file.read(), PARAM_CONTENT)
+        self.assertIsNone(self.archive.open("/not/in/archive"))
+
+    def test_iter_entries(self):
+        items = list(self.archive.iter_entries())
+        expected = [
+            (index, name, content)
+            for index, files in ARCHIVE_CONTENT.items()
+            for name, content in files
+        ]
+        expected.insert(3, (1, "{:08X}".format(UNNAMED_HASH), UNNAMED_CONTENT))
+        self.assertEqual(
+            [(item.record_index, item.name, bytes(item.payload))
+             for item in items],
+            expected
+        )
+        self.assertFalse(any(item.decompressed for item in items))
+        for readahead in (0, 2):
+            items = list(self.archive.iter_entries(True, readahead))
+            param_item = items[4]
+            self.assertTrue(param_item.decompressed)
+            self.assertEqual(param_item.payload, PARAM_CONTENT)
+            self.assertEqual( param_item.hash,
+                              BhdDataEntry.hash_name(param_item.name) )
+
+    def test_export_all_files(self):
+        output_dir = os.path.join(self.temp_dir, "export")
+        self.archive.export_all_files(output_dir)
+        for files in ARCHIVE_CONTENT.values():
+            for name, content in files:
+                if name.endswith(".dcx"):
+                    continue
+                file_path = os.path.join(output_dir, name.lstrip("/"))
+                with open(file_path, "rb") as exported_file:
+                    self.assertEqual(exported_file.read(), content)
+        self.assertEqual(
+            self.archive.records_map[1],
+            ["/map/m10_00_00_00.msb", "{:08X}".format(UNNAMED_HASH)]
+        )
+        self.assertEqual( self.archive.decompressed_list,
+                          ["/param/drawparam.parambnd"] )
+        param_path = os.path.join(output_dir, "param", "drawparam.parambnd")
+        with open(param_path, "rb") as param_file:
+            self.assertEqual(param_file.read(), PARAM_CONTENT)
+        self.assertFalse(os.path.exists(param_path + ".dcx"))
+
+    def test_export_all_files_workers(self):
+        serial_dir = os.path.join(self.temp_dir, "serial")
+        parallel_dir = os.path.join(self.temp_dir, "parallel")
+        self.archive.export_all_files(serial_dir)
+        self.archive.export_all_files(parallel_dir, workers = 2)
+        for name in ( ExternalArchive.RECORDS_MAP_NAME,
+                      ExternalArchive.DECOMPRESSED_LIST_NAME ):
+            with open(os.path.join(serial_dir, name), "rb") as serial_file:
+                with open(os.path.join(parallel_dir, name), "rb") as par_file:
+                    self.assertEqual(serial_file.read(), par_file.read())
+        self.assertEqual(_list_tree(serial_dir), _list_tree(parallel_dir))
+
+    def test_export_all_files_workers_logging(self):
+        if multiprocessing.get_start_method() != "fork":
+            self.skipTest("workers only inherit handlers when forked")
+        # Cut the last entry (the unnamed one, 7 bytes padded to 16).
+        bdt_path = os.path.splitext(self.bhd_path)[0] + ".bdt"
+        os.truncate(bdt_path, os.stat(bdt_path).st_size - 16)
+        log_path = os.path.join(self.temp_dir, "export.log")
+        handler = logging.FileHandler(log_path)
+        LOG.addHandler(handler)
+        start_async_logging()
+        try:
+            output_dir = os.path.join(self.temp_dir, "export")
+            self.archive.export_all_files(output_dir, workers = 2)
+        finally:
+            stop_async_logging()
+            LOG.removeHandler(handler)
+            handler.close()
+        with open(log_path, "r") as log_file:
+            log_content = log_file.read()
+        self.assertIn(
+            "Tried to read 7 bytes but only 0 were available", log_content
+        )
+        self.assertIn("Export done: 4 files, 1 failed", log_content)
+
+    def test_export_all_files_offset_order(self):
+        record_dir = os.path.join(self.temp_dir, "record")
+        offset_dir = os.path.join(self.temp_dir, "offset")
+        self.archive.export_all_files(record_dir)
+        self.archive.export_all_files(offset_dir, offset_order = True)
+        self.assertEqual(_list_tree(record_dir), _list_tree(offset_dir))
+
+    def test_export_all_files_resume(self):
+        full_dir = os.path.join(self.temp_dir, "full")
+        self.archive.export_all_files(full_dir)
+        self.assertFalse(os.path.exists(
+            os.path.join(full_dir, ExportJournal.FILE_NAME)
+        ))
+
+        # Journal of an interrupted export: the first entry is done, the next
+        # line has a wrong hash and the last one has been cut.
+        resumed_dir = os.path.join(self.temp_dir, "resumed")
+        name = ARCHIVE_CONTENT[0][0][0]
+        os.makedirs(os.path.join(resumed_dir, "chr"))
+        with open(os.path.join(resumed_dir, name.lstrip("/")), "wb") as file:
+            file.write(b"already exported")
+        journal_lines = "0 0 {:08X} e {}\n0 1 00000000 e {}\n1 0".format(
+            BhdDataEntry.hash_name(name), name, ARCHIVE_CONTENT[0][1][0]
+        )
+        journal_path = os.path.join(resumed_dir, ExportJournal.FILE_NAME)
+        with open(journal_path, "w") as journal_file:
+            journal_file.write(journal_lines)
+        self.archive.export_all_files(resumed_dir, resume = True)
+        self.assertFalse(os.path.exists(journal_path))
+        with open(os.path.join(resumed_dir, name.lstrip("/")), "rb") as file:
+            self.assertEqual(file.read(), b"already exported")
+        for name in ( ExternalArchive.RECORDS_MAP_NAME,
+                      ExternalArchive.DECOMPRESSED_LIST_NAME ):
+            with open(os.path.join(full_dir, name), "rb") as full_file:
+                with open(os.path.join(resumed_dir, name), "rb") as file:
+                    self.assertEqual(full_file.read(), file.read())
+
+    def test_export_all_files_resume_new_dir(self):
+        errors = []
+        handler = logging.Handler(logging.ERROR)
+        handler.emit = errors.append
+        LOG.addHandler(handler)
+        try:
+            output_dir = os.path.join(self.temp_dir, "export")
+            self.archive.export_all_files(output_dir, resume = True)
+        finally:
+            LOG.removeHandler(handler)
+        self.assertEqual(errors, [])
+        self.assertEqual(len(self.archive.records_map[1]), 2)
+
+    def test_export_all_files_filter(self):
+        entry_filter = EntryFilter(
+            patterns = ["/CHR/*.anibnd"], extensions = ["parambnd.dcx"],
+            hashes = [UNNAMED_HASH]
+        )
+        filtered_out = self.archive.get_filtered_out(entry_filter)
+        self.assertEqual(filtered_out, {(0, 1), (1, 0)})
+        output_dir = os.path.join(self.temp_dir, "export")
+        self.archive.export_all_files(output_dir, entry_filter = entry_filter)
+        self.assertEqual(sorted(_list_tree(output_dir)), [
+            "192E66A4", os.path.join("chr", "c0000.anibnd"),
+            "decompressed.json", os.path.join("param", "drawparam.parambnd"),
+            "records.json"
+        ])
+        self.assertEqual(self.archive.records_map[1], ["192E66A4"])
+
+    def test_export_all_files_filter_resume(self):
+        # Journal of an interrupted export without filter.
+        output_dir = os.path.join(self.temp_dir, "export")
+        journal_lines = ""
+        for index, files in ARCHIVE_CONTENT.items():
+            if not files:
+                continue
+            name, content = files[0]
+            file_path = os.path.join(output_dir, name.lstrip("/"))
+            os.makedirs(os.path.dirname(file_path))
+            with open(file_path, "wb") as exported_file:
+                exported_file.write(content)
+            journal_lines += "{} 0 {:08X} e {}\n".format(
+                index, BhdDataEntry.hash_name(name), name
+            )
+        journal_path = os.path.join(output_dir, ExportJournal.FILE_NAME)
+        with open(journal_path, "w") as journal_file:
+            journal_file.write(journal_lines)
+        entry_filter = EntryFilter(patterns = ["/chr/*"])
+        self.archive.export_all_files(
+            output_dir, resume = True, entry_filter = entry_filter
+        )
+        self.assertEqual(self.archive.records_map[0], [
+            "/chr/c0000.anibnd", "/chr/c0001.chrbnd"
+        ])
+        self.assertEqual(self.archive.records_map[1], [])
+        self.assertEqual(self.archive.records_map[2], [])
+        self.assertEqual(self.archive.decompressed_list, [])
+
+    def test_export_all_files_invalid_dcx(self):
+        bhd_path = os.path.join(self.temp_dir, "invalid.bhd5")
+        bdt = Bdt()
+        bdt.open(os.path.splitext(bhd_path)[0] + ".bdt", "wb")
+        bdt.make_header()
+        bhd = Bhd()
+        bhd.records = [BhdRecord()]
+        broken_dcx = bytearray(Dcx.compress_data(PARAM_CONTENT))
+        broken_dcx[4:8] = b"\xFF" * 4  # Invalid DCX header value.
+        contents = {
+            "/x/readme.txt.dcx": b"plain text",
+            "/x/broken.bin.dcx": bytes(broken_dcx)
+        }
+        filelist = {}
+        for name, content in contents.items():
+            entry_hash = BhdDataEntry.hash_name(name)
+            filelist[entry_hash] = name
+            _add_entry(bdt, bhd.records[0], entry_hash, content)
+        bdt.close()
+        bhd.header = BhdHeader()
+        bhd.header.num_records = 1
+        bhd.save(bhd_path)
+
+        archive = ExternalArchive()
+        self.assertTrue(archive.load(bhd_path))
+        archive.filelist = Filelist(filelist)
+        expected_tree = {
+            os.path.normpath(name.lstrip("/")): content
+            for name, content in contents.items()
+        }
+        for kwargs in ({}, {"offset_order": True}, {"workers": 2}):
+            output_dir = os.path.join(self.temp_dir, str(kwargs))
+            archive.export_all_files(output_dir, **kwargs)
+            self.assertEqual(archive.decompressed_list, [])
+            tree = _list_tree(output_dir)
+            for name in ( ExternalArchive.RECORDS_MAP_NAME,
+                          ExternalArchive.DECOMPRESSED_LIST_NAME ):
+                del tree[name]
+            self.assertEqual(tree, expected_tree)
+        archive.bdt.close()
+
+    def test_export_scheduler(self):
+        serial_dir = os.path.join(self.temp_dir, "serial")
+        self.archive.export_all_files(serial_dir)
+        other_archive = ExternalArchive()
+        self.assertTrue(other_archive.load(self.bhd_path, use_mmap = True))
+        other_archive.filelist = Filelist(self.filelist)
+        scheduler = ExportScheduler(workers = 3, max_in_flight = 256)
+        for index, archive in enumerate((self.archive, other_archive)):
+            output_dir = os.path.join(self.temp_dir, str(index))
+            scheduler.add_archive(archive, output_dir)
+        scheduler.run()
+        other_archive.bdt.close()
+        self.assertEqual(scheduler.num_files, 10)
+        for index in range(2):
+            output_dir = os.path.join(self.temp_dir, str(index))
+            self.assertEqual(_list_tree(output_dir), _list_tree(serial_dir))
+
+    def test_import_files(self):
+        export_dir = os.path.join(self.temp_dir, "export")
+        self.archive.export_all_files(export_dir)
+        with open(os.path.join(export_dir, "unknown.bin"), "wb") as unknown:
+            unknown.write(b"not in any record")
+
+        new_bhd_path = os.path.join(self.temp_dir, "new", "dvdbnd.bhd5")
+        os.makedirs(os.path.dirname(new_bhd_path))
+        new_archive = ExternalArchive()
+        self.assertTrue(new_archive.import_files(export_dir, new_bhd_path))
+        new_archive.bdt.close()
+        self.assertEqual(new_archive.unknown_files, ["/unknown.bin"])
+
+        self.assertTrue(new_archive.load(new_bhd_path))
+        new_archive.filelist = self.archive.filelist
+        reexport_dir = os.path.join(self.temp_dir, "reexport")
+        new_archive.export_all_files(reexport_dir)
+        new_archive.bdt.close()
+        # Entries order in a record depends on the directory walk.
+        for index, files in self.archive.records_map.items():
+            self.assertEqual(sorted(new_archive.records_map[index]), files)
+        reference_dir = os.path.join(self.temp_dir, "reference")
+        self.archive.export_all_files(reference_dir)
+        reexported_tree = _list_tree(reexport_dir)
+        reference_tree = _list_tree(reference_dir)
+        del reexported_tree[ExternalArchive.RECORDS_MAP_NAME]
+        del reference_tree[ExternalArchive.RECORDS_MAP_NAME]
+        self.assertEqual(reexported_tree, reference_tree)
+
+    def test_import_files_workers(self):
+        bhd_paths = []
+        for workers in (1, 2):
+            export_dir = os.path.join(self.temp_dir, "export{}".format(workers))
+            self.archive.export_all_files(export_dir)
+            bhd_path = export_dir + ".bhd5"
+            new_archive = ExternalArchive()
+            new_archive.import_files(export_dir, bhd_path, workers = workers)
+            bhd_paths.append(bhd_path)
+        for extension in (".bhd5", ".bdt"):
+            contents = []
+            for bhd_path in bhd_paths:
+                with open(os.path.splitext(bhd_path)[0] + extension, "rb") as f:
+                    contents.append(f.read())
+            self.assertEqual(contents[0], contents[1])
+
+    def test_import_files_dedup(self):
+        export_dir = os.path.join(self.temp_dir, "export")
+        self.archive.export_all_files(export_dir)
+        duplicate = ARCHIVE_CONTENT[0][0][1]
+        with open(os.path.join(export_dir, "chr", "c0001.chrbnd"), "wb") as f:
+            f.write(duplicate)
+        expected_tree = _list_tree(export_dir)
+
+        new_bhd_path = os.path.join(self.temp_dir, "dedup.bhd5")
+        new_archive = ExternalArchive()
+        new_archive.import_files(export_dir, new_bhd_path, dedup = True)
+        self.assertEqual(new_archive.bdt.bytes_saved, len(duplicate))
+        c0000 = new_archive.get_entry("/chr/c0000.anibnd")
+        c0001 = new_archive.get_entry("/chr/c0001.chrbnd")
+        self.assertEqual(c0000.offset, c0001.offset)
+
+        self.assertTrue(new_archive.load(new_bhd_path))
+        new_archive.filelist = Filelist(self.filelist)
+        reexport_dir = os.path.join(self.temp_dir, "reexport")
+        new_archive.export_all_files(reexport_dir)
+        new_archive.bdt.close()
+        reexported_tree = _list_tree(reexport_dir)
+        for tree in (reexported_tree, expected_tree):
+            del tree[ExternalArchive.RECORDS_MAP_NAME]
+        self.assertEqual(reexported_tree, expected_tree)
+
+    def test_update_files(self):
+        export_dir = os.path.join(self.temp_dir, "export")
+        self.archive.export_all_files(export_dir, write_manifest = True)
+        self.archive.bdt.close()
+        bdt_path = os.path.splitext(self.bhd_path)[0] + ".bdt"
+        bdt_size = os.stat(bdt_path).st_size
+
+        new_param = b"modified param" * 20
+        param_path = os.path.join(export_dir, "param", "drawparam.parambnd")
+        with open(param_path, "wb") as param_file:
+            param_file.write(new_param)
+        msb_path = os.path.join(export_dir, "map", "m10_00_00_00.msb")
+        os.utime(msb_path, ns = (0, 0))  # touched but unchanged
+
+        updated_archive = ExternalArchive()
+        self.assertTrue(updated_archive.update_files(export_dir, self.bhd_path))
+        self.assertGreater(os.stat(bdt_path).st_size, bdt_size)
+        self.assertLess(os.stat(bdt_path).st_size, bdt_size + 1024)
+
+        self.assertTrue(self.archive.load(self.bhd_path))
+        self.archive.filelist = Filelist(self.filelist)
+        reexport_dir = os.path.join(self.temp_dir, "reexport")
+        self.archive.export_all_files(reexport_dir)
+        with open(os.path.join(reexport_dir, "param", "drawparam.parambnd"),
+                  "rb") as param_file:
+            self.assertEqual(param_file.read(), new_param)
+        exported_tree = _list_tree(export_dir)
+        del exported_tree[Manifest.FILE_NAME]
+        self.assertEqual(_list_tree(reexport_dir), exported_tree)
+
+    def test_build_overlay(self):
+        override_dir = os.path.join(self.temp_dir, "overrides")
+        os.makedirs(os.path.join(override_dir, "param"))
+        new_param = b"overlay param" * 20
+        param_path = os.path.join(override_dir, "param", "drawparam.parambnd")
+        with open(param_path, "wb") as param_file:
+            param_file.write(new_param)
+        with open(os.path.join(override_dir, "192E66A4"), "wb") as unnamed:
+            unnamed.write(b"new unnamed")
+
+        overlay_bhd_path = os.path.join(self.temp_dir, "overlay.bhd5")
+        self.assertTrue(
+            self.archive.build_overlay(override_dir, overlay_bhd_path)
+        )
+        reference_dir = os.path.join(self.temp_dir, "reference")
+        self.archive.export_all_files(reference_dir)
+
+        overlay_archive = ExternalArchive()
+        self.assertTrue(overlay_archive.load(overlay_bhd_path))
+        overlay_archive.filelist = Filelist(self.filelist)
+        overlay_dir = os.path.join(self.temp_dir, "overlay")
+        overlay_archive.export_all_files(overlay_dir)
+        overlay_archive.bdt.close()
+
+        overlay_tree = _list_tree(overlay_dir)
+        reference_tree = _list_tree(reference_dir)
+        param_rel_path = os.path.join("param", "drawparam.parambnd")
+        self.assertEqual(overlay_tree.pop(param_rel_path), new_param)
+        self.assertEqual(overlay_tree.pop("192E66A4"), b"new unnamed")
+        del reference_tree[param_rel_path]
+        del reference_tree["192E66A4"]
+        self.assertEqual(overlay_tree, reference_tree)
+
+    def test_build_overlay_unknown_file(self):
+        override_dir = os.path.join(self.temp_dir, "overrides")
+        os.makedirs(override_dir)
+        with open(os.path.join(override_dir, "unknown.bin"), "wb") as unknown:
+            unknown.write(b"unknown")
+        overlay_bhd_path = os.path.join(self.temp_dir, "overlay.bhd5")
+        self.assertFalse(
+            self.archive.build_overlay(override_dir, overlay_bhd_path)
+        )
+
+
+def _list_tree(directory):
+    """ Return a dict of relative paths to file contents in directory. """
+    tree = {}
+    for root, _, files in os.walk(directory):
+        for file_name in files:
+            file_path = os.path.join(root, file_name)
+            with open(file_path, "rb") as tree_file:
+                tree[os.path.relpath(file_path, directory)] = tree_file.read()
+    return tree
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+import os
+import tempfile
+import unittest
+
+from sieglib.bhd import BhdDataEntry
+from sieglib.filelist import Filelist
+from sieglib.hashmap_cache import HashmapCache
+
+
+EXAMPLE_NAME = "/chr/c0000.anibnd.dcx"
+EXAMPLE_HASH = 0xF8630FB1
+
+
+class FilelistTests(unittest.TestCase):
+
+    def test_reverse_index(self):
+        filelist = Filelist({ 1: "/a", 2: "/b" })
+        self.assertEqual(filelist.get_hash("/b"), 2)
+        filelist[2] = "/c"
+        self.assertFalse(filelist.has_name("/b"))
+        self.assertEqual(filelist.get_hash("/c"), 2)
+        del filelist[1]
+        self.assertIsNone(filelist.get_hash("/a"))
+        self.assertEqual(filelist.add_name(EXAMPLE_NAME), EXAMPLE_HASH)
+        self.assertEqual(filelist.get(EXAMPLE_HASH), EXAMPLE_NAME)
+
+    def test_save_and_load(self):
+        filelist = Filelist()
+        for name in ("/a.dcx", "/b/c.tpf", EXAMPLE_NAME):
+            filelist.add_name(name)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            hashmap_path = os.path.join(temp_dir, "test.hashmap.json")
+            self.assertTrue(filelist.save(hashmap_path))
+            loaded_filelist = Filelist()
+            self.assertTrue(loaded_filelist.load(hashmap_path))
+        self.assertEqual(dict(loaded_filelist.items()), dict(filelist.items()))
+        self.assertEqual( loaded_filelist.get_hash("/b/c.tpf"),
+                          BhdDataEntry.hash_name("/b/c.tpf") )
+
+    def test_load_with_cache(self):
+        filelist = Filelist()
+        for name in ("/a.dcx", "/b/c.tpf", EXAMPLE_NAME):
+            filelist.add_name(name)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            hashmap_path = os.path.join(temp_dir, "test.hashmap.json")
+            cache_path = HashmapCache.get_cache_path(hashmap_path)
+            self.assertTrue(filelist.save(hashmap_path))
+            cached = Filelist()
+            self.assertTrue(cached.load(hashmap_path, use_cache = True))
+            self.assertTrue(os.path.isfile(cache_path))
+            self.assertEqual(len(cached), 3)
+            self.assertEqual(cached.get(EXAMPLE_HASH), EXAMPLE_NAME)
+            self.assertIsNone(cached.get(EXAMPLE_HASH + 1))
+            self.assertTrue(cached.has_name("/b/c.tpf"))
+            self.assertFalse(cached.has_name("/b/c.dcx"))
+            self.assertEqual(dict(cached.items()), dict(filelist.items()))
+            self.assertIsNone(cached.cache)
+
+            # Changing the JSON invalidates the cache.
+            filelist.add_name("/d.bnd")
+            self.assertTrue(filelist.save(hashmap_path))
+            self.assertTrue(cached.load(hashmap_path, use_cache = True))
+            self.assertEqual(len(cached), 4)
+            self.assertEqual( cached.get_hash("/d.bnd"),
+                              BhdDataEntry.hash_name("/d.bnd") )
+            cached.cache.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
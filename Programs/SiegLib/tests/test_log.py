@@ -0,0 +1,30 @@
+import unittest
+from unittest import mock
+
+from sieglib.log import FileProgress
+
+
+class FileProgressTests(unittest.TestCase):
+
+    def test_summaries(self):
+        progress = FileProgress()
+        progress.interval = 0.0
+        with mock.patch("sieglib.log.LOG") as log:
+            progress.start("Export")
+            progress.file("Extracting", "/a", 1000)
+            progress.file("Extracting", "/b", 2000)
+            progress.fail()
+            progress.finish()
+            self.assertEqual(log.info.call_count, 3)
+            self.assertIn( "Export done: 2 files, 1 failed, 0.0 MB",
+                           log.info.call_args[0][0] )
+
+            log.reset_mock()
+            progress.verbose = True
+            progress.start("Export")
+            progress.file("Extracting", "/a", 1000)
+            log.info.assert_called_once_with("%s %s", "Extracting", "/a")
+
+
+if __name__ == "__main__":
+    unittest.main()
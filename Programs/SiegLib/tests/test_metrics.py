@@ -0,0 +1,33 @@
+import tracemalloc
+import unittest
+
+from sieglib.metrics import Metrics
+
+
+class MetricsTests(unittest.TestCase):
+
+    def test_measure(self):
+        metrics = Metrics()
+        with metrics.measure(Metrics.BDT_READ, 16):
+            pass
+        self.assertEqual(metrics.stages, {})
+
+        metrics.enable()
+        tracemalloc.start()
+        try:
+            for size in (16, 32):
+                with metrics.measure(Metrics.BDT_READ) as timer:
+                    data = bytearray(size * 1024)
+                    timer.num_bytes = len(data)
+        finally:
+            tracemalloc.stop()
+        report = metrics.get_report()
+        stage = report["stages"][Metrics.BDT_READ]
+        self.assertEqual(stage["count"], 2)
+        self.assertEqual(stage["bytes"], 48 * 1024)
+        self.assertGreaterEqual(stage["peak_memory"], 16 * 1024)
+        self.assertGreater(stage["wall"], 0.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,33 @@
+import unittest
+
+from sieglib.bhd import BhdDataEntry
+from sieglib.name_recovery import NameRecovery, NameTemplate
+
+
+class NameRecoveryTests(unittest.TestCase):
+
+    def test_parse(self):
+        template = NameTemplate.parse(
+            "/chr/c{0000-0012}.{ext}.dcx", { "ext": ["anibnd", "chrbnd"] }
+        )
+        self.assertEqual(len(template.parts), 3)
+        self.assertEqual(template.num_candidates, 26)
+        self.assertEqual( template.get_name((0, 12, 1)),
+                          "/chr/c0012.chrbnd.dcx" )
+        self.assertIsNone(NameTemplate.parse("/chr/{unknown}"))
+
+    def test_search(self):
+        names = ["/chr/c0003.anibnd.dcx", "/chr/c0010.CHRBND.dcx"]
+        targets = [BhdDataEntry.hash_name(name) for name in names]
+        template = NameTemplate.parse(
+            "/chr/c{0000-0012}.{anibnd,CHRBND}.dcx"
+        )
+        for workers in (1, 2):
+            recovery = NameRecovery(targets + [0x12345678])
+            self.assertEqual(recovery.search([template], workers), 2)
+            self.assertEqual( recovery.found_names,
+                              dict(zip(targets, names)) )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,49 @@
+import os
+import tempfile
+import unittest
+
+from sieglib.bdt import Bdt
+from sieglib.read_planner import ReadPlanner
+
+
+class ReadPlannerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.bdt_path = os.path.join(self.temp_dir.name, "test.bdt")
+        self.content = bytes(range(256)) * 4
+        with open(self.bdt_path, "wb") as bdt_file:
+            bdt_file.write(self.content)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_plan(self):
+        planner = ReadPlanner(max_gap = 16, max_read_size = 256)
+        entries = [ (512, 64, "c"), (0, 32, "a"), (40, 8, "b"),
+                    (512, 64, "d"), (600, 300, "e") ]
+        ranges, big_entries = planner.plan(entries)
+        self.assertEqual(
+            [(r.offset, r.size, [e[2] for e in r.entries]) for r in ranges],
+            [(0, 48, ["a", "b"]), (512, 64, ["c"]), (512, 64, ["d"])]
+        )
+        self.assertEqual(big_entries, [(600, 300, "e")])
+
+    def test_read(self):
+        planner = ReadPlanner(max_gap = 16, max_read_size = 256)
+        entries = [ (1000, 100, "past_end"), (40, 8, "b"), (0, 32, "a"),
+                    (600, 300, "big") ]
+        for use_mmap in (False, True):
+            bdt = Bdt()
+            bdt.open(self.bdt_path, use_mmap = use_mmap)
+            payloads = dict(planner.read(bdt, entries))
+            self.assertEqual(bytes(payloads["a"]), self.content[:32])
+            self.assertEqual(bytes(payloads["b"]), self.content[40:48])
+            self.assertEqual(bytes(payloads["past_end"]), self.content[1000:])
+            self.assertIsNone(payloads["big"])
+            del payloads
+            bdt.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
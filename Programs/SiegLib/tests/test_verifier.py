@@ -0,0 +1,103 @@
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from sieglib.bdt import Bdt
+from sieglib.bhd import Bhd, BhdHeader, BhdRecord, BhdDataEntry
+from sieglib.dcx import Dcx
+from sieglib.external_archive import ExternalArchive
+from sieglib.filelist import Filelist
+from sieglib.verifier import ArchiveVerifier
+
+
+class ArchiveVerifierTests(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.bhd_path = os.path.join(self.temp_dir, "dvdbnd.bhd5")
+        self.filelist = {}
+        self.bdt = Bdt()
+        self.bdt.open(os.path.splitext(self.bhd_path)[0] + ".bdt", "wb")
+        self.bdt.make_header()
+        self.bhd = Bhd()
+        self.bhd.records = [BhdRecord(), BhdRecord()]
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _add_file(self, record_index, name, content):
+        """ Import content in the BDT, return its BhdDataEntry. """
+        entry = BhdDataEntry()
+        entry.hash = BhdDataEntry.hash_name(name)
+        entry.offset, entry.size = self.bdt.import_data(content)
+        self.bhd.records[record_index].entries.append(entry)
+        self.filelist[entry.hash] = name
+        return entry
+
+    def _verify(self, workers = 1):
+        self.bdt.close()
+        self.bhd.header = BhdHeader()
+        self.bhd.header.num_records = len(self.bhd.records)
+        self.bhd.save(self.bhd_path)
+        archive = ExternalArchive()
+        self.assertTrue(archive.load(self.bhd_path))
+        archive.filelist = Filelist(self.filelist)
+        verifier = ArchiveVerifier(archive)
+        verifier.verify(workers)
+        archive.bdt.close()
+        return verifier
+
+    def test_verify_valid(self):
+        self._add_file(0, "/chr/c0000.anibnd", b"anibnd" * 10)
+        dcx_entry = self._add_file(
+            0, "/param/a.parambnd.dcx", Dcx.compress_data(b"a")
+        )
+        self.bhd.records[1].entries.append(dcx_entry)  # Deduplicated entry.
+        dcx_entry = self._add_file(
+            1, "/param/b.parambnd.dcx", Dcx.compress_data(b"b")
+        )
+        del self.filelist[dcx_entry.hash]  # Unnamed entries are probed.
+        for workers in (1, 2):
+            verifier = self._verify(workers)
+            report = verifier.get_report()
+            self.assertTrue(report["valid"])
+            self.assertEqual(report["num_entries"], 4)
+            self.assertEqual(report["num_dcx"], 2)
+
+    def test_verify_issues(self):
+        entry = self._add_file(0, "/chr/c0000.anibnd", b"anibnd" * 10)
+        overlapping_entry = BhdDataEntry()
+        overlapping_entry.hash = BhdDataEntry.hash_name("/chr/overlap")
+        overlapping_entry.offset = entry.offset + 8
+        overlapping_entry.size = 8
+        self.bhd.records[1].entries.append(overlapping_entry)
+        outside_entry = BhdDataEntry()
+        outside_entry.offset = 0x10000
+        outside_entry.size = 16
+        self.bhd.records[1].entries.append(outside_entry)
+        bad_size = bytearray(Dcx.compress_data(b"a" * 100))
+        struct.pack_into(">I", bad_size, 0x1C, 99)  # DCS uncompressed size.
+        self._add_file(1, "/a.dcx", bytes(bad_size))
+        self._add_file(1, "/b.dcx", Dcx.compress_data(b"b")[:-4])
+        bad_header = bytearray(Dcx.compress_data(b"c"))
+        struct.pack_into(">I", bad_header, 0x18, 0xDEADBEEF)
+        self._add_file(1, "/c.dcx", bytes(bad_header))
+        self._add_file(1, "/d.dcx", b"not a dcx at all")
+
+        verifier = self._verify(workers = 2)
+        self.assertFalse(verifier.get_report()["valid"])
+        self.assertEqual(
+            [(issue["check"], issue["entry"]) for issue in verifier.issues],
+            [ ("overlap", 0), ("bounds", 1), ("dcx", 2), ("dcx", 3),
+              ("dcx", 4), ("dcx", 5) ]
+        )
+        self.assertEqual(
+            verifier.issues[2]["message"],
+            "Inflated to 100 bytes instead of 99."
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()